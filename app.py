@@ -1,184 +1,402 @@
+"""
+Horse racing filter API
+
+create_app() builds the application without touching the database: the
+engine is created by db.init_app but connects on the first query, and the
+schema is managed by `flask migrate` rather than at startup.
+
+The ops endpoints (pool, cache, compression and Prometheus metrics) sit
+on their own blueprint, outside CORS, and answer only requests carrying
+"Authorization: Bearer <OPS_TOKEN>". Without OPS_TOKEN set they return
+404.
+"""
+
+import hmac
 import os
-from flask import Flask, request, jsonify
+from flask import Blueprint, Flask, Response, abort, current_app, request, jsonify
 from flask_cors import CORS
-from models import db, Race, Runner, FormLine
-from course_mapping import get_course_characteristics
+from sqlalchemy import func
+from models import (db, Race, Runner, FormLine, RunnerFormStat, COURSE_CHARACTERISTIC_KEYS,
+                    form_before, course_codes)
+from course_mapping import resolve_course
+from courses import courses_with_races, seed_courses_command
+from pagination import parse_page_args, paginate, keyset_query
+from cache import cached_lookup, lookup_cache
+from db_pool import configure_engine, engine_options, pool_stats
+from metrics import install_metrics, metrics
+from form_filters import (build_form_criteria, build_race_criteria, build_screen_query,
+                          parse_int_arg)
+from http_cache import make_etag, not_modified, with_validators
+from ingest import ingest_command
+from refresh import refresh_command
+from form_stats import STAT_DIMENSIONS, ALL, BAND_ORDER, rebuild_form_stats_command
+from migrations import migrate_command
+from streaming import stream_response, wants_stream
+from racecards import (MAX_FORM_LIMIT, build_snapshot, is_live, load_form_lines, racecard_runners_query,
+                       racecard_version, read_snapshot, snapshot_response, stored_snapshot)
+from compression import compressed_bodies, install_compression, preferred_encoding
+from serializers import (install_json_provider, serialize_race, serialize_runner,
+                         serialize_form_line)
 from datetime import datetime
 
-app = Flask(__name__)
-CORS(app)
-
-# Database configuration
-database_url = os.getenv('DATABASE_URL')
-if database_url and database_url.startswith('postgres://'):
-    database_url = database_url.replace('postgres://', 'postgresql://', 1)
-
-app.config['SQLALCHEMY_DATABASE_URI'] = database_url
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+api = Blueprint('api', __name__)
+CORS(api)
+ops = Blueprint('ops', __name__)  # not CORS enabled
 
-db.init_app(app)
+def database_url():
+    """DATABASE_URL, with the postgres:// scheme some hosts still hand out fixed up"""
+    url = os.getenv('DATABASE_URL')
+    if url and url.startswith('postgres://'):
+        url = url.replace('postgres://', 'postgresql://', 1)
+    return url
 
-# Create tables
-with app.app_context():
-    db.create_all()
+def create_app(config=None):
+    """
+    Build the Flask application
+    
+    Args:
+        config (dict): Settings applied over the defaults (e.g. a test
+            SQLALCHEMY_DATABASE_URI)
+    """
+    app = Flask(__name__)
+    
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_url()
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['OPS_TOKEN'] = os.getenv('OPS_TOKEN')
+    app.config.update(config or {})
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS',
+                          engine_options(app.config['SQLALCHEMY_DATABASE_URI']))
+    
+    install_json_provider(app)
+    install_metrics(app)
+    install_compression(app)  # after metrics, so its hook runs first and is timed
+    
+    db.init_app(app)
+    with app.app_context():
+        configure_engine(db.engine)
+    app.register_blueprint(api)
+    app.register_blueprint(ops)
+    app.cli.add_command(ingest_command)
+    app.cli.add_command(refresh_command)
+    app.cli.add_command(rebuild_form_stats_command)
+    app.cli.add_command(migrate_command)
+    app.cli.add_command(seed_courses_command)
+    return app
 
-@app.route('/api/races', methods=['GET'])
+@api.route('/api/races', methods=['GET'])
 def get_races():
     """
-    Get races with optional filtering
-    Query params: date, course, going, distance, race_class
+    Get races with optional filtering, paged by (date, id)
+    Query params: date, course, going, distance, race_class, min_distance,
+    max_distance, going_min, going_max, surface, configuration, lh_rh,
+    limit, cursor
+    With stream=1 or Accept: application/x-ndjson every matching race from
+    the cursor onwards is streamed instead of a single page
     """
+    try:
+        limit, cursor = parse_page_args(request.args)
+        criteria = build_race_criteria(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
     date_str = request.args.get('date')
     course = request.args.get('course')
     going = request.args.get('going')
     distance = request.args.get('distance')
     race_class = request.args.get('race_class')
     
-    # Start with all races
-    query = Race.query
+    # Start with all races, selecting plain columns rather than Race objects
+    query = db.session.query(*serialize_race.columns).filter(*criteria)
     
     # Apply filters
     if date_str:
         try:
             date_obj = datetime.strptime(date_str, '%Y-%m-%d').date()
-            query = query.filter_by(date=date_obj)
+            query = query.filter(Race.date == date_obj)
         except ValueError:
             return jsonify({'error': 'Invalid date format. Use YYYY-MM-DD'}), 400
     
     if course:
-        query = query.filter_by(course=course)
+        query = query.filter(Race.course == course)
     
     if going:
-        query = query.filter_by(going=going)
+        query = query.filter(Race.going == going)
         
     if distance:
-        query = query.filter_by(distance=distance)
+        query = query.filter(Race.distance == distance)
         
     if race_class:
-        query = query.filter_by(race_class=race_class)
+        query = query.filter(Race.race_class == race_class)
+    
+    if wants_stream():
+        return stream_response(keyset_query(query, Race.date, Race.id, cursor),
+                               'races', serialize_race)
     
-    races = query.all()
+    races, next_cursor = paginate(query, Race.date, Race.id, limit, cursor)
     
     return jsonify({
         'count': len(races),
-        'races': [race.to_dict() for race in races]
+        'races': [serialize_race(race) for race in races],
+        'next_cursor': next_cursor
     })
 
-@app.route('/api/races/<int:race_id>', methods=['GET'])
+@api.route('/api/races/<int:race_id>', methods=['GET'])
 def get_race_detail(race_id):
     """
     Get detailed race card with all runners and their form
+    Query params: form_limit (optional, most recent form lines per runner)
     """
+    form_limit = request.args.get('form_limit', type=int)
+    if form_limit is not None and form_limit < 1:
+        return jsonify({'error': 'form_limit must be a positive integer'}), 400
+    
     race = Race.query.get_or_404(race_id)
-    runners = Runner.query.filter_by(race_id=race_id).all()
     
-    return jsonify({
+    # Version the card from row counts and timestamps so a revalidation
+    # can be answered before any runner or form rows are loaded. No
+    # Last-Modified: a new form line or a deleted runner moves no
+    # timestamp, so only the ETag can tell.
+    runner_count, runners_updated, form_count, max_form_id = (
+        db.session.query(func.count(func.distinct(Runner.id)), func.max(Runner.updated_at),
+                         func.count(FormLine.id), func.max(FormLine.id))
+        .select_from(Runner)
+        .outerjoin(FormLine, db.and_(FormLine.horse_id == Runner.horse_id,
+                                     form_before(race.date)))
+        .filter(Runner.race_id == race_id)
+        .one())
+    etag = make_etag(race_id, race.updated_at, runner_count, runners_updated,
+                     form_count, max_form_id, form_limit)
+    
+    cached = not_modified(etag)
+    if cached:
+        return cached
+    
+    rows = racecard_runners_query([race_id]).all()
+    
+    # One statement for every runner's form instead of a lazy load per runner
+    form_by_horse = load_form_lines([row.horse_id for row in rows], race.date, form_limit)
+    runners = []
+    for row in rows:
+        runner = serialize_runner(row)
+        runner['form_lines'] = form_by_horse[row.horse_id]
+        runners.append(runner)
+    
+    response = jsonify({
         'race': race.to_dict(),
-        'runners': [runner.to_dict(include_form=True) for runner in runners]
+        'runners': runners
     })
+    return with_validators(response, etag)
 
-@app.route('/api/runners/<int:runner_id>/form', methods=['GET'])
+@api.route('/api/runners/<int:runner_id>/form', methods=['GET'])
 def get_runner_form(runner_id):
     """
-    Get filtered form for a specific runner
-    Query params: going, distance, class, min_position, max_position
+    Get filtered form for a specific runner, paged by (race_date, id)
+    Query params:
+        going, distance, class, race_type, course, surface, configuration, lh_rh
+            (repeat or comma separate for several values)
+        min_position, max_position, min_or, max_or, date_from, date_to
+        min_distance, max_distance (e.g. 2m, 2m4f), going_min, going_max
+            (e.g. Good to Soft, Heavy; firmest to softest)
+        limit, cursor
+        stream=1 or Accept: application/x-ndjson streams all matching form
     """
+    try:
+        limit, cursor = parse_page_args(request.args)
+        criteria = build_form_criteria(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
     runner = Runner.query.get_or_404(runner_id)
     
-    # Start with all form lines for this runner
-    query = FormLine.query.filter_by(runner_id=runner_id)
+    # The horse's form going into this race. All filters compile into one
+    # statement served by ix_form_lines_horse_date
+    query = (db.session.query(*serialize_form_line.columns)
+             .filter(FormLine.horse_id == runner.horse_id, form_before(runner.race.date),
+                     *criteria))
     
-    # Apply filters
-    going = request.args.get('going')
-    if going:
-        query = query.filter_by(going=going)
+    if wants_stream():
+        return stream_response(keyset_query(query, FormLine.race_date, FormLine.id, cursor,
+                                            descending=True),
+                               'form', serialize_form_line)
     
-    distance = request.args.get('distance')
-    if distance:
-        query = query.filter_by(distance=distance)
+    # Most recent first
+    form_lines, next_cursor = paginate(query, FormLine.race_date, FormLine.id,
+                                       limit, cursor, descending=True)
     
-    race_class = request.args.get('class')
-    if race_class:
-        query = query.filter_by(race_class=race_class)
+    return jsonify({
+        'runner': runner.to_dict(include_form=False),
+        'form': [serialize_form_line(form) for form in form_lines],
+        'next_cursor': next_cursor
+    })
+
+@api.route('/api/runners/<int:runner_id>/stats', methods=['GET'])
+def get_runner_stats(runner_id):
+    """
+    Get precomputed form aggregates for a runner's horse
+    Query params: dimension (optional, one of going, distance, race_class,
+    race_type, surface, configuration, lh_rh). Distances are bands, shortest
+    first (form_stats.DISTANCE_BANDS).
+    """
+    dimension = request.args.get('dimension')
+    if dimension and dimension not in STAT_DIMENSIONS:
+        return jsonify({'error': 'dimension must be one of %s' % ', '.join(STAT_DIMENSIONS)}), 400
     
-    min_position = request.args.get('min_position', type=int)
-    if min_position:
-        query = query.filter(FormLine.position >= min_position)
+    runner = Runner.query.get_or_404(runner_id)
     
-    max_position = request.args.get('max_position', type=int)
-    if max_position:
-        query = query.filter(FormLine.position <= max_position)
+    query = RunnerFormStat.query.filter_by(horse_id=runner.horse_id)
+    if dimension:
+        query = query.filter(RunnerFormStat.dimension.in_([ALL, dimension]))
     
-    # Order by date descending (most recent first)
-    form_lines = query.order_by(FormLine.date.desc()).all()
+    overall = None
+    stats = {}
+    for stat in query.order_by(RunnerFormStat.dimension, RunnerFormStat.value):
+        if stat.dimension == ALL:
+            overall = stat.to_dict()
+        else:
+            stats.setdefault(stat.dimension, []).append(stat.to_dict())
+    if 'distance' in stats:
+        stats['distance'].sort(key=lambda stat: BAND_ORDER.get(stat['value'], len(BAND_ORDER)))
     
     return jsonify({
         'runner': runner.to_dict(include_form=False),
-        'form': [form.to_dict() for form in form_lines]
+        'overall': overall,
+        'stats': stats
     })
 
-@app.route('/api/courses', methods=['GET'])
-def get_courses():
+@api.route('/api/screen', methods=['GET'])
+def screen_runners():
     """
-    Get list of all courses
+    Screen every runner on a day by their form, in one grouped query
+    Query params:
+        date (required)
+        any form filter accepted by /api/runners/<id>/form
+        within_days (recency window before the race date)
+        min_matches (default 1), min_wins (default 0)
     """
-    courses = db.session.query(Race.course).distinct().order_by(Race.course).all()
+    date_str = request.args.get('date')
+    
+    if not date_str:
+        return jsonify({'error': 'Date parameter is required'}), 400
+    
+    try:
+        date_obj = datetime.strptime(date_str, '%Y-%m-%d').date()
+    except ValueError:
+        return jsonify({'error': 'Invalid date format. Use YYYY-MM-DD'}), 400
+    
+    try:
+        criteria = build_form_criteria(request.args)
+        within_days = parse_int_arg(request.args, 'within_days')
+        min_matches = parse_int_arg(request.args, 'min_matches') or 1
+        min_wins = parse_int_arg(request.args, 'min_wins') or 0
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    rows = build_screen_query(date_obj, criteria, within_days, min_matches, min_wins).all()
+    
+    results = []
+    for row in rows:
+        result = row.Runner.to_dict(include_form=False)
+        result.update({
+            'race_id': row.race_id,
+            'course': row.course,
+            'race_time': row.race_time,
+            'race_name': row.race_name,
+            'matches': row.matches,
+            'wins': row.wins,
+            'places': row.places,
+            'last_match': row.last_match.isoformat() if row.last_match else None,
+            'best_rpr': row.best_rpr,
+            'best_or': row.best_or
+        })
+        results.append(result)
+    
     return jsonify({
-        'courses': [course[0] for course in courses]
+        'date': date_str,
+        'count': len(results),
+        'runners': results
     })
 
-@app.route('/api/courses/<course_name>', methods=['GET'])
+@api.route('/api/courses', methods=['GET'])
+def get_courses():
+    """
+    Get list of the courses with races, and the characteristics of each
+    keyed by name
+    """
+    def load():
+        courses = courses_with_races().all()
+        return {
+            'courses': [course.name for course in courses],
+            'characteristics': {course.name: {key: getattr(course, key) for key in COURSE_CHARACTERISTIC_KEYS}
+                                for course in courses}
+        }
+    
+    return jsonify(cached_lookup('courses', load))
+
+@api.route('/api/courses/<course_name>', methods=['GET'])
 def get_course_info(course_name):
     """
-    Get course characteristics
+    Get course characteristics from the courses table; names not stored
+    as given are matched through course_mapping's aliases and fuzzy match
     """
-    characteristics = get_course_characteristics(course_name)
+    code = course_codes.code(course_name) or course_codes.code(resolve_course(course_name))
+    course = course_codes.row(code) if code else None
     
-    if characteristics:
+    if course:
         return jsonify({
             'course': course_name,
-            'characteristics': characteristics
+            'characteristics': {key: course[key] for key in COURSE_CHARACTERISTIC_KEYS}
         })
     else:
         return jsonify({
             'error': 'Course not found'
         }), 404
 
-@app.route('/api/goings', methods=['GET'])
+@api.route('/api/goings', methods=['GET'])
 def get_goings():
     """
     Get list of all going descriptions
     """
-    goings = db.session.query(Race.going).distinct().order_by(Race.going).all()
+    def load():
+        goings = db.session.query(Race.going).distinct().order_by(Race.going).all()
+        return [going[0] for going in goings if going[0]]
+    
     return jsonify({
-        'goings': [going[0] for going in goings if going[0]]
+        'goings': cached_lookup('goings', load)
     })
 
-@app.route('/api/distances', methods=['GET'])
+@api.route('/api/distances', methods=['GET'])
 def get_distances():
     """
     Get list of all distances
     """
-    distances = db.session.query(Race.distance).distinct().order_by(Race.distance).all()
+    def load():
+        distances = db.session.query(Race.distance).distinct().order_by(Race.distance).all()
+        return [distance[0] for distance in distances if distance[0]]
+    
     return jsonify({
-        'distances': [distance[0] for distance in distances if distance[0]]
+        'distances': cached_lookup('distances', load)
     })
 
-@app.route('/api/classes', methods=['GET'])
+@api.route('/api/classes', methods=['GET'])
 def get_classes():
     """
     Get list of all race classes
     """
-    classes = db.session.query(Race.race_class).distinct().order_by(Race.race_class).all()
+    def load():
+        classes = db.session.query(Race.race_class).distinct().order_by(Race.race_class).all()
+        return [cls[0] for cls in classes if cls[0]]
+    
     return jsonify({
-        'classes': [cls[0] for cls in classes if cls[0]]
+        'classes': cached_lookup('classes', load)
     })
 
-@app.route('/api/racecards', methods=['GET'])
+@api.route('/api/racecards', methods=['GET'])
 def get_racecards():
     """
-    Get race cards (races with runners) for a specific date
-    Query params: date (required)
+    Get race cards (races with runners) for a specific date, served from
+    the date's compressed snapshot (see racecards.py)
+    Query params: date (required), form_limit (latest form lines per
+    runner, up to MAX_FORM_LIMIT; default none)
     """
     date_str = request.args.get('date')
     
@@ -190,45 +408,83 @@ def get_racecards():
     except ValueError:
         return jsonify({'error': 'Invalid date format. Use YYYY-MM-DD'}), 400
     
-    races = Race.query.filter_by(date=date_obj).order_by(Race.race_time).all()
+    form_limit = request.args.get('form_limit', 0, type=int)
+    if not 0 <= form_limit <= MAX_FORM_LIMIT:
+        return jsonify({'error': 'form_limit must be between 0 and %d' % MAX_FORM_LIMIT}), 400
     
-    racecards = []
-    for race in races:
-        runners = Runner.query.filter_by(race_id=race.id).all()
-        racecards.append({
-            'race': race.to_dict(),
-            'runners': [runner.to_dict(include_form=False) for runner in runners]
-        })
+    encoding = preferred_encoding()
+    version = None
+    if is_live(date_obj):
+        # Cards still changing: check the cheap per-date version first
+        version = racecard_version(date_obj, form_limit)
+        cached = not_modified(version)
+        if cached:
+            cached.vary.add('Accept-Encoding')
+            return cached
     
-    return jsonify({
-        'date': date_str,
-        'count': len(racecards),
-        'racecards': racecards
-    })
+    snapshot = read_snapshot(date_obj, form_limit, encoding)
+    if snapshot is None or (version is not None and snapshot.version != version):
+        snapshot = stored_snapshot(build_snapshot(date_obj, form_limit), encoding)
+    return snapshot_response(snapshot)
 
-@app.route('/api/health', methods=['GET'])
+@api.route('/api/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
     return jsonify({'status': 'healthy'})
 
-@app.route('/api/test-db', methods=['GET'])
+@api.route('/api/test-db', methods=['GET'])
 def test_db():
     """Test database connection and show what races are in the database"""
     try:
-        races = Race.query.all()
+        # Count in the database and only load the five races shown
+        total_races = db.session.query(func.count(Race.id)).scalar()
+        races = Race.query.limit(5).all()
         return jsonify({
             'status': 'success',
-            'total_races': len(races),
+            'total_races': total_races,
             'races': [{
                 'date': str(race.date),
                 'course': race.course,
                 'time': race.race_time,
                 'name': race.race_name
-            } for race in races[:5]]
+            } for race in races]
         })
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
+@ops.before_request
+def require_ops_token():
+    """Turn away ops requests without the bearer token, or all of them if none is set"""
+    token = current_app.config.get('OPS_TOKEN')
+    if not token:
+        abort(404)
+    supplied = request.headers.get('Authorization', '').encode('utf-8')
+    if not hmac.compare_digest(supplied, ('Bearer %s' % token).encode('utf-8')):
+        return jsonify({'error': 'ops token required'}), 401, {'WWW-Authenticate': 'Bearer'}
+
+@ops.route('/api/cache-stats', methods=['GET'])
+def cache_stats():
+    """Hit/miss counters for the lookup cache"""
+    return jsonify(lookup_cache.stats())
+
+@ops.route('/api/compression-stats', methods=['GET'])
+def compression_stats():
+    """Responses compressed by this process, bytes in and out and CPU time"""
+    return jsonify(compressed_bodies.stats())
+
+@ops.route('/api/pool-stats', methods=['GET'])
+def get_pool_stats():
+    """Connection pool gauges and checkout counters of the worker answering"""
+    return jsonify(pool_stats(db.engine))
+
+@ops.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """Request, SQL and connection pool metrics of this worker in the Prometheus text format"""
+    return Response(metrics.render(pool_stats(db.engine)), mimetype='text/plain; version=0.0.4')
+
+# For `gunicorn app:app` and `flask --app app`
+app = create_app()
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port)
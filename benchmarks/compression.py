@@ -0,0 +1,95 @@
+"""
+Bytes on the wire and CPU per response for each compression setting
+
+Loads the synthetic dataset (benchmarks.dataset) into an empty database,
+fetches the large JSON responses uncompressed, then compresses each body
+--repeat times per encoding and level, timing CPU with process_time().
+The last table sends the same requests with Accept-Encoding: br, gzip
+through the app, first with the compressed-body LRU cold and then warm.
+
+Usage: python -m benchmarks.compression [--scale day] [--seed 1] [--repeat 20]
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from benchmarks.dataset import FIRST_DAY, generate, load
+
+# (label, url); {date} and {race_id} are filled from the loaded data
+RESPONSES = [
+    ('race detail', '/api/races/{race_id}'),
+    ('race detail, form_limit=5', '/api/races/{race_id}?form_limit=5'),
+    ('races page', '/api/races?limit=50'),
+    ('races streamed', '/api/races?stream=1'),
+    ('screen', '/api/screen?date={date}&going=Soft&min_matches=1'),
+    ('racecards, form_limit=5', '/api/racecards?date={date}&form_limit=5'),
+]
+
+SETTINGS = [('gzip', 1), ('gzip', 6), ('gzip', 9), ('br', 1), ('br', 4), ('br', 6), ('br', 9), ('br', 11)]
+
+
+def cpu_ms(compress, body, encoding, level, repeat):
+    started = time.process_time()
+    for _ in range(repeat):
+        compressed = compress(body, encoding, level)
+    return (time.process_time() - started) / repeat * 1000, len(compressed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scale', default='day')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=20)
+    options = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='hrf-bench-')
+    os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(workdir, 'bench.sqlite'))
+
+    from app import app
+    from compression import brotli, compress, compressed_bodies
+    from migrations import migrate
+    from models import db, Race
+
+    with app.app_context():
+        migrate()
+        if not db.session.query(Race.id).first():
+            load(generate(options.scale, options.seed, workdir))
+        race = Race.query.filter(Race.date == FIRST_DAY).order_by(Race.id).first()
+        values = {'date': FIRST_DAY.isoformat(), 'race_id': race.id}
+
+    settings = [(encoding, level) for encoding, level in SETTINGS if brotli or encoding == 'gzip']
+    client = app.test_client()
+    bodies = {}
+    print('%-28s %9s  %s' % ('', 'identity', '  '.join('%-16s' % ('%s-%d' % s) for s in settings)))
+    print('%-28s %9s  %s' % ('', 'KB', '  '.join('%-16s' % 'KB    ms CPU' for _ in settings)))
+    for label, url in RESPONSES:
+        url = url.format(**values)
+        bodies[label] = url
+        body = client.get(url, headers={'Accept-Encoding': 'identity'}).get_data()
+        cells = []
+        for encoding, level in settings:
+            ms, size = cpu_ms(compress, body, encoding, level, options.repeat)
+            cells.append('%-16s' % ('%6.1f %7.2f' % (size / 1024, ms)))
+        print('%-28s %9.1f  %s' % (label, len(body) / 1024, '  '.join(cells)))
+
+    print('\nthrough the app with Accept-Encoding: br, gzip (levels from COMPRESS_*)')
+    print('%-28s %-6s %9s %9s %10s %10s' % ('', 'coding', 'wire KB', 'ratio', 'cold ms', 'warm ms'))
+    for label, url in bodies.items():
+        identity = len(client.get(url, headers={'Accept-Encoding': 'identity'}).get_data())
+        compressed_bodies.clear()
+        timings = []
+        for _ in range(2):
+            started = time.perf_counter()
+            response = client.get(url, headers={'Accept-Encoding': 'br, gzip'})
+            wire = len(response.get_data())
+            timings.append((time.perf_counter() - started) * 1000)
+        print('%-28s %-6s %9.1f %9.3f %10.2f %10.2f'
+              % (label, response.headers.get('Content-Encoding', '-'), wire / 1024,
+                 wire / identity, timings[0], timings[1]))
+    print('\n%s' % compressed_bodies.stats())
+
+
+if __name__ == '__main__':
+    main()
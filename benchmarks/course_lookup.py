@@ -0,0 +1,72 @@
+"""
+Course name resolution throughput: exact dict.get vs resolve_course
+
+Resolves a deterministic stream of course strings as they arrive from
+feeds: exact names, other casings, all-weather and "Park" variants,
+aliases, typos and unknown courses. Reports rows/s and how many strings
+each approach matched, plus the cost of the uncached normalise + fuzzy
+path for comparison.
+
+Usage: python -m benchmarks.course_lookup [--count 1000000] [--seed 1]
+"""
+
+import argparse
+import random
+import time
+
+from course_mapping import COURSE_ALIASES, COURSE_CHARACTERISTICS, _resolve_course, resolve_course
+
+
+def variants(course_name, rng):
+    base = course_name.replace(' (AW)', '')
+    typo_at = rng.randrange(1, len(base) - 1)
+    return [
+        course_name,
+        course_name.upper(),
+        course_name.lower(),
+        base + ' AW',
+        base + ' (Tapeta)',
+        base + ' Park',
+        base[:typo_at] + base[typo_at + 1:],
+    ]
+
+
+def make_stream(count, seed):
+    rng = random.Random(seed)
+    pool = []
+    for course_name in sorted(COURSE_CHARACTERISTICS):
+        pool.extend(variants(course_name, rng))
+    pool.extend(COURSE_ALIASES)
+    pool.extend('Unknown Downs %d' % i for i in range(50))
+    # Feeds repeat the day's few courses, so skew towards the start of the pool
+    return [pool[min(int(rng.expovariate(1 / 40)), len(pool) - 1)] for _ in range(count)]
+
+
+def timed(label, resolve, names):
+    started = time.perf_counter()
+    matched = sum(1 for name in names if resolve(name) is not None)
+    seconds = time.perf_counter() - started
+    print('%-28s %10.0f names/s  (%.2fs, %.1f%% matched)'
+          % (label, len(names) / seconds, seconds, 100.0 * matched / len(names)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--count', type=int, default=1000000)
+    parser.add_argument('--seed', type=int, default=1)
+    options = parser.parse_args()
+
+    names = make_stream(options.count, options.seed)
+    print('%d names, %d distinct' % (len(names), len(set(names))))
+
+    timed('exact dict.get', COURSE_CHARACTERISTICS.get, names)
+    _resolve_course.cache_clear()
+    timed('resolve_course', resolve_course, names)
+    info = _resolve_course.cache_info()
+    print('  cache: %d hits, %d misses' % (info.hits, info.misses))
+    sample = names[:max(1, options.count // 100)]
+    timed('uncached normalise + fuzzy', _resolve_course.__wrapped__, sample)
+
+
+if __name__ == '__main__':
+    main()
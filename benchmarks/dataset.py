@@ -0,0 +1,168 @@
+"""
+Deterministic synthetic racing data at a chosen scale
+
+Builds race days at real courses from COURSE_CHARACTERISTICS, with a fixed
+population of horses that each run about once a month. Every runner of a
+race gets a form line for it, so a horse's form is exactly its earlier
+runs; small scales also get form-only history days before the first race
+card so runners arrive with form. The same --scale and --seed always
+produce the same rows.
+
+Writes cards.jsonl (races and runners) and form.csv (form lines) in the
+formats `flask ingest` reads, then optionally loads them through the
+ingest pipeline.
+
+Scales: day (1 day after 180 days of form), season (26 weeks),
+        decade (10 years)
+
+Usage: python -m benchmarks.dataset [--scale day] [--seed 1] [--out DIR] [--load]
+"""
+
+import argparse
+import csv
+import json
+import os
+import random
+import tempfile
+from datetime import date, timedelta
+
+from course_mapping import COURSE_CHARACTERISTICS
+from race_conditions import GOING_SCALE
+
+# race card days, form-only history days, meetings per day, races per
+# meeting, runners per race
+SCALES = {
+    'day': (1, 180, 6, 7, 10),
+    'season': (182, 0, 5, 7, 10),
+    'decade': (3650, 0, 5, 7, 10),
+}
+
+# Date of the first race card
+FIRST_DAY = date(2015, 1, 1)
+
+DISTANCES = ['5f', '6f', '7f', '1m', '1m2f', '1m4f', '1m6f', '2m', '2m4f', '3m', '3m2f']
+GOINGS = [going.title() for going in GOING_SCALE]
+RACE_CLASSES = ['Class %d' % n for n in range(1, 7)]
+RACE_TYPES = ['Handicap', 'Maiden', 'Novice', 'Conditions', 'Listed', 'Group 3']
+RACE_CODES = ['Flat', 'Hurdle', 'Chase', 'NH Flat']
+FORM_FIELDS = ['horse_name', 'race_date', 'course', 'distance', 'going', 'race_class',
+               'race_type', 'race_code', 'finishing_position', 'beaten_distance',
+               'weight_carried', 'official_rating', 'rpr', 'jockey', 'odds', 'comment']
+
+
+def generate(scale='day', seed=1, out=None):
+    """
+    Write cards.jsonl and form.csv for a scale
+
+    Returns:
+        dict: Paths of the files and the row counts written
+    """
+    days, history, meetings, races_per_meeting, field_size = SCALES[scale]
+    rng = random.Random(seed)
+    out = out or tempfile.mkdtemp(prefix='hrf-data-')
+    os.makedirs(out, exist_ok=True)
+    courses = sorted(COURSE_CHARACTERISTICS)
+    jockeys = ['Jockey %d' % n for n in range(300)]
+    trainers = ['Trainer %d' % n for n in range(200)]
+
+    # Enough horses that each runs about once a month
+    horses = ['Horse %d' % n for n in range(max(200, meetings * races_per_meeting * field_size * 30))]
+    ratings = {horse: rng.randint(40, 120) for horse in horses}
+
+    cards_path = os.path.join(out, 'cards.jsonl')
+    form_path = os.path.join(out, 'form.csv')
+    counts = {'races': 0, 'runners': 0, 'form_lines': 0}
+    with open(cards_path, 'w', encoding='utf-8') as cards, \
+            open(form_path, 'w', encoding='utf-8', newline='') as form_file:
+        form = csv.DictWriter(form_file, FORM_FIELDS)
+        form.writeheader()
+        for day in range(-history, days):
+            race_date = FIRST_DAY + timedelta(days=day)
+            for course in rng.sample(courses, meetings):
+                going = rng.choice(GOINGS)  # shared by the meeting's races
+                for number in range(races_per_meeting):
+                    distance = rng.choice(DISTANCES)
+                    race = {
+                        'date': race_date.isoformat(),
+                        'course': course,
+                        'race_time': '%02d:%02d' % (13 + number * 35 // 60, number * 35 % 60),
+                        'race_name': '%s %s Stakes' % (course, rng.choice(RACE_TYPES)),
+                        'distance': distance,
+                        'race_class': rng.choice(RACE_CLASSES),
+                        'going': going,
+                        'prize': '£%d' % rng.choice([3000, 5000, 10000, 25000, 100000]),
+                        'age_restriction': rng.choice(['2yo', '3yo', '3yo+', '4yo+']),
+                        'runners': [],
+                    }
+                    race_type, race_code = rng.choice(RACE_TYPES), rng.choice(RACE_CODES)
+                    # Finishing order is the order the horses were drawn
+                    field = rng.sample(horses, field_size)
+                    draws = rng.sample(range(1, field_size + 1), field_size)
+                    for position, (horse, draw) in enumerate(zip(field, draws), 1):
+                        jockey = rng.choice(jockeys)
+                        odds = '%d/%d' % (rng.randint(1, 40), rng.choice([1, 2]))
+                        race['runners'].append({
+                            'horse_name': horse,
+                            'age': rng.randint(2, 10),
+                            'weight': '%d-%d' % (rng.randint(8, 11), rng.randint(0, 13)),
+                            'draw': draw,
+                            'jockey': jockey,
+                            'trainer': rng.choice(trainers),
+                            'official_rating': ratings[horse],
+                            'odds': odds,
+                        })
+                        form.writerow({
+                            'horse_name': horse,
+                            'race_date': race_date.isoformat(),
+                            'course': course,
+                            'distance': distance,
+                            'going': going,
+                            'race_class': race['race_class'],
+                            'race_type': race_type,
+                            'race_code': race_code,
+                            'finishing_position': position,
+                            'beaten_distance': '' if position == 1 else '%.1f' % rng.uniform(0.1, 20),
+                            'weight_carried': race['runners'][-1]['weight'],
+                            'official_rating': ratings[horse],
+                            'rpr': ratings[horse] + rng.randint(-10, 10),
+                            'jockey': jockey,
+                            'odds': odds,
+                            'comment': rng.choice(['led', 'prominent', 'held up', 'never nearer', '']),
+                        })
+                    counts['form_lines'] += field_size
+                    if day >= 0:
+                        cards.write(json.dumps(race) + '\n')
+                        counts['races'] += 1
+                        counts['runners'] += field_size
+    return dict(counts, cards=cards_path, form=form_path)
+
+
+def load(files):
+    """Ingest generated files into the app's database (needs an app context)"""
+    from ingest import ingest_file
+    return [ingest_file(files['cards']), ingest_file(files['form'])]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scale', choices=sorted(SCALES), default='day')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--out')
+    parser.add_argument('--load', action='store_true',
+                        help='ingest into DATABASE_URL after writing the files')
+    options = parser.parse_args()
+
+    files = generate(options.scale, options.seed, options.out)
+    print('%(races)d races, %(runners)d runners, %(form_lines)d form lines' % files)
+    print('wrote %s and %s' % (files['cards'], files['form']))
+    if options.load:
+        from app import app
+        from migrations import migrate
+        with app.app_context():
+            migrate()
+            for stats in load(files):
+                print(stats)
+
+
+if __name__ == '__main__':
+    main()
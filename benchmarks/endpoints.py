@@ -0,0 +1,210 @@
+"""
+Every API route under repeated requests, saved as JSON for comparison
+
+Loads the synthetic dataset (benchmarks.dataset) into an empty database,
+then sends each request in REQUESTS --requests times through the test
+client. For each it records throughput, p50/p99 latency, the SQL
+statements per request (from the Server-Timing header) and the peak
+Python memory allocated by one request (tracemalloc). Routes in the app
+that REQUESTS does not cover are listed so the suite keeps up with them.
+
+Run once against SQLite (the default, a throwaway file) and once with
+DATABASE_URL pointing at a local Postgres. --compare prints the change
+against an earlier --output file, e.g. from the previous commit.
+
+Usage: python -m benchmarks.endpoints [--scale day] [--seed 1] [--requests 200]
+                                      [--output results.json] [--compare baseline.json]
+"""
+
+import argparse
+import json
+import os
+import platform
+import re
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks.dataset import FIRST_DAY, generate, load
+
+# (label, url, headers); {date}, {race_id}, {runner_id}, {course},
+# {etag} and {ops} (the ops endpoints' Authorization) are filled in
+REQUESTS = [
+    ('races page', '/api/races?limit=50', {}),
+    ('races by date', '/api/races?date={date}', {}),
+    ('races by surface and going', '/api/races?surface=Flat&going_min=Good&limit=50', {}),
+    ('races streamed', '/api/races?stream=1', {}),
+    ('race detail', '/api/races/{race_id}', {}),
+    ('race detail, form_limit=5', '/api/races/{race_id}?form_limit=5', {}),
+    ('runner form', '/api/runners/{runner_id}/form', {}),
+    ('runner form filtered', '/api/runners/{runner_id}/form?going_min=Good&min_distance=1m', {}),
+    ('runner stats', '/api/runners/{runner_id}/stats', {}),
+    ('runner stats by going', '/api/runners/{runner_id}/stats?dimension=going', {}),
+    ('screen', '/api/screen?date={date}&going=Soft&min_matches=1', {}),
+    ('courses', '/api/courses', {}),
+    ('course info', '/api/courses/{course}', {}),
+    ('goings', '/api/goings', {}),
+    ('distances', '/api/distances', {}),
+    ('classes', '/api/classes', {}),
+    ('racecards', '/api/racecards?date={date}', {}),
+    ('racecards, not modified', '/api/racecards?date={date}', {'If-None-Match': '{etag}'}),
+    ('health', '/api/health', {}),
+    ('cache stats', '/api/cache-stats', {'Authorization': '{ops}'}),
+    ('compression stats', '/api/compression-stats', {'Authorization': '{ops}'}),
+    ('pool stats', '/api/pool-stats', {'Authorization': '{ops}'}),
+    ('metrics', '/api/metrics', {'Authorization': '{ops}'}),
+    ('test db', '/api/test-db', {}),
+]
+
+# p50 changes smaller than this are timer noise, whatever the percentage
+NOISE_MS = 0.25
+
+STATEMENTS = re.compile(r'desc="(\d+) statements"')
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def sample_values(client):
+    """Ids and names the request URLs are filled with"""
+    from models import db, Race, Runner
+
+    race_date = FIRST_DAY.isoformat()
+    race = Race.query.filter(Race.date == FIRST_DAY).order_by(Race.id).first()
+    runner_id = (db.session.query(Runner.id).filter(Runner.race_id == race.id)
+                 .order_by(Runner.id).limit(1).scalar())
+    etag = client.get('/api/racecards?date=%s' % race_date).headers['ETag']
+    return {'date': race_date, 'race_id': race.id, 'runner_id': runner_id,
+            'course': race.course, 'etag': etag}
+
+
+def measure(client, url, headers, count):
+    for _ in range(3):
+        client.get(url, headers=headers).get_data()
+
+    latencies, statements, statuses = [], [], set()
+    started = time.perf_counter()
+    for _ in range(count):
+        request_started = time.perf_counter()
+        response = client.get(url, headers=headers)
+        response.get_data()
+        latencies.append(time.perf_counter() - request_started)
+        statuses.add(response.status_code)
+        match = STATEMENTS.search(response.headers.get('Server-Timing', ''))
+        if match:
+            statements.append(int(match.group(1)))
+    elapsed = time.perf_counter() - started
+
+    tracemalloc.start()
+    client.get(url, headers=headers).get_data()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        'requests': count,
+        'status': sorted(statuses),
+        'requests_per_second': round(count / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'statements': statistics.median(statements) if statements else None,
+        'peak_kb': round(peak / 1024, 1),
+    }
+
+
+def compare(results, baseline_path, threshold):
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)['endpoints']
+    print('\nvs %s (regressions: p50 more than %d%% slower or more statements)'
+          % (baseline_path, threshold * 100))
+    for label, result in results.items():
+        before = baseline.get(label)
+        if before is None:
+            print('  %-30s new' % label)
+            continue
+        change = result['p50_ms'] / before['p50_ms'] - 1 if before['p50_ms'] else 0.0
+        more_statements = (result['statements'] or 0) > (before['statements'] or 0)
+        slower = change > threshold and result['p50_ms'] - before['p50_ms'] > NOISE_MS
+        flag = 'REGRESSED' if slower or more_statements else ''
+        print('  %-30s p50 %+6.1f%%  statements %s -> %s  %s'
+              % (label, change * 100, before['statements'], result['statements'], flag))
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scale', default='day')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--output')
+    parser.add_argument('--compare')
+    parser.add_argument('--threshold', type=float, default=0.10)
+    options = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='hrf-bench-')
+    os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(workdir, 'bench.sqlite'))
+    os.environ['METRICS_ENABLED'] = '1'
+    os.environ.setdefault('OPS_TOKEN', 'benchmark')
+
+    from app import app
+    from migrations import migrate
+    from models import db, Race
+
+    with app.app_context():
+        migrate()
+        if not db.session.query(Race.id).first():
+            load(generate(options.scale, options.seed, workdir))
+        dialect = db.engine.dialect.name
+        values = sample_values(app.test_client())
+        values['ops'] = 'Bearer %s' % app.config['OPS_TOKEN']
+
+    # Outside an app context, so each request gets its own (and its own session)
+    client = app.test_client()
+    covered = set()
+    results = {}
+    for label, url, headers in REQUESTS:
+        url = url.format(**values)
+        headers = {name: value.format(**values) for name, value in headers.items()}
+        covered.add(app.url_map.bind('localhost').match(url.split('?')[0])[0])
+        results[label] = measure(client, url, headers, options.requests)
+        result = results[label]
+        print('%-30s %8.1f req/s  p50 %8.2f ms  p99 %8.2f ms  %4s stmts  %8.1f KB  %s'
+              % (label, result['requests_per_second'], result['p50_ms'], result['p99_ms'],
+                 result['statements'], result['peak_kb'], result['status']))
+
+    missing = sorted(rule.rule for rule in app.url_map.iter_rules()
+                     if rule.endpoint != 'static' and rule.endpoint not in covered)
+    if missing:
+        print('\nroutes without a benchmark: %s' % ', '.join(missing))
+
+    if options.output:
+        with open(options.output, 'w', encoding='utf-8') as f:
+            json.dump({
+                'meta': {
+                    'commit': git_commit(),
+                    'database': dialect,
+                    'scale': options.scale,
+                    'seed': options.seed,
+                    'python': platform.python_version(),
+                    'date_sampled': values['date'],
+                },
+                'endpoints': results,
+            }, f, indent=2)
+        print('\nsaved %s' % options.output)
+
+    if options.compare:
+        compare(results, options.compare, options.threshold)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Full reload vs incremental refresh of a day's odds
+
+Loads one race day (races, runners and form lines), then applies an odds
+change for every runner two ways:
+  - full reload: delete the day's races, runners and form lines and ingest
+    the whole card again
+  - incremental: `flask refresh` style upsert of just the odds
+
+Runs against a throwaway SQLite file unless DATABASE_URL is set.
+
+Usage: python -m benchmarks.refresh [--races 60] [--runners 12] [--form 20]
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import time
+
+
+def write_card(path, races, runners, form, odds):
+    with open(path, 'w', encoding='utf-8') as f:
+        for r in range(races):
+            f.write(json.dumps({
+                'date': '2024-04-13',
+                'course': 'Aintree' if r % 2 else 'Newbury',
+                'race_time': '%02d:%02d' % (12 + r // 6, (r % 6) * 10),
+                'going': 'Good to Soft',
+                'runners': [{
+                    'horse_name': 'Horse %d-%d' % (r, h),
+                    'odds': odds,
+                    'form_lines': [{'race_date': '2023-%02d-01' % (f % 12 + 1),
+                                    'course': 'Cheltenham',
+                                    'finishing_position': f % 10 + 1} for f in range(form)]
+                } for h in range(runners)]
+            }) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--races', type=int, default=60)
+    parser.add_argument('--runners', type=int, default=12)
+    parser.add_argument('--form', type=int, default=20)
+    options = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='hrf-bench-')
+    os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(workdir, 'bench.sqlite'))
+
+    from app import app
+    from ingest import ingest_file
+    from models import db, Race, Runner, FormLine
+    from refresh import refresh_file
+
+    card = os.path.join(workdir, 'card.jsonl')
+    odds = os.path.join(workdir, 'odds.jsonl')
+    write_card(card, options.races, options.runners, options.form, '5/1')
+    write_card(odds, options.races, options.runners, 0, '9/2')
+
+    with app.app_context():
+        db.create_all()
+        ingest_file(card)
+
+        started = time.perf_counter()
+        race_ids = db.session.query(Race.id).filter(Race.date == '2024-04-13')
+        horse_ids = db.session.query(Runner.horse_id).filter(Runner.race_id.in_(race_ids))
+        FormLine.query.filter(FormLine.horse_id.in_(horse_ids)).delete(synchronize_session=False)
+        Runner.query.filter(Runner.race_id.in_(race_ids)).delete(synchronize_session=False)
+        Race.query.filter(Race.id.in_(race_ids)).delete(synchronize_session=False)
+        db.session.commit()
+        ingest_file(card)
+        full_reload = time.perf_counter() - started
+
+        stats = refresh_file(odds)
+        incremental = stats['seconds']
+        unchanged = refresh_file(odds)['seconds']
+
+    print('%d races, %d runners, %d form lines'
+          % (options.races, options.races * options.runners,
+             options.races * options.runners * options.form))
+    print('full reload:            %8.1f ms' % (full_reload * 1000))
+    print('incremental refresh:    %8.1f ms (%d runners changed)'
+          % (incremental * 1000, stats['runners']))
+    print('refresh, no changes:    %8.1f ms' % (unchanged * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+FormLine serialisation throughput: ORM to_dict + stdlib json vs
+column-projected rows + precompiled serializer (+ orjson when installed)
+
+Runs against a throwaway SQLite file unless DATABASE_URL is set.
+
+Usage: python -m benchmarks.serialize [--rows 100000]
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import time
+from datetime import date, timedelta
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=100000)
+    options = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='hrf-bench-')
+    os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(workdir, 'bench.sqlite'))
+
+    from sqlalchemy import insert
+
+    from app import app
+    from ingest import resolve_codes
+    from models import db, Horse, FormLine
+    from serializers import orjson, serialize_form_line
+
+    with app.app_context():
+        db.create_all()
+        # One form line per (horse, date, course), so spread rows over horses
+        horses = [Horse(name='Benchmark %d' % i) for i in range(options.rows // 5000 + 1)]
+        db.session.add_all(horses)
+        db.session.commit()
+
+        rows = [{
+            'horse_id': horses[i // 5000].id,
+            'race_date': date(2010, 1, 1) + timedelta(days=i % 5000),
+            'course': 'Cheltenham', 'distance': '2m4f', 'going': 'Good to Soft',
+            'race_class': 'Class 2', 'race_type': 'Hurdle', 'race_code': 'Hcap',
+            'finishing_position': i % 12 + 1, 'beaten_distance': '3 1/4',
+            'weight_carried': '11-2', 'official_rating': 120, 'rpr': 131,
+            'jockey': 'A Jockey', 'odds': '9/2', 'comment': 'Held up, kept on'
+        } for i in range(options.rows)]
+        resolve_codes(rows[:1])
+        db.session.execute(insert(FormLine), rows)
+        db.session.commit()
+
+        def timed(label, run):
+            db.session.expunge_all()
+            started = time.perf_counter()
+            body = run()
+            seconds = time.perf_counter() - started
+            print('%-34s %8.0f rows/s  (%.2fs, %.1f MB)'
+                  % (label, options.rows / seconds, seconds, len(body) / 1e6))
+
+        timed('ORM to_dict + json', lambda: json.dumps(
+            [form.to_dict() for form in FormLine.query.all()]))
+        timed('projected rows + json', lambda: json.dumps(
+            [serialize_form_line(row) for row in db.session.query(*serialize_form_line.columns)]))
+        if orjson is not None:
+            timed('projected rows + orjson', lambda: orjson.dumps(
+                [serialize_form_line(row) for row in db.session.query(*serialize_form_line.columns)]))
+
+
+if __name__ == '__main__':
+    main()
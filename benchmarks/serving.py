@@ -0,0 +1,130 @@
+"""
+/api/racecards under load: Flask development server vs the gunicorn profile
+
+Loads one race day, then starts each server in turn and polls the day's
+racecards from concurrent keep-alive clients for a fixed time. Reports
+requests/s and p50/p99 latency per server.
+
+Runs against a throwaway SQLite file unless DATABASE_URL is set; the
+servers are started from the repository root with the same environment.
+
+Usage: python -m benchmarks.serving [--races 40] [--runners 12] [--form 10]
+                                    [--clients 16] [--seconds 10]
+"""
+
+import argparse
+import http.client
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks.refresh import write_card
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+URL = '/api/racecards?date=2024-04-13'
+
+SERVERS = [
+    ('flask dev server', [sys.executable, 'app.py']),
+    ('gunicorn profile', [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'app:app']),
+]
+
+
+def wait_until_up(port, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('server exited with code %d' % process.returncode)
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', '/api/health')
+            connection.getresponse().read()
+            connection.close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('server did not start within %ds' % timeout)
+
+
+def poll(port, stop_at, latencies, errors):
+    """One client: request the racecards back to back on one connection"""
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    while time.monotonic() < stop_at:
+        started = time.perf_counter()
+        try:
+            connection.request('GET', URL)
+            response = connection.getresponse()
+            response.read()
+            if response.status != 200:
+                errors.append(response.status)
+                continue
+        except (OSError, http.client.HTTPException) as e:
+            errors.append(type(e).__name__)
+            connection.close()
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+            continue
+        latencies.append(time.perf_counter() - started)
+    connection.close()
+
+
+def load(port, clients, seconds):
+    latencies, errors = [], []
+    stop_at = time.monotonic() + seconds
+    pollers = [threading.Thread(target=poll, args=(port, stop_at, latencies, errors))
+               for _ in range(clients)]
+    for poller in pollers:
+        poller.start()
+    for poller in pollers:
+        poller.join()
+    return sorted(latencies), errors
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] if ordered else float('nan')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--races', type=int, default=40)
+    parser.add_argument('--runners', type=int, default=12)
+    parser.add_argument('--form', type=int, default=10)
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--port', type=int, default=5099)
+    options = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='hrf-bench-')
+    os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(workdir, 'bench.sqlite'))
+
+    from app import app
+    from ingest import ingest_file
+    from models import db
+
+    card = os.path.join(workdir, 'card.jsonl')
+    write_card(card, options.races, options.runners, options.form, '5/1')
+    with app.app_context():
+        db.create_all()
+        ingest_file(card)
+
+    print('%d races x %d runners, %d clients for %gs'
+          % (options.races, options.runners, options.clients, options.seconds))
+    env = dict(os.environ, PORT=str(options.port), GUNICORN_ACCESS_LOG='')
+    for label, command in SERVERS:
+        process = subprocess.Popen(command, cwd=ROOT, env=env,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_until_up(options.port, process)
+            load(options.port, options.clients, 1)  # warm up
+            latencies, errors = load(options.port, options.clients, options.seconds)
+        finally:
+            process.terminate()
+            process.wait()
+        print('%-18s %8.0f req/s  p50 %6.1f ms  p99 %6.1f ms  (%d errors)'
+              % (label, len(latencies) / options.seconds, percentile(latencies, 0.50) * 1000,
+                 percentile(latencies, 0.99) * 1000, len(errors)))
+
+
+if __name__ == '__main__':
+    main()
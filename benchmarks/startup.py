@@ -0,0 +1,102 @@
+"""
+Cold start: import-to-first-request time of a fresh process
+
+Each run starts a new interpreter that imports the app, builds it with
+create_app() and serves /api/health then the day's /api/racecards (the
+first request that connects to the database) through the test client.
+Separately times a gunicorn master booting with the production profile
+until it answers /api/health. Medians over --runs.
+
+Runs against a throwaway SQLite file unless DATABASE_URL is set.
+
+Usage: python -m benchmarks.startup [--runs 5] [--port 5099]
+"""
+
+import argparse
+import http.client
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.refresh import write_card
+from benchmarks.serving import ROOT, wait_until_up
+
+PROBE = """
+import json, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+application = app.create_app()
+created = time.perf_counter()
+client = application.test_client()
+client.get('/api/health')
+health = time.perf_counter()
+assert client.get('/api/racecards?date=2024-04-13').status_code == 200
+racecards = time.perf_counter()
+print(json.dumps({
+    'import app': imported - started,
+    'create_app()': created - imported,
+    'first request': health - created,
+    'first DB request': racecards - health,
+    'import to first DB request': racecards - started,
+}))
+"""
+
+
+def probe():
+    started = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', PROBE], cwd=ROOT, check=True,
+                            capture_output=True, text=True).stdout
+    timings = json.loads(output.strip().splitlines()[-1])
+    timings['process start to first DB request'] = time.perf_counter() - started
+    return timings
+
+
+def gunicorn_boot(port):
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'app:app'],
+                               cwd=ROOT, env=dict(os.environ, PORT=str(port), GUNICORN_ACCESS_LOG=''),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_until_up(port, process)
+        seconds = time.perf_counter() - started
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        connection.request('GET', '/api/racecards?date=2024-04-13')
+        connection.getresponse().read()
+        return {'gunicorn boot to /api/health': seconds,
+                'gunicorn boot to first DB request': time.perf_counter() - started}
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--port', type=int, default=5099)
+    options = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='hrf-bench-')
+    os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(workdir, 'bench.sqlite'))
+
+    from app import app
+    from ingest import ingest_file
+    from migrations import migrate
+
+    card = os.path.join(workdir, 'card.jsonl')
+    write_card(card, 40, 12, 10, '5/1')
+    with app.app_context():
+        migrate()
+        ingest_file(card)
+
+    runs = [dict(probe(), **gunicorn_boot(options.port)) for _ in range(options.runs)]
+    for name in runs[0]:
+        print('%-36s %8.1f ms' % (name, statistics.median(run[name] for run in runs) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+"""
+Small caching layer for lookup endpoints (courses, goings, distances, classes)
+Entries expire after a TTL and are dropped whenever Race rows change
+
+Only the process that commits the change drops them. Races are written by
+`flask ingest`, `flask refresh` and `flask seed-courses`, which run in
+processes of their own, so with the in-process TTLCache the web workers
+keep serving the old lists for up to LOOKUP_CACHE_TTL. Set
+LOOKUP_CACHE_URL to share one cache, which those commands then clear for
+every worker.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+DEFAULT_TTL = 300
+DEFAULT_MAX_ENTRIES = 256
+
+
+class TTLCache:
+    """Bounded in-process cache with per-entry expiry and LRU eviction"""
+
+    def __init__(self, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Return the cached value, or None if missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'backend': 'memory',
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'ttl': self.ttl,
+            'max_entries': self.max_entries
+        }
+
+
+class RedisCache:
+    """
+    Cache shared between gunicorn workers through a Redis-compatible server
+
+    Keys are namespaced by a generation number stored in Redis; clearing the
+    cache bumps the generation so every worker misses at once without having
+    to enumerate keys. Any client exposing get/setex/incr can be passed in.
+    """
+
+    def __init__(self, client, ttl=DEFAULT_TTL, prefix='hrf:lookup'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, key):
+        generation = self.client.get(self.prefix + ':gen') or b'0'
+        if isinstance(generation, bytes):
+            generation = generation.decode('ascii')
+        return '%s:%s:%s' % (self.prefix, generation, key)
+
+    def get(self, key):
+        raw = self.client.get(self._key(key))
+        if raw is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(raw)
+
+    def set(self, key, value):
+        self.client.setex(self._key(key), self.ttl, json.dumps(value))
+
+    def clear(self):
+        self.client.incr(self.prefix + ':gen')
+
+    def stats(self):
+        return {
+            'backend': 'redis',
+            'hits': self.hits,
+            'misses': self.misses,
+            'ttl': self.ttl
+        }
+
+
+def create_cache():
+    """
+    Build the lookup cache from environment variables
+    LOOKUP_CACHE_URL (redis://...) selects the shared backend, otherwise an
+    in-process TTLCache sized by LOOKUP_CACHE_TTL / LOOKUP_CACHE_SIZE is used.
+    An in-process cache is not cleared by the CLI commands that write races
+    (see the module docstring), so its TTL bounds how stale lists can get.
+    """
+    ttl = int(os.getenv('LOOKUP_CACHE_TTL', DEFAULT_TTL))
+    redis_url = os.getenv('LOOKUP_CACHE_URL')
+
+    if redis_url:
+        import redis  # optional dependency, only needed for the shared backend
+        return RedisCache(redis.Redis.from_url(redis_url), ttl=ttl)
+
+    max_entries = int(os.getenv('LOOKUP_CACHE_SIZE', DEFAULT_MAX_ENTRIES))
+    return TTLCache(ttl=ttl, max_entries=max_entries)
+
+
+lookup_cache = create_cache()
+
+
+def cached_lookup(key, loader):
+    """Return lookup_cache[key], calling loader() to fill it on a miss"""
+    value = lookup_cache.get(key)
+    if value is None:
+        value = loader()
+        lookup_cache.set(key, value)
+    return value
+
+
+def invalidate_lookups():
+    lookup_cache.clear()
+
+
+def _touches_races(session):
+    from models import Race
+    return any(isinstance(obj, Race)
+               for obj in list(session.new) + list(session.dirty) + list(session.deleted))
+
+
+@event.listens_for(Session, 'after_flush')
+def _mark_race_changes(session, flush_context):
+    # Only note the change here; clearing before commit would let a
+    # concurrent request re-cache the old values
+    if _touches_races(session):
+        session.info['races_changed'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _clear_on_commit(session):
+    if session.info.pop('races_changed', False):
+        invalidate_lookups()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_on_rollback(session):
+    session.info.pop('races_changed', None)
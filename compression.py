@@ -0,0 +1,202 @@
+"""
+gzip / brotli compression of API responses
+
+Responses are compressed in an after_request hook when the client's
+Accept-Encoding allows it: brotli first (if the brotli module is
+installed), then gzip. Only JSON and text bodies of at least
+COMPRESS_MIN_SIZE bytes are compressed; below that the framing costs more
+than it saves. Responses that already carry a Content-Encoding (the
+precompressed racecard snapshots) are sent as they are.
+
+A compressed response's ETag gets the encoding appended (see
+http_cache.representation_etag). When the response has an ETag its
+compressed body is kept in an LRU keyed by endpoint, ETag and encoding,
+so repeat requests for an unchanged race or runner reuse the bytes
+instead of compressing them again. Streamed bodies are compressed
+incrementally.
+
+  COMPRESSION_ENABLED       0 to send every response uncompressed (default 1)
+  COMPRESS_MIN_SIZE         smallest body compressed, in bytes (default 1024)
+  COMPRESS_GZIP_LEVEL       1-9 (default 6)
+  COMPRESS_BROTLI_QUALITY   0-11 (default 4; quality 9 is 10-25% smaller
+                            for about 7x the CPU, see benchmarks.compression)
+  COMPRESS_CACHE_SIZE       compressed bodies kept per process (default 256)
+"""
+
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+from flask import request
+
+from db_pool import env_flag
+from http_cache import representation_etag
+
+try:
+    import brotli
+except ImportError:  # optional; responses are then gzip only
+    brotli = None
+
+COMPRESSIBLE_TYPES = ('application/json', 'application/x-ndjson', 'text/')
+
+# gzip container from zlib (wbits 16 + 15): no filename or mtime, so the
+# same body always compresses to the same bytes
+GZIP_WBITS = 31
+
+
+def gzip_compress(body, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+
+def compress(body, encoding, level):
+    """body compressed as 'br' or 'gzip' at a brotli quality or gzip level"""
+    if encoding == 'br':
+        return brotli.compress(body, quality=level)
+    return gzip_compress(body, level)
+
+
+def preferred_encoding():
+    """br or gzip when the request accepts it (br first), else None"""
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+
+class CompressedBodies:
+    """LRU of compressed bodies by (endpoint, etag, encoding), with counters"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.responses = 0
+        self.reused = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0.0
+
+    def get(self, key):
+        with self._lock:
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+            return body
+
+    def set(self, key, body):
+        if not self.max_entries:
+            return
+        with self._lock:
+            self._entries[key] = body
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def record(self, size, compressed_size, seconds, reused):
+        with self._lock:
+            self.responses += 1
+            self.reused += reused
+            self.bytes_in += size
+            self.bytes_out += compressed_size
+            self.seconds += seconds
+
+    def stats(self):
+        return {
+            'responses': self.responses,
+            'reused': self.reused,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'ratio': round(self.bytes_out / self.bytes_in, 3) if self.bytes_in else None,
+            'seconds': round(self.seconds, 6),
+            'entries': len(self._entries),
+            'max_entries': self.max_entries,
+        }
+
+
+compressed_bodies = CompressedBodies(int(os.getenv('COMPRESS_CACHE_SIZE', 256)))
+
+
+def _compressible(response):
+    if response.status_code < 200 or response.status_code in (204, 206, 304):
+        return False
+    if 'Content-Encoding' in response.headers or response.direct_passthrough:
+        return False
+    if response.cache_control.no_transform:
+        return False
+    return response.mimetype.startswith(COMPRESSIBLE_TYPES)
+
+
+def _stream(chunks, encoding, level):
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=level)
+        compress_chunk, finish = compressor.process, compressor.finish
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+        compress_chunk, finish = compressor.compress, compressor.flush
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        data = compress_chunk(chunk)
+        if data:
+            yield data
+    yield finish()
+
+
+def _compress_response(response, config):
+    if not _compressible(response):
+        return response
+    if response.is_streamed:
+        encoding = preferred_encoding()
+        response.vary.add('Accept-Encoding')
+        if encoding:
+            level = config['COMPRESS_LEVELS'][encoding]
+            response.response = _stream(response.response, encoding, level)
+            response.headers['Content-Encoding'] = encoding
+            response.headers.pop('Content-Length', None)
+        return response
+
+    body = response.get_data()
+    if len(body) < config['COMPRESS_MIN_SIZE']:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = preferred_encoding()
+    if encoding is None:
+        return response
+
+    started = time.perf_counter()
+    etag, weak = response.get_etag()
+    key = (request.endpoint, etag, encoding) if etag else None
+    compressed = compressed_bodies.get(key) if key else None
+    reused = compressed is not None
+    if not reused:
+        compressed = compress(body, encoding, config['COMPRESS_LEVELS'][encoding])
+        if key:
+            compressed_bodies.set(key, compressed)
+    compressed_bodies.record(len(body), len(compressed), time.perf_counter() - started, reused)
+
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    if etag:
+        response.set_etag(representation_etag(etag, encoding), weak)
+    return response
+
+
+def install_compression(app):
+    """Compress the app's responses unless COMPRESSION_ENABLED=0"""
+    if not env_flag('COMPRESSION_ENABLED', True):
+        return
+    app.config.setdefault('COMPRESS_MIN_SIZE', int(os.getenv('COMPRESS_MIN_SIZE', 1024)))
+    app.config.setdefault('COMPRESS_LEVELS', {
+        'gzip': int(os.getenv('COMPRESS_GZIP_LEVEL', 6)),
+        'br': int(os.getenv('COMPRESS_BROTLI_QUALITY', 4)),
+    })
+    app.after_request(lambda response: _compress_response(response, app.config))
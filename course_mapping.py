@@ -1,8 +1,20 @@
 """
 Course Characteristics Mapping for UK and Irish Racecourses
 Maps each course to its Surface, Configuration, and LH/RH (Handedness)
+
+Course names from feeds vary ("Chelmsford City", "Bangor", "Lingfield AW",
+"KEMPTON (A.W)"), so lookups go through an index of normalised names and
+known aliases built once at import, with a cached fuzzy match as the last
+resort.
+
+This mapping seeds the courses table (`flask seed-courses`), which is what
+the API serves and filters on.
 """
 
+import difflib
+import re
+from functools import lru_cache
+
 COURSE_CHARACTERISTICS = {
     # UK Courses - from Pattern Form official data
     "Aintree": {
@@ -475,18 +487,108 @@ COURSE_CHARACTERISTICS = {
 }
 
 
+# Other names courses are known by (normalised like any input)
+COURSE_ALIASES = {
+    "Bangor": "Bangor-On-Dee",
+    "Market Rasen": "Market Raisen",
+    "Newmarket July": "Newmarket",
+    "Newmarket Rowley": "Newmarket",
+    "Great Yarmouth": "Yarmouth",
+    "Newton Abbott": "Newton Abbot",
+    "Stratford-upon-Avon": "Stratford",
+    "Stratford-on-Avon": "Stratford",
+}
+
+# All-weather markers, folded into a trailing " aw" on the normalised name
+AW_PATTERN = re.compile(r"\(?\b(?:a\.?w\.?|all[ -]?weather|tapeta|polytrack|fibresand)(?!\w)\)?")
+COUNTRY_PATTERN = re.compile(r"\((?:ire|gb|uk)\)")
+IGNORED_WORDS = {"the", "park", "city", "racecourse"}
+
+FUZZY_CUTOFF = 0.85
+RESOLVE_CACHE_SIZE = 4096
+
+
+def normalise_course_name(course_name):
+    """
+    Reduce a course name to its lookup key: case-folded, punctuation and
+    filler words ("Park", "City", "(IRE)") removed, and any all-weather
+    marker (AW, Tapeta, Polytrack, ...) written as a trailing " aw"
+    
+    Args:
+        course_name (str): Course name as received
+        
+    Returns:
+        str: Normalised key, e.g. "lingfield aw" for "Lingfield Park (A.W)"
+    """
+    text = course_name.casefold()
+    all_weather = AW_PATTERN.search(text) is not None
+    text = COUNTRY_PATTERN.sub(" ", AW_PATTERN.sub(" ", text))
+    words = [word for word in re.sub(r"[^a-z0-9]+", " ", text).split() if word not in IGNORED_WORDS]
+    return " ".join(words + ["aw"] if all_weather else words)
+
+
+def _build_course_index():
+    index = {}
+    for course_name in COURSE_CHARACTERISTICS:
+        index.setdefault(normalise_course_name(course_name), course_name)
+    for alias, course_name in COURSE_ALIASES.items():
+        index.setdefault(normalise_course_name(alias), course_name)
+    return index
+
+
+# Normalised name or alias -> course name in COURSE_CHARACTERISTICS
+COURSE_INDEX = _build_course_index()
+
+
+@lru_cache(maxsize=RESOLVE_CACHE_SIZE)
+def _resolve_course(course_name):
+    key = normalise_course_name(course_name)
+    if key in COURSE_INDEX:
+        return COURSE_INDEX[key]
+
+    # A course with only a turf or only an all-weather entry matches either way
+    toggled = key[:-3] if key.endswith(" aw") else key + " aw"
+    if toggled in COURSE_INDEX:
+        return COURSE_INDEX[toggled]
+
+    matches = difflib.get_close_matches(key, COURSE_INDEX, n=1, cutoff=FUZZY_CUTOFF)
+    return COURSE_INDEX[matches[0]] if matches else None
+
+
+def resolve_course(course_name):
+    """
+    Find the mapped course a name refers to
+    
+    Exact names are a dict lookup. Anything else is normalised and looked
+    up in COURSE_INDEX, then fuzzy matched; those results are kept in a
+    bounded LRU cache.
+    
+    Args:
+        course_name (str): Course name as received
+        
+    Returns:
+        str: Key of COURSE_CHARACTERISTICS, or None if no course matches
+    """
+    if not course_name:
+        return None
+    if course_name in COURSE_CHARACTERISTICS:
+        return course_name
+    return _resolve_course(course_name)
+
+
 def get_course_characteristics(course_name):
     """
     Get characteristics for a given course
     
     Args:
-        course_name (str): Name of the racecourse
+        course_name (str): Name of the racecourse, matched as by resolve_course
         
     Returns:
         dict: Dictionary with surface, configuration, and lh_rh keys
         Returns None if course not found
     """
-    return COURSE_CHARACTERISTICS.get(course_name)
+    resolved = resolve_course(course_name)
+    return COURSE_CHARACTERISTICS[resolved] if resolved else None
 
 
 def add_characteristics_to_race(race_dict):
@@ -0,0 +1,55 @@
+"""
+Loading course_mapping into the courses table
+
+Every course in COURSE_CHARACTERISTICS is upserted by name, and a row is
+only rewritten when its characteristics changed. A rewrite moves
+courses.updated_at, which is the version stamp of the in-process course
+cache (models.course_codes), so running workers pick the change up within
+lookups.VERSION_CHECK_SECONDS. Courses first seen by ingest are added
+there and left alone here.
+
+Usage: flask --app app seed-courses
+"""
+
+import click
+from flask.cli import with_appcontext
+
+from cache import invalidate_lookups
+from course_mapping import COURSE_CHARACTERISTICS
+from models import db, Course, Race, COURSE_CHARACTERISTIC_KEYS
+from refresh import upsert
+
+
+def courses_with_races():
+    """Courses that have at least one race, by name"""
+    return (db.session.query(Course)
+            .filter(db.session.query(Race.id).filter(Race.course_id == Course.id).exists())
+            .order_by(Course.name))
+
+
+def load_courses():
+    """
+    Upsert every mapped course within the current transaction
+
+    Returns:
+        int: Number of courses inserted or changed
+    """
+    rows = [dict({key: characteristics.get(key) for key in COURSE_CHARACTERISTIC_KEYS}, name=name)
+            for name, characteristics in sorted(COURSE_CHARACTERISTICS.items())]
+    return upsert(Course, rows, ('name',))
+
+
+def seed_courses():
+    """Load every mapped course, commit and drop the cached course lists"""
+    changed = load_courses()
+    db.session.commit()
+    invalidate_lookups()
+    return changed
+
+
+@click.command('seed-courses')
+@with_appcontext
+def seed_courses_command():
+    """Load the course characteristics from course_mapping into the courses table"""
+    changed = seed_courses()
+    click.echo('%d courses, %d inserted or changed' % (len(COURSE_CHARACTERISTICS), changed))
@@ -0,0 +1,142 @@
+"""
+Database engine and connection pool settings
+
+Read from environment variables so each deployment can size the pool to
+its worker count and the server's max_connections:
+
+  DB_POOL_SIZE              connections kept open per process (default 5)
+  DB_MAX_OVERFLOW           extra connections opened under bursts (default 5)
+  DB_POOL_TIMEOUT           seconds to wait for a free connection (default 10)
+  DB_POOL_RECYCLE           seconds before a connection is replaced (default 1800)
+  DB_POOL_PRE_PING          test connections on checkout, 0 to disable (default 1)
+  DB_STATEMENT_TIMEOUT      Postgres statement_timeout in ms (default unset)
+  DB_PGBOUNCER              1 when connecting through PgBouncer in
+                            transaction pooling mode (default 0)
+
+Each gunicorn worker has its own pool, so a host can open up to
+WEB_CONCURRENCY x (DB_POOL_SIZE + DB_MAX_OVERFLOW) connections.
+
+PgBouncer mode sends no startup parameters, applying the statement
+timeout with SET LOCAL at the start of each transaction instead, and
+turns off server-side prepared statements for drivers that use them
+(psycopg 3). psycopg2 never prepares statements.
+
+Pools are MeteredQueuePools, which count checkouts and the time spent
+getting a connection; pool_stats() reports them with the pool's gauges.
+"""
+
+import os
+import threading
+import time
+
+from sqlalchemy import event, exc
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+
+# Checkouts slower than this count as having waited for a connection
+SLOW_CHECKOUT_SECONDS = 0.01
+
+
+def env_flag(name, default):
+    return os.getenv(name, '1' if default else '0').strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+class MeteredQueuePool(QueuePool):
+    """QueuePool counting checkouts, the time they took and timeouts"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._metrics_lock = threading.Lock()
+        self.checkouts = 0
+        self.slow_checkouts = 0
+        self.timeouts = 0
+        self.checkout_seconds = 0.0
+        self.max_checkout_seconds = 0.0
+
+    def _do_get(self):
+        started = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            seconds = time.perf_counter() - started
+            with self._metrics_lock:
+                self.checkouts += 1
+                self.timeouts += timed_out
+                self.slow_checkouts += seconds >= SLOW_CHECKOUT_SECONDS
+                self.checkout_seconds += seconds
+                self.max_checkout_seconds = max(self.max_checkout_seconds, seconds)
+
+    def stats(self):
+        return {
+            'pool_size': self.size(),
+            'checked_out': self.checkedout(),
+            'checked_in': self.checkedin(),
+            'overflow': self.overflow(),
+            'checkouts': self.checkouts,
+            'slow_checkouts': self.slow_checkouts,
+            'timeouts': self.timeouts,
+            'checkout_seconds': round(self.checkout_seconds, 6),
+            'max_checkout_seconds': round(self.max_checkout_seconds, 6),
+        }
+
+
+def engine_options(database_url):
+    """
+    SQLALCHEMY_ENGINE_OPTIONS for a database URL from the DB_* variables
+
+    Pool sizing only applies where SQLAlchemy would pool connections in a
+    QueuePool (not in-memory SQLite).
+    """
+    if not database_url:
+        return {}
+    url = make_url(database_url)
+    options = {
+        'pool_pre_ping': env_flag('DB_POOL_PRE_PING', True),
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', 1800)),
+    }
+    if url.get_dialect().get_pool_class(url) is QueuePool:
+        options.update(
+            poolclass=MeteredQueuePool,
+            pool_size=int(os.getenv('DB_POOL_SIZE', 5)),
+            max_overflow=int(os.getenv('DB_MAX_OVERFLOW', 5)),
+            pool_timeout=float(os.getenv('DB_POOL_TIMEOUT', 10)),
+        )
+
+    if url.get_backend_name() == 'postgresql':
+        connect_args = {}
+        timeout = os.getenv('DB_STATEMENT_TIMEOUT')
+        if env_flag('DB_PGBOUNCER', False):
+            if url.get_driver_name() == 'psycopg':
+                connect_args['prepare_threshold'] = None
+        elif timeout:
+            connect_args['options'] = '-c statement_timeout=%d' % int(timeout)
+        if connect_args:
+            options['connect_args'] = connect_args
+    return options
+
+
+def configure_engine(engine):
+    """Per-transaction settings that cannot be passed when connecting"""
+    timeout = os.getenv('DB_STATEMENT_TIMEOUT')
+    if engine.dialect.name != 'postgresql' or not timeout or not env_flag('DB_PGBOUNCER', False):
+        return
+    statement = 'SET LOCAL statement_timeout = %d' % int(timeout)
+
+    @event.listens_for(engine, 'begin')
+    def _statement_timeout(connection):
+        # PgBouncer hands out a server connection per transaction, so a
+        # session-level SET would leak to (or be lost for) other clients
+        connection.exec_driver_sql(statement)
+
+
+def pool_stats(engine):
+    """Gauges and counters of an engine's pool, for this process"""
+    pool = engine.pool
+    stats = pool.stats() if isinstance(pool, MeteredQueuePool) else {'status': pool.status()}
+    stats['pool'] = type(pool).__name__
+    stats['pid'] = os.getpid()
+    return stats
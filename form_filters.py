@@ -0,0 +1,242 @@
+"""
+Form line filter engine
+Turns request query params into SQL criteria on FormLine so every filter
+combination compiles to a single statement
+"""
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import case, func, select
+
+from course_mapping import resolve_course
+from models import db, Race, Runner, FormLine, Course, LookupValue
+from race_conditions import parse_distance, parse_going
+
+# Query param -> FormLine column for multi-value (IN) filters. Each param
+# may be repeated (?going=Soft&going=Heavy) or comma separated.
+IN_FILTERS = {
+    'going': FormLine.going,
+    'distance': FormLine.distance,
+    'class': FormLine.race_class,
+    'race_type': FormLine.race_type,
+    'course': FormLine.course,
+}
+
+# Query param -> Course column for characteristic filters, which match races
+# and form lines run at any course with one of the given values
+COURSE_FILTERS = {
+    'surface': Course.surface,
+    'configuration': Course.configuration,
+    'lh_rh': Course.lh_rh,
+}
+
+# Query param prefix -> FormLine column for inclusive integer ranges
+# (min_position / max_position, min_or / max_or)
+RANGE_FILTERS = {
+    'position': FormLine.finishing_position,
+    'or': FormLine.official_rating,
+}
+
+
+# (low param, high param) -> (lookup kind, parser) for ranges over the
+# numeric measure of a distance or going. FormLine filters go through the
+# measure on lookup_values; Race has the measures as columns.
+MEASURE_FILTERS = {
+    ('min_distance', 'max_distance'): ('distance', parse_distance),
+    ('going_min', 'going_max'): ('going', parse_going),
+}
+RACE_MEASURES = {
+    'distance': Race.distance_yards,
+    'going': Race.going_rank,
+}
+
+
+def get_multi(args, name):
+    """Collect every value for a param, splitting comma separated lists"""
+    values = []
+    for raw in args.getlist(name):
+        values.extend(value.strip() for value in raw.split(','))
+    return [value for value in values if value]
+
+
+def parse_date_arg(args, name):
+    value = args.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise ValueError('Invalid %s format. Use YYYY-MM-DD' % name)
+
+
+def parse_int_arg(args, name):
+    value = args.get(name)
+    if value is None or value == '':
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError('%s must be an integer' % name)
+
+
+def parse_measure_arg(args, name, parse):
+    value = args.get(name)
+    if not value:
+        return None
+    measure = parse(value)
+    if measure is None:
+        raise ValueError('Invalid %s %r' % (name, value))
+    return measure
+
+
+def measure_ranges(args):
+    """
+    Read the distance and going range params present in args
+
+    Distances are given as on a race card (2m4f, 1m2f110y, 7f) and goings
+    by description (Good to Soft, Soft), both bounds inclusive.
+
+    Returns:
+        list: (lookup kind, low or None, high or None) per range given
+
+    Raises:
+        ValueError: If a distance or going is not recognised
+    """
+    ranges = []
+    for (low_name, high_name), (kind, parse) in MEASURE_FILTERS.items():
+        low = parse_measure_arg(args, low_name, parse)
+        high = parse_measure_arg(args, high_name, parse)
+        if low is not None or high is not None:
+            ranges.append((kind, low, high))
+    return ranges
+
+
+def range_criteria(column, low, high):
+    criteria = []
+    if low is not None:
+        criteria.append(column >= low)
+    if high is not None:
+        criteria.append(column <= high)
+    return criteria
+
+
+def course_id_filters(args):
+    """Subqueries of the courses matching each characteristic param in args"""
+    subqueries = []
+    for name, column in COURSE_FILTERS.items():
+        values = get_multi(args, name)
+        if values:
+            subqueries.append(select(Course.id).where(column.in_(values)))
+    return subqueries
+
+
+def build_race_criteria(args):
+    """
+    SQL criteria on Race for the distance and going range params and the
+    surface, configuration and lh_rh params (multi-value)
+    """
+    criteria = []
+    for kind, low, high in measure_ranges(args):
+        criteria.extend(range_criteria(RACE_MEASURES[kind], low, high))
+    for courses in course_id_filters(args):
+        criteria.append(Race.course_id.in_(courses))
+    return criteria
+
+
+def build_form_criteria(args):
+    """
+    Build SQL criteria for the form filters present in args
+
+    Supported params: going, distance, class, race_type, course, surface,
+    configuration, lh_rh (multi-value), min_position, max_position,
+    min_or, max_or, min_distance, max_distance, going_min, going_max,
+    date_from, date_to (inclusive ranges)
+
+    Returns:
+        list: SQLAlchemy criteria to AND together
+
+    Raises:
+        ValueError: If a range or date value is malformed
+    """
+    criteria = []
+
+    for name, column in IN_FILTERS.items():
+        values = get_multi(args, name)
+        if name == 'course':
+            # Stored under the mapped name (see ingest.clean_form_line)
+            values = [resolve_course(value) or value for value in values]
+        if len(values) == 1:
+            criteria.append(column == values[0])
+        elif values:
+            criteria.append(column.in_(values))
+
+    for courses in course_id_filters(args):
+        criteria.append(FormLine.course.in_(courses))
+
+    for name, column in RANGE_FILTERS.items():
+        low = parse_int_arg(args, 'min_' + name)
+        high = parse_int_arg(args, 'max_' + name)
+        criteria.extend(range_criteria(column, low, high))
+
+    for kind, low, high in measure_ranges(args):
+        values = select(LookupValue.id).where(
+            LookupValue.kind == kind, *range_criteria(LookupValue.measure, low, high))
+        criteria.append(getattr(FormLine, kind).in_(values))
+
+    date_from = parse_date_arg(args, 'date_from')
+    date_to = parse_date_arg(args, 'date_to')
+    if date_from:
+        criteria.append(FormLine.race_date >= date_from)
+    if date_to:
+        criteria.append(FormLine.race_date <= date_to)
+
+    return criteria
+
+
+def build_screen_query(race_date, criteria, within_days=None, min_matches=1, min_wins=0):
+    """
+    Build the grouped query behind /api/screen: every runner declared on
+    race_date joined to its horse's earlier form lines that match criteria,
+    aggregated per runner in one statement
+
+    Args:
+        race_date (date): Day whose runners are screened
+        criteria (list): Form line criteria from build_form_criteria
+        within_days (int): Only count form from the last N days before race_date
+        min_matches (int): Minimum matching form lines per runner
+        min_wins (int): Minimum wins among the matching form lines
+
+    Returns:
+        Query: Rows of (Runner, race_id, course, race_time, race_name,
+        matches, wins, places, last_match, best_rpr, best_or)
+    """
+    wins = func.sum(case((FormLine.finishing_position == 1, 1), else_=0))
+    places = func.sum(case((FormLine.finishing_position <= 3, 1), else_=0))
+    matches = func.count(FormLine.id)
+
+    query = (db.session.query(
+                 Runner,
+                 Race.id.label('race_id'),
+                 Race.course,
+                 Race.race_time,
+                 Race.race_name,
+                 matches.label('matches'),
+                 wins.label('wins'),
+                 places.label('places'),
+                 func.max(FormLine.race_date).label('last_match'),
+                 func.max(FormLine.rpr).label('best_rpr'),
+                 func.max(FormLine.official_rating).label('best_or'))
+             .join(Race, Race.id == Runner.race_id)
+             .join(FormLine, FormLine.horse_id == Runner.horse_id)
+             .filter(Race.date == race_date, FormLine.race_date < race_date, *criteria))
+
+    if within_days is not None:
+        query = query.filter(FormLine.race_date >= race_date - timedelta(days=within_days))
+
+    query = query.group_by(Runner.id, Race.id)
+    if min_matches > 1:
+        query = query.having(matches >= min_matches)
+    if min_wins > 0:
+        query = query.having(wins >= min_wins)
+
+    return query.order_by(Race.race_time, Race.id, Runner.id)
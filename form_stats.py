@@ -0,0 +1,168 @@
+"""
+Per-horse form aggregates (runner_form_stats)
+
+Each row holds runs, wins, places and rating summaries for one horse and
+one value of one dimension (going, distance, race_class, race_type,
+surface, configuration, lh_rh, plus an overall 'all' row). Distances are
+counted by band rather than by their exact string, so "2m4f", "2m4f 10y"
+and "2m 4½f" are one row (see DISTANCE_BANDS). Ingest adds
+newly inserted form lines to the aggregates as they are loaded, so
+profiling a horse is a primary key lookup rather than a scan of its form.
+"""
+
+from functools import lru_cache
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import case
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import db, FormLine, Course, RunnerFormStat, COURSE_CHARACTERISTIC_KEYS
+from race_conditions import parse_distance
+
+STAT_DIMENSIONS = ['going', 'distance', 'race_class', 'race_type',
+                   'surface', 'configuration', 'lh_rh']
+ALL = 'all'
+
+COUNTERS = ['runs', 'wins', 'places', 'rpr_total', 'rpr_runs']
+BESTS = ['best_rpr', 'best_or']
+
+REBUILD_CHUNK_SIZE = 5000
+
+# (longest distance in yards, band), shortest first. Each band runs to
+# half a furlong past its last label; anything longer is LONGEST_BAND.
+DISTANCE_BANDS = [
+    (1430, '5f-6f'),
+    (1870, '7f-1m'),
+    (2970, '1m1f-1m3f'),
+    (3850, '1m4f-1m7f'),
+    (4290, '2m-2m3f'),
+    (5170, '2m4f-2m7f'),
+    (6050, '3m-3m3f'),
+]
+LONGEST_BAND = '3m4f+'
+BAND_ORDER = {band: i for i, band in enumerate([band for _, band in DISTANCE_BANDS] + [LONGEST_BAND])}
+
+
+@lru_cache(maxsize=1024)
+def distance_band(distance):
+    """Band of a distance string, or None if it does not parse"""
+    yards = parse_distance(distance)
+    if yards is None:
+        return None
+    for longest, band in DISTANCE_BANDS:
+        if yards <= longest:
+            return band
+    return LONGEST_BAND
+
+
+def accumulate(entries, stats=None):
+    """
+    Fold form line dicts (with horse_id) into aggregate deltas
+
+    Returns:
+        dict: (horse_id, dimension, value) -> stat columns
+    """
+    stats = {} if stats is None else stats
+    for row in entries:
+        horse_id = row['horse_id']
+        position = row.get('finishing_position')
+        rpr = row.get('rpr')
+        official_rating = row.get('official_rating')
+
+        for dimension in [ALL] + STAT_DIMENSIONS:
+            if dimension == ALL:
+                value = ''
+            elif dimension == 'distance':
+                value = distance_band(row.get('distance'))
+            else:
+                value = row.get(dimension)
+            if value is None:
+                continue
+            stat = stats.get((horse_id, dimension, value))
+            if stat is None:
+                stat = stats[(horse_id, dimension, value)] = dict(
+                    {counter: 0 for counter in COUNTERS}, best_rpr=None, best_or=None)
+            stat['runs'] += 1
+            if position == 1:
+                stat['wins'] += 1
+            if position is not None and position <= 3:
+                stat['places'] += 1
+            if rpr is not None:
+                stat['rpr_total'] += rpr
+                stat['rpr_runs'] += 1
+                stat['best_rpr'] = rpr if stat['best_rpr'] is None else max(stat['best_rpr'], rpr)
+            if official_rating is not None:
+                stat['best_or'] = (official_rating if stat['best_or'] is None
+                                   else max(stat['best_or'], official_rating))
+    return stats
+
+
+def _greater(current, incoming):
+    # GREATEST() that ignores NULLs on both Postgres and SQLite
+    return case((incoming.is_(None), current), (current.is_(None), incoming),
+                (incoming > current, incoming), else_=current)
+
+
+def apply_stats(stats):
+    """Add aggregate deltas to runner_form_stats in one upsert statement"""
+    if not stats:
+        return
+
+    dialect = db.session.get_bind().dialect.name
+    insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+    table = RunnerFormStat.__table__
+
+    stmt = insert(table)
+    set_ = {counter: table.c[counter] + stmt.excluded[counter] for counter in COUNTERS}
+    set_.update({best: _greater(table.c[best], stmt.excluded[best]) for best in BESTS})
+    stmt = stmt.on_conflict_do_update(index_elements=['horse_id', 'dimension', 'value'], set_=set_)
+
+    db.session.execute(stmt, [dict(stat, horse_id=horse_id, dimension=dimension, value=value)
+                              for (horse_id, dimension, value), stat in stats.items()])
+
+
+def record_form_lines(rows):
+    """
+    Count form lines into the aggregates. Pass only rows that were actually
+    inserted, so a line already on file is never counted twice.
+    """
+    apply_stats(accumulate(rows))
+
+
+def rebuild_form_stats():
+    """
+    Recompute runner_form_stats from scratch, streaming form lines horse by
+    horse so memory holds only one chunk of aggregates at a time
+
+    Returns:
+        int: Number of horses aggregated
+    """
+    RunnerFormStat.query.delete()
+
+    columns = [FormLine.finishing_position, FormLine.rpr, FormLine.official_rating]
+    columns += [getattr(Course if dimension in COURSE_CHARACTERISTIC_KEYS else FormLine, dimension)
+                for dimension in STAT_DIMENSIONS]
+    query = (db.session.query(FormLine.horse_id, *columns)
+             .outerjoin(Course, Course.id == FormLine.course)
+             .order_by(FormLine.horse_id))
+
+    stats, horses, current = {}, 0, None
+    for row in query.yield_per(REBUILD_CHUNK_SIZE):
+        if row.horse_id != current:
+            current, horses = row.horse_id, horses + 1
+            if len(stats) >= REBUILD_CHUNK_SIZE:
+                apply_stats(stats)
+                stats = {}
+        accumulate([row._asdict()], stats)
+
+    apply_stats(stats)
+    db.session.commit()
+    return horses
+
+
+@click.command('rebuild-form-stats')
+@with_appcontext
+def rebuild_form_stats_command():
+    """Recompute runner_form_stats from all form lines"""
+    click.echo('Aggregated form for %d horses' % rebuild_form_stats())
@@ -0,0 +1,61 @@
+"""
+Production serving profile: gunicorn with threaded workers
+
+Every setting can be overridden from the environment, so one file serves
+both a small dyno and a large host:
+
+  WEB_CONCURRENCY           worker processes (default 2 x CPUs + 1)
+  GUNICORN_THREADS          threads per worker (default 4)
+  GUNICORN_MAX_REQUESTS     requests before a worker is recycled (default 1000)
+  GUNICORN_KEEPALIVE        seconds an idle keep-alive connection is held (default 75)
+  GUNICORN_TIMEOUT          seconds before a silent worker is killed (default 30)
+  GUNICORN_ACCESS_LOG       access log path, '-' for stdout (default), empty for none
+  PORT                      listen port (default 5000)
+
+The app is imported once in the master (preload_app) so the models, the
+course mapping and its lookup indexes are shared copy-on-write between
+workers. Requests are mostly waiting on the database, so each worker runs
+a few threads rather than more processes.
+
+Usage: gunicorn -c gunicorn.conf.py app:app
+"""
+
+import gc
+import multiprocessing
+import os
+
+bind = '0.0.0.0:%s' % os.getenv('PORT', '5000')
+
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.getenv('GUNICORN_THREADS', 4))
+worker_class = 'gthread' if threads > 1 else 'sync'
+
+preload_app = True
+
+# Recycle workers gradually, with jitter so they do not all restart at once
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = max_requests // 10
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 30))
+graceful_timeout = timeout
+
+# Clients poll racecards every few seconds; holding the connection open
+# saves a TCP (and TLS) handshake per poll. Kept above the usual 60s idle
+# timeout of load balancers so they close first.
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', 75))
+
+accesslog = os.getenv('GUNICORN_ACCESS_LOG', '-') or None
+
+
+def when_ready(server):
+    # Keep the preloaded objects out of the collector's reach so its passes
+    # in the workers do not write to (and so copy) the shared pages
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    # Connections opened in the master while preloading must not be shared
+    # across processes; drop them without closing the master's sockets
+    from app import app
+    from models import db
+    with app.app_context():
+        db.engine.dispose(close=False)
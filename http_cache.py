@@ -0,0 +1,71 @@
+"""
+HTTP conditional request helpers (ETag / Last-Modified / 304 Not Modified)
+Routes compute a cheap version for the data behind a response and call
+not_modified() before loading the full payload
+"""
+
+import hashlib
+import json
+from datetime import timezone
+
+from flask import current_app, request
+
+# Content codings compression.py may append to an ETag
+ENCODINGS = ('gzip', 'br')
+
+
+def make_etag(*parts):
+    """Build a strong ETag value from the version parts of a response"""
+    raw = json.dumps(parts, default=str, separators=(',', ':'))
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def representation_etag(etag, encoding):
+    """ETag of a content-coded body; each encoding is different bytes"""
+    return '%s-%s' % (etag, encoding) if encoding else etag
+
+
+def _matching_etag(etag):
+    """The ETag in If-None-Match for any encoding of etag, or None"""
+    for candidate in [etag] + [representation_etag(etag, encoding) for encoding in ENCODINGS]:
+        if request.if_none_match.contains(candidate):
+            return candidate
+    return None
+
+
+def _as_utc(value):
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+
+def not_modified(etag, last_modified=None):
+    """
+    Check the request's validators against the current version
+
+    Returns:
+        Response: An empty 304 response if the client copy is current,
+        otherwise None
+    """
+    if request.if_none_match:
+        # If-None-Match takes precedence over If-Modified-Since (RFC 9110).
+        # A compressed copy's tag is answered with that tag.
+        etag = _matching_etag(etag)
+        if etag is None:
+            return None
+    elif last_modified is None or request.if_modified_since is None:
+        return None
+    elif _as_utc(last_modified).replace(microsecond=0) > request.if_modified_since:
+        return None
+
+    response = current_app.response_class(status=304)
+    return with_validators(response, etag, last_modified)
+
+
+def with_validators(response, etag, last_modified=None):
+    """Attach ETag / Last-Modified and require revalidation on each use"""
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = _as_utc(last_modified)
+    response.cache_control.no_cache = True
+    return response
@@ -0,0 +1,434 @@
+"""
+Bulk ingestion of race cards and form lines
+
+Two input shapes are supported:
+  - JSONL race cards: one race per line with nested "runners", each runner
+    optionally carrying nested "form_lines"
+  - CSV form lines: one form line per row, with a horse_name column (used
+    for loading whole seasons of history)
+
+Races already on file (same date, course and race_time) are logged and
+skipped; `flask refresh` updates them. Horses are created on first
+sight. Form lines belong to the horse and are stored once; a line the
+horse already has (same race_date and course) is skipped. On Postgres
+they are COPYed into a staging table and merged with INSERT ... ON
+CONFLICT DO NOTHING; other databases use batched executemany inserts.
+Newly stored lines are added to the per-horse aggregates in
+runner_form_stats. Every batch of records is its own transaction, and
+drops the racecard snapshots it changes (see racecards.py).
+
+A horse is identified by its name exactly as the feed spells it, country
+suffix included. Only race cards carry an age, and CSV form has nothing
+but the name, so there is no foaling year to match on everywhere. Two
+horses sharing an unsuffixed name therefore share one record, and with
+it one form history and one set of aggregates; "Frankel" and
+"Frankel (GB)" are two horses. Feeds that suffix every name avoid both.
+
+New going, distance, class, race type and race code strings and new
+courses get lookup codes before the lines and races using them are
+stored. Race and form line courses are both named by course_mapping's
+resolve_course, so feed spellings of one course share its row. A new
+course takes its characteristics from course_mapping, or from the first
+line naming it; `flask seed-courses` loads every mapped course up front.
+
+Usage: flask --app app ingest cards.jsonl [--batch-size 1000]
+       flask --app app ingest form.csv
+"""
+
+import csv
+import io
+import json
+import time
+from datetime import datetime
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import insert, text, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+
+from cache import invalidate_lookups
+from course_mapping import get_course_characteristics, resolve_course
+from form_stats import record_form_lines
+from lookups import coded_columns
+from models import (db, Race, Horse, Runner, FormLine, COURSE_CHARACTERISTIC_KEYS,
+                    course_characteristics, course_codes)
+from race_conditions import add_measures
+from racecards import invalidate_form_snapshots, invalidate_snapshots
+
+DEFAULT_BATCH_SIZE = 1000
+
+RACE_FIELDS = ['date', 'course', 'race_time', 'race_name', 'distance', 'race_class',
+               'going', 'prize', 'age_restriction']
+RUNNER_FIELDS = ['horse_name', 'age', 'weight', 'draw', 'jockey', 'trainer',
+                 'official_rating', 'rpr', 'ts', 'odds', 'form', 'non_runner']
+FORM_FIELDS = ['horse_id', 'race_date', 'course', 'distance', 'going', 'race_class',
+               'race_type', 'race_code', 'finishing_position', 'beaten_distance',
+               'weight_carried', 'official_rating', 'rpr', 'jockey', 'odds', 'comment']
+
+# Natural keys of races and runners (unique in the schema)
+RACE_KEY = ('date', 'course', 'race_time')
+RUNNER_KEY = ('race_id', 'horse_name')
+
+INT_FIELDS = {'age', 'draw', 'official_rating', 'rpr', 'ts', 'horse_id', 'finishing_position'}
+FORM_KEY = ['horse_id', 'race_date', 'course']
+DATE_FIELDS = {'date', 'race_date'}
+BOOL_FIELDS = {'non_runner'}
+
+
+class IngestError(ValueError):
+    """A record failed validation"""
+
+
+def clean_record(record, fields, required=(), present_only=False):
+    """
+    Keep only known fields and coerce ints and dates
+    With present_only, fields absent from the record are left out rather
+    than set to None (used by partial refreshes)
+
+    Raises:
+        IngestError: If a required field is missing or a value is malformed
+    """
+    row = {}
+    for field in fields:
+        if present_only and field not in record and field not in required:
+            continue
+        value = record.get(field)
+        if isinstance(value, str):
+            value = value.strip()
+        if value in ('', None):
+            value = False if field in BOOL_FIELDS else None
+        elif field in INT_FIELDS:
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                raise IngestError('%s must be an integer, got %r' % (field, value))
+        elif field in BOOL_FIELDS:
+            if isinstance(value, str):
+                value = value.lower() in ('1', 'true', 'yes', 'y')
+            value = bool(value)
+        elif field in DATE_FIELDS:
+            try:
+                value = datetime.strptime(value, '%Y-%m-%d').date()
+            except (TypeError, ValueError):
+                raise IngestError('%s must be YYYY-MM-DD, got %r' % (field, value))
+        row[field] = value
+
+    for field in required:
+        if row.get(field) is None:
+            raise IngestError('missing required field %s' % field)
+    return row
+
+
+def clean_form_line(record):
+    """
+    Validate a form line, naming its course as resolve_race_courses does
+    and filling the course characteristics from it
+    """
+    row = clean_record(record, FORM_FIELDS + COURSE_CHARACTERISTIC_KEYS, required=('race_date',))
+    if row['course']:
+        row['course'] = resolve_course(row['course']) or row['course']
+    characteristics = get_course_characteristics(row['course']) if row['course'] else None
+    if characteristics:
+        for key, value in characteristics.items():
+            if row.get(key) is None:
+                row[key] = value
+    return row
+
+
+def read_jsonl(path):
+    """Yield (line number, record) for each non-blank line"""
+    with open(path, encoding='utf-8') as f:
+        for line_no, line in enumerate(f, 1):
+            if line.strip():
+                try:
+                    yield line_no, json.loads(line)
+                except ValueError as e:
+                    yield line_no, IngestError('invalid JSON: %s' % e)
+
+
+def read_csv(path):
+    with open(path, newline='', encoding='utf-8') as f:
+        for line_no, record in enumerate(csv.DictReader(f), 2):
+            yield line_no, record
+
+
+def batched(records, size):
+    batch = []
+    for item in records:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def upsert_insert():
+    dialect = db.session.get_bind().dialect.name
+    return postgresql.insert if dialect == 'postgresql' else sqlite.insert
+
+
+def resolve_horses(names):
+    """
+    Get or create a horse for each name (names are the horse's identity,
+    see the module docstring)
+
+    Returns:
+        dict: name -> horse id
+    """
+    names = set(names)
+    if not names:
+        return {}
+    db.session.execute(upsert_insert()(Horse.__table__).on_conflict_do_nothing(index_elements=['name']),
+                       [{'name': name} for name in names])
+    return dict(db.session.query(Horse.name, Horse.id).filter(Horse.name.in_(names)))
+
+
+def resolve_codes(rows):
+    """Make sure every coded value in the form line rows has a lookup code"""
+    for column, dictionary in coded_columns(FormLine.__table__):
+        sources = {}
+        for row in rows:
+            if row.get(column.key) is not None:
+                sources.setdefault(row[column.key], row)
+        dictionary.resolve(db.session, sources)
+
+
+def resolve_race_courses(rows):
+    """
+    Set course_id on each race row to the course its name refers to
+
+    Feed spellings of a mapped course ("Chelmsford", "Chelmsford City (AW)")
+    resolve to the mapped course's row; courses rows are only created for
+    names course_mapping does not know.
+    """
+    canonical = {row['course']: resolve_course(row['course']) or row['course'] for row in rows}
+    course_codes.resolve(db.session, {name: get_course_characteristics(name) or {}
+                                      for name in set(canonical.values())})
+    for row in rows:
+        row['course_id'] = course_codes.code(canonical[row['course']])
+
+
+def copy_form_lines(rows):
+    """
+    Store validated form lines, skipping any the horse already has
+
+    Returns:
+        list: The rows that were actually inserted
+    """
+    if not rows:
+        return []
+
+    # Keep the first of any lines repeated within the batch
+    unique = {}
+    for row in rows:
+        unique.setdefault(tuple(row[field] for field in FORM_KEY), row)
+    rows = list(unique.values())
+
+    table = FormLine.__table__
+    key_columns = [table.c[field] for field in FORM_KEY]
+    connection = db.session.connection()
+    if connection.dialect.name != 'postgresql':
+        stmt = (upsert_insert()(table)
+                .on_conflict_do_nothing(index_elements=key_columns)
+                .returning(*key_columns))
+        stored = [{field: row[field] for field in FORM_FIELDS} for row in rows]
+        inserted = {tuple(key) for key in connection.execute(stmt, stored)}
+        return [row for key, row in unique.items() if key in inserted]
+
+    # COPY cannot skip conflicts itself, so load a staging table and merge.
+    # COPY bypasses the column types, so coded values are written as codes.
+    columns = ', '.join(table.c[field].name for field in FORM_FIELDS)
+    connection.execute(text('CREATE TEMP TABLE IF NOT EXISTS form_lines_load ON COMMIT DELETE ROWS '
+                            'AS SELECT %s FROM form_lines WITH NO DATA' % columns))
+
+    codes = {column.key: dictionary for column, dictionary in coded_columns(table)}
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        values = [codes[field].code(row[field]) if field in codes else row[field]
+                  for field in FORM_FIELDS]
+        # Unquoted empty fields are read back by COPY ... CSV as NULL
+        writer.writerow(['' if value is None else value for value in values])
+    buffer.seek(0)
+
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert('COPY form_lines_load (%s) FROM STDIN WITH (FORMAT csv)' % columns, buffer)
+    finally:
+        cursor.close()
+
+    key_names = ', '.join(column.name for column in key_columns)
+    inserted = connection.execute(text(
+        'INSERT INTO form_lines (%s) SELECT %s FROM form_lines_load '
+        'ON CONFLICT (%s) DO NOTHING RETURNING %s'
+        % (columns, columns, key_names, key_names)).columns(*key_columns))
+    inserted = {tuple(key) for key in inserted}
+    connection.execute(text('TRUNCATE form_lines_load'))
+    return [row for key, row in unique.items() if key in inserted]
+
+
+def store_form_lines(rows, stats):
+    """Insert new form lines, fold them into the aggregates and count them"""
+    resolve_codes(rows)
+    for row in rows:
+        # Aggregate on the characteristics the course is stored with
+        row.update(course_characteristics(row['course']) if row['course'] else {})
+    inserted = copy_form_lines(rows)
+    record_form_lines(inserted)
+    invalidate_form_snapshots(db.session, {row['race_date'] for row in inserted})
+    stats['form_lines'] += len(inserted)
+    stats['duplicates'] += len(rows) - len(inserted)
+
+
+def insert_returning_ids(model, rows):
+    """Insert rows in one batched statement and return their new ids in order"""
+    if not rows:
+        return []
+    result = db.session.execute(
+        insert(model).returning(model.id, sort_by_parameter_order=True), rows)
+    return [row.id for row in result]
+
+
+def existing_race_keys(rows):
+    """Natural keys of the race rows that are already stored"""
+    keys = {tuple(row[column] for column in RACE_KEY) for row in rows}
+    if not keys:
+        return set()
+    return set(db.session.query(Race.date, Race.course, Race.race_time)
+               .filter(tuple_(Race.date, Race.course, Race.race_time).in_(keys)))
+
+
+def load_race_batch(batch, stats):
+    """
+    Validate and insert one batch of JSONL race cards and their children
+
+    A race already on file (or repeated in the batch) is logged and
+    skipped, as is a runner repeated within a race; `flask refresh`
+    updates stored cards. Form lines nested in a skipped race are still
+    stored.
+    """
+    race_rows, runner_groups = [], []
+    for line_no, record in batch:
+        try:
+            if isinstance(record, Exception):
+                raise record
+            race_row = add_measures(clean_record(record, RACE_FIELDS, required=('date', 'course')))
+            runner_rows = []
+            for runner in record.get('runners') or []:
+                runner_row = clean_record(runner, RUNNER_FIELDS, required=('horse_name',))
+                form_rows = []
+                for form_line in runner.get('form_lines') or []:
+                    form_rows.append(clean_form_line(form_line))
+                runner_rows.append((runner_row, form_rows))
+        except IngestError as e:
+            stats['skipped'] += 1
+            current_app.logger.warning('line %d skipped: %s', line_no, e)
+            continue
+        race_rows.append((line_no, race_row))
+        runner_groups.append(runner_rows)
+
+    seen = existing_race_keys([race_row for _, race_row in race_rows])
+    new_races, new_groups, skipped_groups = [], [], []
+    for (line_no, race_row), runners in zip(race_rows, runner_groups):
+        key = tuple(race_row[column] for column in RACE_KEY)
+        if key in seen:
+            stats['skipped'] += 1
+            current_app.logger.warning('line %d skipped: race already on file', line_no)
+            skipped_groups.append(runners)
+            continue
+        if race_row['race_time'] is not None:  # NULL times never conflict
+            seen.add(key)
+        new_races.append(race_row)
+        new_groups.append((line_no, runners))
+
+    resolve_race_courses(new_races)
+    race_ids = insert_returning_ids(Race, new_races)
+    invalidate_snapshots(db.session, {row['date'] for row in new_races})
+    horse_ids = resolve_horses(runner_row['horse_name']
+                               for runners in runner_groups for runner_row, _ in runners)
+
+    runner_rows, form_rows = [], []
+    for race_id, (line_no, runners) in zip(race_ids, new_groups):
+        names = set()
+        for runner_row, runner_form in runners:
+            horse_id = horse_ids[runner_row['horse_name']]
+            form_rows.extend(dict(row, horse_id=horse_id) for row in runner_form)
+            if runner_row['horse_name'] in names:
+                stats['skipped'] += 1
+                current_app.logger.warning('line %d: repeated runner %s skipped',
+                                           line_no, runner_row['horse_name'])
+                continue
+            names.add(runner_row['horse_name'])
+            runner_rows.append(dict(runner_row, race_id=race_id, horse_id=horse_id))
+    for runners in skipped_groups:
+        for runner_row, runner_form in runners:
+            horse_id = horse_ids[runner_row['horse_name']]
+            form_rows.extend(dict(row, horse_id=horse_id) for row in runner_form)
+    runner_ids = insert_returning_ids(Runner, runner_rows)
+    store_form_lines(form_rows, stats)
+
+    stats['races'] += len(race_ids)
+    stats['runners'] += len(runner_ids)
+
+
+def load_form_batch(batch, stats):
+    """Validate and store one batch of CSV form lines"""
+    rows = []
+    for line_no, record in batch:
+        try:
+            horse_name = (record.get('horse_name') or '').strip()
+            if not horse_name:
+                raise IngestError('missing required field horse_name')
+            rows.append((horse_name, clean_form_line(record)))
+        except IngestError as e:
+            stats['skipped'] += 1
+            current_app.logger.warning('line %d skipped: %s', line_no, e)
+
+    horse_ids = resolve_horses(horse_name for horse_name, _ in rows)
+    store_form_lines([dict(row, horse_id=horse_ids[horse_name]) for horse_name, row in rows], stats)
+
+
+def ingest_file(path, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Load a JSONL race card file or a CSV form line file
+
+    Returns:
+        dict: Row counts per table, skipped records and elapsed seconds
+    """
+    stats = {'races': 0, 'runners': 0, 'form_lines': 0, 'duplicates': 0, 'skipped': 0}
+    if path.endswith('.csv'):
+        records, load_batch = read_csv(path), load_form_batch
+    else:
+        records, load_batch = read_jsonl(path), load_race_batch
+
+    started = time.perf_counter()
+    for batch in batched(records, batch_size):
+        try:
+            load_batch(batch, stats)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+    if stats['races']:
+        invalidate_lookups()
+    stats['seconds'] = time.perf_counter() - started
+    return stats
+
+
+@click.command('ingest')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--batch-size', default=DEFAULT_BATCH_SIZE, show_default=True,
+              help='Records per transaction (races for JSONL, form lines for CSV)')
+@with_appcontext
+def ingest_command(path, batch_size):
+    """Bulk load race cards (.jsonl) or form lines (.csv)"""
+    stats = ingest_file(path, batch_size)
+    rows = stats['races'] + stats['runners'] + stats['form_lines']
+    seconds = stats['seconds']
+    click.echo('Loaded %d races, %d runners, %d form lines (%d already on file, %d skipped)'
+               % (stats['races'], stats['runners'], stats['form_lines'], stats['duplicates'],
+                  stats['skipped']))
+    click.echo('%d rows in %.1fs (%.0f rows/s)' % (rows, seconds, rows / seconds if seconds else 0))
@@ -0,0 +1,260 @@
+"""
+Dictionary encoding for low-cardinality form line columns
+
+Going, distance, class, race type and race code repeat the same few hundred
+strings across every form line, and surface/configuration/lh_rh are fixed
+properties of the course. Form lines store small integer codes instead:
+lookup_values holds one (kind, value) row per distinct string and courses
+holds each course with its characteristics.
+
+Both tables are tiny, so each process keeps a Dictionary of them in memory.
+The Coded column type swaps strings for codes when binding parameters and
+back when reading results, so models, filters and responses keep working
+with the strings while rows, indexes and comparisons use integers.
+
+Codes are made in the writing transaction: ingest resolves a batch's
+values up front, and a before_flush hook does the same for ORM objects,
+so an insert or update never binds UNKNOWN. UNKNOWN is only bound by
+filters on values no row has.
+
+That swapping happens while a statement is being run, so a Dictionary
+reads its table through the connection running that statement rather
+than checking out a second one. A value or code that is not in the table
+is remembered as missing until the table's version moves, so a filter on
+an unknown string (?going=bogus) does not re-read the table each request.
+"""
+
+import threading
+import time
+
+from sqlalchemy import event, func, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from sqlalchemy.types import SmallInteger, TypeDecorator
+
+# Code bound for a string that has no code yet. No row has it, so a filter
+# on an unknown value simply matches nothing.
+UNKNOWN = 0
+
+# How often a Dictionary asks the database whether its table changed
+VERSION_CHECK_SECONDS = 30
+
+_dictionaries = []
+
+# The connection each thread last started a statement on
+_statements = threading.local()
+
+
+@event.listens_for(Engine, 'before_execute')
+def _note_connection(connection, clauseelement, multiparams, params, execution_options):
+    _statements.connection = connection
+
+
+class Dictionary:
+    """
+    In-memory code <-> value map over a lookup table
+
+    Args:
+        db: The Flask-SQLAlchemy extension (the engine is looked up lazily)
+        table (Table): Lookup table with an integer id column
+        value_column (str): Column holding the string
+        kind (str): Restrict to rows with this kind (shared lookup_values)
+        extra (list): Further columns kept per code (course characteristics)
+        derive (callable): value -> further column values for new rows
+        version_column (str): Row timestamp for tables whose rows can
+            change. (row count, latest timestamp, or highest id without
+            one) is checked every VERSION_CHECK_SECONDS; when it moves the
+            rows are reloaded and the values known to be missing forgotten
+    """
+
+    def __init__(self, db, table, value_column='value', kind=None, extra=(), derive=None,
+                 version_column=None):
+        self.db = db
+        self.table = table
+        self.value_column = value_column
+        self.kind = kind
+        self.extra = list(extra)
+        self.derive = derive
+        self.version_column = version_column
+        self._version = None
+        self._next_check = 0.0
+        self._codes = {}
+        self._rows = {}
+        self._missing_values = set()
+        self._missing_codes = set()
+        self._lock = threading.Lock()
+        _dictionaries.append(self)
+
+    def _select(self):
+        stmt = select(self.table)
+        if self.kind is not None:
+            stmt = stmt.where(self.table.c.kind == self.kind)
+        return stmt
+
+    def _read(self, stmt):
+        """Rows of stmt, through the statement's connection when one is running"""
+        connection = getattr(_statements, 'connection', None)
+        if connection is not None and not connection.closed and not connection.invalidated:
+            return connection.execute(stmt).all()
+        with self.db.engine.connect() as connection:
+            return connection.execute(stmt).all()
+
+    def register(self, rows):
+        """Learn codes from lookup table rows (mappings with id and value)"""
+        with self._lock:
+            for row in rows:
+                self._rows[row['id']] = dict(row)
+                self._codes[row[self.value_column]] = row['id']
+                self._missing_values.discard(row[self.value_column])
+                self._missing_codes.discard(row['id'])
+
+    def reload(self):
+        """Read the table, keeping codes learnt in this transaction"""
+        self.register([row._mapping for row in self._read(self._select())])
+
+    def clear(self):
+        with self._lock:
+            self._codes = {}
+            self._rows = {}
+            self._missing_values = set()
+            self._missing_codes = set()
+            self._version = None
+            self._next_check = 0.0
+
+    def check_version(self):
+        """Reload the rows if the table changed since the last check"""
+        if time.monotonic() < self._next_check:
+            return
+        self._next_check = time.monotonic() + VERSION_CHECK_SECONDS
+        version_column = self.table.c[self.version_column or 'id']
+        stmt = select(func.count(), func.max(version_column))
+        if self.kind is not None:
+            stmt = stmt.where(self.table.c.kind == self.kind)
+        version = tuple(self._read(stmt)[0])
+        if version != self._version:
+            with self._lock:
+                self._missing_values = set()
+                self._missing_codes = set()
+            self._version = version
+            self.reload()
+
+    def code(self, value):
+        """Code for a string (UNKNOWN if it has none), None for None"""
+        if value is None:
+            return None
+        self.check_version()
+        code = self._codes.get(value)
+        if code is None:
+            if value in self._missing_values:
+                return UNKNOWN
+            self.reload()
+            code = self._codes.get(value)
+            if code is None:
+                self._missing_values.add(value)
+                return UNKNOWN
+        return code
+
+    def row(self, code):
+        """Lookup row for a code as a dict, or None"""
+        if code is None:
+            return None
+        self.check_version()
+        row = self._rows.get(code)
+        if row is None and code not in self._missing_codes:
+            self.reload()
+            row = self._rows.get(code)
+            if row is None:
+                self._missing_codes.add(code)
+        return row
+
+    def value(self, code):
+        row = self.row(code)
+        return None if row is None else row[self.value_column]
+
+    def resolve(self, session, sources):
+        """
+        Give every value a code within the session's transaction, creating
+        lookup rows for new ones
+
+        Args:
+            sources (dict): value -> record to take the extra columns from
+        """
+        missing = [value for value in sources if value is not None and value not in self._codes]
+        if missing:
+            self.register(session.execute(self._select()).mappings().all())
+            missing = [value for value in missing if value not in self._codes]
+        if not missing:
+            return
+
+        rows = []
+        for value in missing:
+            row = {self.value_column: value}
+            if self.kind is not None:
+                row['kind'] = self.kind
+            row.update((column, sources[value].get(column)) for column in self.extra)
+            if self.derive is not None:
+                row.update(self.derive(value))
+            rows.append(row)
+
+        dialect = session.get_bind().dialect.name
+        insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+        key = ['kind', self.value_column] if self.kind is not None else [self.value_column]
+        session.execute(insert(self.table).on_conflict_do_nothing(index_elements=key), rows)
+
+        stmt = self._select().where(self.table.c[self.value_column].in_(missing))
+        self.register(session.execute(stmt).mappings().all())
+        session.info['codes_learnt'] = True
+
+
+class Coded(TypeDecorator):
+    """String column stored as a SmallInteger code from a Dictionary"""
+
+    impl = SmallInteger
+    cache_ok = True
+
+    def __init__(self, dictionary):
+        super().__init__()
+        self.dictionary = dictionary
+
+    def process_bind_param(self, value, dialect):
+        return self.dictionary.code(value)
+
+    def process_result_value(self, value, dialect):
+        return self.dictionary.value(value)
+
+
+def coded_columns(table):
+    """(column, dictionary) for each Coded column of a table"""
+    return [(column, column.type.dictionary) for column in table.columns
+            if isinstance(column.type, Coded)]
+
+
+@event.listens_for(Session, 'before_flush')
+def _resolve_on_flush(session, flush_context, instances):
+    # Code new strings on ORM writes, which would otherwise bind UNKNOWN
+    values = {}
+    for obj in list(session.new) + list(session.dirty):
+        table = getattr(obj, '__table__', None)
+        if table is None:
+            continue
+        for column, dictionary in coded_columns(table):
+            value = getattr(obj, column.key)
+            if value is not None:
+                values.setdefault(dictionary, {}).setdefault(value, {})
+    for dictionary, sources in values.items():
+        dictionary.resolve(session, sources)
+
+
+@event.listens_for(Session, 'after_commit')
+def _keep_on_commit(session):
+    session.info.pop('codes_learnt', None)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_on_rollback(session):
+    # Codes learnt inside the rolled back transaction may not exist, and
+    # their ids can be handed out again
+    if session.info.pop('codes_learnt', False):
+        for dictionary in _dictionaries:
+            dictionary.clear()
@@ -0,0 +1,228 @@
+"""
+Per-request performance instrumentation
+
+Every request records its latency and, through SQLAlchemy cursor events,
+the number of SQL statements it ran, the time spent in them and the rows
+they returned (where the driver reports a rowcount; psycopg2 does for
+SELECTs, SQLite does not). Each response gets a Server-Timing header, e.g.
+
+    Server-Timing: db;dur=4.1;desc="3 statements", app;dur=6.9, total;dur=11.0
+
+statements slower than SLOW_QUERY_MS are logged with the endpoint, and
+totals are kept per endpoint for /api/metrics in the Prometheus text
+format (scraped with OPS_TOKEN as the bearer token, see app.py). Queries
+run while a streamed body is sent happen after the response is recorded
+and are not counted.
+
+The cost is a few perf_counter() calls per statement and one locked update
+per request. Counters are per process; with several gunicorn workers each
+keeps its own, so scrape the workers individually to see them all.
+
+  METRICS_ENABLED           0 to turn the instrumentation off (default 1)
+  SLOW_QUERY_MS             slow query log threshold (default 250)
+"""
+
+import bisect
+import os
+import threading
+import time
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# db_pool.pool_stats() keys exported, with their metric type
+POOL_METRICS = [
+    ('pool_size', 'gauge', 'Connections the pool keeps open'),
+    ('checked_out', 'gauge', 'Connections in use'),
+    ('checked_in', 'gauge', 'Idle connections in the pool'),
+    ('overflow', 'gauge', 'Connections open beyond pool_size (negative while below it)'),
+    ('checkouts', 'counter', 'Connection checkouts'),
+    ('slow_checkouts', 'counter', 'Checkouts that waited for a connection'),
+    ('timeouts', 'counter', 'Checkouts that timed out'),
+    ('checkout_seconds', 'counter', 'Time spent checking out connections'),
+    ('max_checkout_seconds', 'gauge', 'Slowest checkout so far'),
+]
+
+# Statement text kept in slow query log lines
+SLOW_QUERY_TEXT = 1000
+
+
+class RequestTiming:
+    """What the current request has spent so far"""
+
+    __slots__ = ('started', 'statements', 'db_seconds', 'rows')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.db_seconds = 0.0
+        self.rows = 0
+
+
+class Histogram:
+    """Cumulative-bucket histogram per label set, in the Prometheus model"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, labels, value):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self, name, label_names):
+        lines = []
+        for labels, (counts, total, count) in sorted(self.series.items()):
+            prefix = format_labels(label_names, labels)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append('%s_bucket{%sle="%s"} %d' % (name, prefix, bound, cumulative))
+            lines.append('%s_bucket{%sle="+Inf"} %d' % (name, prefix, count))
+            lines.append('%s_sum{%s} %.6f' % (name, prefix.rstrip(','), total))
+            lines.append('%s_count{%s} %d' % (name, prefix.rstrip(','), count))
+        return lines
+
+
+def format_labels(names, values):
+    return ''.join('%s="%s",' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                   for name, value in zip(names, values))
+
+
+class Metrics:
+    """Per-process totals of the instrumented requests"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.statements = Histogram(STATEMENT_BUCKETS)
+        self.requests = {}
+        self.db_seconds = {}
+        self.rows = {}
+        self.slow_queries = 0
+
+    def record(self, endpoint, method, status, timing, seconds):
+        with self._lock:
+            key = (endpoint, method, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self.latency.observe((endpoint,), seconds)
+            self.statements.observe((endpoint,), timing.statements)
+            self.db_seconds[endpoint] = self.db_seconds.get(endpoint, 0.0) + timing.db_seconds
+            self.rows[endpoint] = self.rows.get(endpoint, 0) + timing.rows
+
+    def count_slow_query(self):
+        with self._lock:
+            self.slow_queries += 1
+
+    def render(self, pool=None):
+        """Prometheus text exposition of the totals and of db_pool.pool_stats()"""
+        with self._lock:
+            lines = ['# HELP hrf_requests_total Requests by endpoint, method and status',
+                     '# TYPE hrf_requests_total counter']
+            lines += ['hrf_requests_total{%s} %d' % (format_labels(
+                          ('endpoint', 'method', 'status'), key).rstrip(','), count)
+                      for key, count in sorted(self.requests.items())]
+            lines += ['# HELP hrf_request_duration_seconds Request latency by endpoint',
+                      '# TYPE hrf_request_duration_seconds histogram']
+            lines += self.latency.render('hrf_request_duration_seconds', ('endpoint',))
+            lines += ['# HELP hrf_db_statements_per_request SQL statements run per request',
+                      '# TYPE hrf_db_statements_per_request histogram']
+            lines += self.statements.render('hrf_db_statements_per_request', ('endpoint',))
+            lines += ['# HELP hrf_db_seconds_total Time spent executing SQL by endpoint',
+                      '# TYPE hrf_db_seconds_total counter']
+            lines += ['hrf_db_seconds_total{endpoint="%s"} %.6f' % (endpoint, seconds)
+                      for endpoint, seconds in sorted(self.db_seconds.items())]
+            lines += ['# HELP hrf_db_rows_total Rows returned by SQL by endpoint',
+                      '# TYPE hrf_db_rows_total counter']
+            lines += ['hrf_db_rows_total{endpoint="%s"} %d' % (endpoint, rows)
+                      for endpoint, rows in sorted(self.rows.items())]
+            lines += ['# HELP hrf_slow_queries_total Statements slower than SLOW_QUERY_MS',
+                      '# TYPE hrf_slow_queries_total counter',
+                      'hrf_slow_queries_total %d' % self.slow_queries]
+        for name, kind, help_text in POOL_METRICS:
+            if pool and name in pool:
+                metric = 'hrf_db_pool_%s%s' % (name, '_total' if kind == 'counter' else '')
+                lines += ['# HELP %s %s' % (metric, help_text), '# TYPE %s %s' % (metric, kind),
+                          '%s %s' % (metric, pool[name])]
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+def slow_query_seconds():
+    return float(os.getenv('SLOW_QUERY_MS', 250)) / 1000
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'request_timing' in g:
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('query_started')
+    if not started or not has_request_context():
+        return
+    seconds = time.perf_counter() - started.pop()
+    timing = g.get('request_timing')
+    if timing is None:
+        return
+    timing.statements += 1
+    timing.db_seconds += seconds
+    if cursor.description is not None and cursor.rowcount > 0:
+        timing.rows += cursor.rowcount
+
+    if seconds >= current_app.config['SLOW_QUERY_SECONDS']:
+        metrics.count_slow_query()
+        current_app.logger.warning('slow query (%.1f ms) in %s: %s', seconds * 1000,
+                                   request.endpoint, statement[:SLOW_QUERY_TEXT])
+
+
+def _handle_error(context):
+    # A failed statement never reaches after_cursor_execute
+    started = context.connection.info.get('query_started') if context.connection else None
+    if started:
+        started.pop()
+
+
+def _start_timing():
+    g.request_timing = RequestTiming()
+
+
+def _finish_timing(response):
+    timing = g.pop('request_timing', None)
+    if timing is None:
+        return response
+    seconds = time.perf_counter() - timing.started
+    metrics.record(request.endpoint or 'unmatched', request.method, response.status_code,
+                   timing, seconds)
+    response.headers.add('Server-Timing', 'db;dur=%.1f;desc="%d statements", app;dur=%.1f, total;dur=%.1f'
+                         % (timing.db_seconds * 1000, timing.statements,
+                            (seconds - timing.db_seconds) * 1000, seconds * 1000))
+    return response
+
+
+_listening = False
+
+
+def install_metrics(app):
+    """Time every request of the app unless METRICS_ENABLED=0"""
+    global _listening
+    if os.getenv('METRICS_ENABLED', '1').strip().lower() in ('0', 'false', 'no', 'off'):
+        return
+    app.config.setdefault('SLOW_QUERY_SECONDS', slow_query_seconds())
+    app.before_request(_start_timing)
+    app.after_request(_finish_timing)
+    if not _listening:
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+        _listening = True
@@ -0,0 +1,352 @@
+"""
+Schema management: creating, migrating and seeding the database
+
+The app never changes the schema at startup. `flask migrate` creates any
+missing tables, applies pending migrations to existing tables (Postgres
+only, in a single transaction, after which the form line indexes and
+aggregates are rebuilt) and seeds the courses table. Run it once per
+deploy, before the web processes start (the Procfile release step).
+
+MIGRATIONS holds a step for every change to an existing table since the
+original schema, so a database created by any earlier version of the app
+is brought up to date by a single run. A schema change that create_all
+cannot apply to an existing table ships with its entry here.
+
+Usage: flask --app app migrate
+"""
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import inspect, text
+
+from course_mapping import resolve_course
+from courses import load_courses
+from form_stats import BAND_ORDER, rebuild_form_stats
+from ingest import resolve_race_courses
+from models import db, Course, FormLine, RunnerFormStat, LOOKUP_KINDS, MEASURED_KINDS
+
+VERSIONS_STEPS = [
+    # Row versions for ETags; existing rows count as changed now
+    "ALTER TABLE races ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP NOT NULL DEFAULT now()",
+    "ALTER TABLE runners ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP NOT NULL DEFAULT now()",
+]
+
+INDEXES_STEPS = [
+    # Composite indexes for racecards and keyset pages
+    "CREATE INDEX IF NOT EXISTS ix_races_date_race_time ON races (date, race_time)",
+    "CREATE INDEX IF NOT EXISTS ix_races_date_id ON races (date, id)",
+    "CREATE INDEX IF NOT EXISTS ix_races_course_date_id ON races (course, date, id)",
+
+    # Single-column indexes no query uses or the composites cover. The
+    # form_lines read index is created on horse_id once form moves to
+    # horses (see HORSES_STEPS).
+    "DROP INDEX IF EXISTS ix_races_date, ix_races_course, ix_runners_horse_name, "
+    "ix_runners_jockey, ix_runners_trainer, ix_form_lines_runner_id, "
+    "ix_form_lines_race_date, ix_form_lines_course, ix_form_lines_distance, "
+    "ix_form_lines_going, ix_form_lines_race_class, ix_form_lines_race_type, "
+    "ix_form_lines_race_code, ix_form_lines_finishing_position",
+]
+
+def merge_duplicate_entries(connection):
+    """
+    Fold races repeated on (date, course, race_time), and runners repeated
+    on (race_id, horse_name), into their oldest row so the natural keys can
+    be added. Form lines of a dropped runner move to the one kept.
+    """
+    connection.execute(text(
+        "UPDATE runners SET race_id = d.keep_id FROM "
+        "(SELECT id, min(id) OVER (PARTITION BY date, course, race_time) AS keep_id "
+        "FROM races WHERE race_time IS NOT NULL) d "
+        "WHERE runners.race_id = d.id AND d.id <> d.keep_id"))
+    connection.execute(text(
+        "DELETE FROM races a USING races b WHERE a.date = b.date AND a.course = b.course "
+        "AND a.race_time = b.race_time AND a.id > b.id"))
+    if has_column(inspect(connection), 'form_lines', 'runner_id'):
+        connection.execute(text(
+            "UPDATE form_lines SET runner_id = d.keep_id FROM "
+            "(SELECT id, min(id) OVER (PARTITION BY race_id, horse_name) AS keep_id FROM runners) d "
+            "WHERE form_lines.runner_id = d.id AND d.id <> d.keep_id"))
+    connection.execute(text(
+        "DELETE FROM runners a USING runners b WHERE a.race_id = b.race_id "
+        "AND a.horse_name = b.horse_name AND a.id > b.id"))
+
+
+NATURAL_KEYS_STEPS = [
+    "ALTER TABLE runners ADD COLUMN IF NOT EXISTS non_runner BOOLEAN NOT NULL DEFAULT false",
+    merge_duplicate_entries,
+    # The conflict targets of the refresh upserts; the runners key also
+    # serves lookups by race_id
+    "ALTER TABLE races ADD CONSTRAINT uq_races_date_course_time UNIQUE (date, course, race_time)",
+    "ALTER TABLE runners ADD CONSTRAINT uq_runners_race_horse UNIQUE (race_id, horse_name)",
+    "DROP INDEX IF EXISTS ix_runners_race_id",
+]
+
+HORSES_STEPS = [
+    # One horse per distinct name, and point every runner at it
+    "INSERT INTO horses (name) SELECT DISTINCT horse_name FROM runners "
+    "ON CONFLICT (name) DO NOTHING",
+    "ALTER TABLE runners ADD COLUMN IF NOT EXISTS horse_id INTEGER REFERENCES horses (id)",
+    "UPDATE runners SET horse_id = horses.id FROM horses "
+    "WHERE horses.name = runners.horse_name AND runners.horse_id IS NULL",
+    "ALTER TABLE runners ALTER COLUMN horse_id SET NOT NULL",
+    "CREATE INDEX IF NOT EXISTS ix_runners_horse_id ON runners (horse_id)",
+    "DROP INDEX IF EXISTS ix_runners_horse_name",
+
+    # Move form lines from the runner entry to the horse
+    "ALTER TABLE form_lines ADD COLUMN IF NOT EXISTS horse_id INTEGER REFERENCES horses (id)",
+    "UPDATE form_lines SET horse_id = runners.horse_id FROM runners "
+    "WHERE runners.id = form_lines.runner_id",
+
+    # Collapse the copies made for each entry, keeping the oldest row
+    "DELETE FROM form_lines a USING form_lines b "
+    "WHERE a.horse_id = b.horse_id AND a.race_date = b.race_date "
+    "AND a.course = b.course AND a.id > b.id",
+
+    # Dropping runner_id also drops the indexes built on it
+    "ALTER TABLE form_lines DROP COLUMN runner_id",
+    "ALTER TABLE form_lines ALTER COLUMN horse_id SET NOT NULL",
+    "ALTER TABLE form_lines ADD CONSTRAINT uq_form_lines_horse_race "
+    "UNIQUE (horse_id, race_date, course)",
+
+    # Aggregates were keyed by horse name; rebuilt afterwards
+    "DROP TABLE IF EXISTS runner_form_stats",
+]
+
+LOOKUPS_STEPS = [
+    # A code for every distinct string, and each course with the
+    # characteristics of its earliest form line
+    *["INSERT INTO lookup_values (kind, value) SELECT DISTINCT '{0}', {0} FROM form_lines "
+      "WHERE {0} IS NOT NULL ON CONFLICT (kind, value) DO NOTHING".format(kind)
+      for kind in LOOKUP_KINDS],
+    "INSERT INTO courses (name, surface, configuration, lh_rh, updated_at) "
+    "SELECT DISTINCT ON (course) course, surface, configuration, lh_rh, now() FROM form_lines "
+    "WHERE course IS NOT NULL ORDER BY course, id ON CONFLICT (name) DO NOTHING",
+
+    # Code columns, filled in one pass over the table
+    *["ALTER TABLE form_lines ADD COLUMN {0}_id SMALLINT REFERENCES lookup_values (id)".format(kind)
+      for kind in LOOKUP_KINDS],
+    "ALTER TABLE form_lines ADD COLUMN course_id SMALLINT REFERENCES courses (id)",
+    "UPDATE form_lines SET course_id = (SELECT id FROM courses WHERE name = form_lines.course), "
+    + ", ".join("{0}_id = (SELECT id FROM lookup_values WHERE kind = '{0}' "
+                "AND value = form_lines.{0})".format(kind) for kind in LOOKUP_KINDS),
+
+    # Dropping the string columns also drops the unique key and covering
+    # index built on them
+    "ALTER TABLE form_lines DROP COLUMN course, DROP COLUMN surface, "
+    "DROP COLUMN configuration, DROP COLUMN lh_rh, "
+    + ", ".join("DROP COLUMN %s" % kind for kind in LOOKUP_KINDS),
+    "ALTER TABLE form_lines ADD CONSTRAINT uq_form_lines_horse_race "
+    "UNIQUE (horse_id, race_date, course_id)",
+]
+
+
+def backfill_measures(connection):
+    """Parse every stored distance and going into its numeric measure"""
+    for column, measure in [('distance', 'distance_yards'), ('going', 'going_rank')]:
+        parse = MEASURED_KINDS[column]
+        values = connection.execute(text(
+            'SELECT DISTINCT {0} FROM races WHERE {0} IS NOT NULL'.format(column))).scalars()
+        params = [{'value': value, 'measure': parse(value)} for value in values]
+        if params:
+            connection.execute(text('UPDATE races SET {0} = :measure WHERE {1} = :value'
+                                    .format(measure, column)), params)
+
+    rows = connection.execute(text(
+        "SELECT id, kind, value FROM lookup_values WHERE kind IN ('distance', 'going')")).all()
+    params = [{'id': row.id, 'measure': MEASURED_KINDS[row.kind](row.value)} for row in rows]
+    if params:
+        connection.execute(text('UPDATE lookup_values SET measure = :measure WHERE id = :id'), params)
+
+
+MEASURES_STEPS = [
+    "ALTER TABLE races ADD COLUMN distance_yards INTEGER",
+    "ALTER TABLE races ADD COLUMN going_rank SMALLINT",
+    # lookup_values may have just been created with the column
+    "ALTER TABLE lookup_values ADD COLUMN IF NOT EXISTS measure INTEGER",
+    backfill_measures,
+    "CREATE INDEX ix_races_distance_yards ON races (distance_yards)",
+    "CREATE INDEX ix_races_going_rank ON races (going_rank)",
+]
+
+
+def backfill_race_courses(connection):
+    """Load the mapped courses and point every race at its course"""
+    load_courses()
+    names = connection.execute(text('SELECT DISTINCT course FROM races')).scalars()
+    rows = [{'course': name} for name in names]
+    resolve_race_courses(rows)
+    if rows:
+        connection.execute(text('UPDATE races SET course_id = :course_id WHERE course = :course'), rows)
+
+
+COURSES_STEPS = [
+    # courses may have just been created with the column
+    "ALTER TABLE courses ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP NOT NULL DEFAULT now()",
+    "ALTER TABLE races ADD COLUMN course_id SMALLINT REFERENCES courses (id)",
+    backfill_race_courses,
+    "CREATE INDEX ix_races_course_id ON races (course_id)",
+]
+
+
+def course_spellings():
+    """(id, mapped name) of courses rows named by a feed spelling of a mapped course"""
+    return [(course_id, resolve_course(name)) for course_id, name in db.session.query(Course.id, Course.name)
+            if resolve_course(name) not in (None, name)]
+
+
+def merge_course_spellings(connection):
+    """
+    Move form lines and races from a course's feed spellings to its mapped
+    row, renaming the spelling's row when there is none. A line the horse
+    already has at the mapped course is dropped.
+    """
+    for course_id, name in course_spellings():
+        mapped_id = connection.execute(text('SELECT id FROM courses WHERE name = :name'),
+                                       {'name': name}).scalar()
+        if mapped_id is None:
+            connection.execute(text('UPDATE courses SET name = :name WHERE id = :id'),
+                               {'name': name, 'id': course_id})
+            continue
+        params = {'id': course_id, 'mapped_id': mapped_id}
+        connection.execute(text(
+            "DELETE FROM form_lines AS a WHERE a.course_id = :id AND EXISTS (SELECT 1 FROM form_lines b "
+            "WHERE b.horse_id = a.horse_id AND b.race_date = a.race_date AND b.course_id = :mapped_id)"),
+            params)
+        connection.execute(text('UPDATE form_lines SET course_id = :mapped_id WHERE course_id = :id'), params)
+        connection.execute(text('UPDATE races SET course_id = :mapped_id WHERE course_id = :id'), params)
+        connection.execute(text('DELETE FROM courses WHERE id = :id'), params)
+
+
+COURSE_SPELLINGS_STEPS = [
+    merge_course_spellings,
+    # Form in the snapshots names the old rows
+    "DELETE FROM racecard_snapshots WHERE form_limit > 0",
+]
+
+
+def has_column(inspector, table, column):
+    return column in {info['name'] for info in inspector.get_columns(table)}
+
+
+def lacks_index(inspector, table, index):
+    """True for an existing table without the index"""
+    return (inspector.has_table(table)
+            and index not in {info['name'] for info in inspector.get_indexes(table)})
+
+
+def lacks_unique(inspector, table, constraint):
+    """True for an existing table without the unique constraint"""
+    return (inspector.has_table(table)
+            and constraint not in {info['name'] for info in inspector.get_unique_constraints(table)})
+
+
+def lacks_column(inspector, table, column):
+    """True for an existing table without the column (new tables get it from create_all)"""
+    return inspector.has_table(table) and not has_column(inspector, table, column)
+
+
+def has_unbanded_distances(inspector):
+    """True while runner_form_stats holds distance rows keyed on the raw string"""
+    if not inspector.has_table('runner_form_stats'):
+        return False
+    query = (db.session.query(RunnerFormStat.value)
+             .filter(RunnerFormStat.dimension == 'distance', RunnerFormStat.value.notin_(BAND_ORDER)))
+    return query.first() is not None
+
+
+def has_unmeasured_values(inspector):
+    """True while a stored distance or going the parsers now read has no measure"""
+    if not lacks_column(inspector, 'races', 'distance_yards') and inspector.has_table('races'):
+        for column, measure in [('distance', 'distance_yards'), ('going', 'going_rank')]:
+            values = db.session.execute(text(
+                'SELECT DISTINCT {0} FROM races WHERE {0} IS NOT NULL AND {1} IS NULL'
+                .format(column, measure))).scalars()
+            if any(MEASURED_KINDS[column](value) is not None for value in values):
+                return True
+    if not inspector.has_table('lookup_values') or not has_column(inspector, 'lookup_values', 'measure'):
+        return False
+    rows = db.session.execute(text("SELECT kind, value FROM lookup_values "
+                                   "WHERE kind IN ('distance', 'going') AND measure IS NULL"))
+    return any(MEASURED_KINDS[kind](value) is not None for kind, value in rows)
+
+
+# (name, test for whether it is still pending, steps), oldest first. A step
+# is a SQL statement or a function taking the connection.
+MIGRATIONS = [
+    ('versions', lambda inspector: (lacks_column(inspector, 'races', 'updated_at')
+                                    or lacks_column(inspector, 'runners', 'updated_at')), VERSIONS_STEPS),
+    ('indexes', lambda inspector: lacks_index(inspector, 'races', 'ix_races_date_race_time'), INDEXES_STEPS),
+    ('natural keys', lambda inspector: (lacks_column(inspector, 'runners', 'non_runner')
+                                        or lacks_unique(inspector, 'races', 'uq_races_date_course_time')
+                                        or lacks_unique(inspector, 'runners', 'uq_runners_race_horse')),
+     NATURAL_KEYS_STEPS),
+    ('horses', lambda inspector: (inspector.has_table('form_lines')
+                                  and has_column(inspector, 'form_lines', 'runner_id')), HORSES_STEPS),
+    ('lookups', lambda inspector: lacks_column(inspector, 'form_lines', 'course_id'), LOOKUPS_STEPS),
+    ('measures', lambda inspector: lacks_column(inspector, 'races', 'distance_yards'), MEASURES_STEPS),
+    ('courses', lambda inspector: lacks_column(inspector, 'races', 'course_id'), COURSES_STEPS),
+    # Nothing to alter: every migration ends by rebuilding the aggregates
+    ('distance bands', has_unbanded_distances, []),
+    # Snapshots are validated by ETag alone (see racecards.racecard_version)
+    ('snapshot validators', lambda inspector: (inspector.has_table('racecard_snapshots')
+                                               and has_column(inspector, 'racecard_snapshots',
+                                                              'last_modified')),
+     ["ALTER TABLE racecard_snapshots DROP COLUMN last_modified"]),
+    # Before the lookups migration, courses is filled from raw form line names
+    ('course spellings', lambda inspector: (inspector.has_table('form_lines')
+                                            and (not inspector.has_table('courses')
+                                                 or bool(course_spellings()))),
+     COURSE_SPELLINGS_STEPS),
+    # parse_going learnt "Gd/Sft" and "Good-Soft"
+    ('going spellings', has_unmeasured_values, [backfill_measures]),
+]
+
+
+def migrate():
+    """
+    Create missing tables, apply every pending migration and seed the
+    courses table, all in one transaction
+
+    Returns:
+        list: Names of the migrations applied
+    """
+    bind = db.session.get_bind()
+    inspector = inspect(bind)
+    pending = [(name, steps) for name, is_pending, steps in MIGRATIONS if is_pending(inspector)]
+    if pending and bind.dialect.name != 'postgresql':
+        raise click.ClickException('migrations support Postgres only; delete other '
+                                   'databases, then run migrate and re-ingest')
+
+    # New tables first, then the steps, then anything the steps dropped
+    connection = db.session.connection()
+    db.metadata.create_all(connection)
+    for name, steps in pending:
+        for step in steps:
+            if callable(step):
+                step(connection)
+            else:
+                connection.execute(text(step))
+    if pending:
+        db.metadata.create_all(connection)
+        for index in FormLine.__table__.indexes:
+            if index.name == 'ix_form_lines_horse_date':
+                index.create(connection, checkfirst=True)
+
+    load_courses()
+    if pending:
+        rebuild_form_stats()  # commits the whole migration
+    else:
+        db.session.commit()
+    return [name for name, steps in pending]
+
+
+@click.command('migrate')
+@with_appcontext
+def migrate_command():
+    """Create, migrate and seed the database schema"""
+    applied = migrate()
+    if not applied:
+        click.echo('Schema up to date')
+        return
+    click.echo('Applied: %s' % ', '.join(applied))
+    click.echo('Run VACUUM FULL form_lines to return the space freed by dropped columns')
@@ -3,17 +3,35 @@ Database Models for Horse Racing Data
 """
 
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.orm import validates
 from datetime import datetime
 
+from lookups import Coded, Dictionary
+from race_conditions import parse_distance, parse_going
+
 db = SQLAlchemy()
 
+# Integer ids for the small lookup tables (SQLite only autoincrements INTEGER keys)
+CODE = db.SmallInteger().with_variant(db.Integer(), 'sqlite')
+
+# Dictionary-encoded form line columns, each a kind in lookup_values
+LOOKUP_KINDS = ['distance', 'going', 'race_class', 'race_type', 'race_code']
+
+# Lookup kinds with a numeric measure, and the parser producing it
+MEASURED_KINDS = {'distance': parse_distance, 'going': parse_going}
+
+# Properties of a course rather than of a single run
+COURSE_CHARACTERISTIC_KEYS = ['surface', 'configuration', 'lh_rh']
+
 class Race(db.Model):
     """Race meeting information"""
     __tablename__ = 'races'
     
     id = db.Column(db.Integer, primary_key=True)
-    date = db.Column(db.Date, nullable=False, index=True)
-    course = db.Column(db.String(100), nullable=False, index=True)
+    date = db.Column(db.Date, nullable=False)
+    course = db.Column(db.String(100), nullable=False)
+    # The courses row the name resolves to, for characteristic filters
+    course_id = db.Column(CODE, db.ForeignKey('courses.id'), index=True)
     race_time = db.Column(db.String(10))
     race_name = db.Column(db.String(200))
     distance = db.Column(db.String(50))
@@ -22,9 +40,36 @@ class Race(db.Model):
     prize = db.Column(db.String(50))
     age_restriction = db.Column(db.String(50))
     
+    # distance and going parsed for range filters (see race_conditions.py)
+    distance_yards = db.Column(db.Integer, index=True)
+    going_rank = db.Column(db.SmallInteger, index=True)
+    
+    # Row version, used to build ETags for race cards
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (
+        # Natural key, the conflict target for refresh upserts
+        db.UniqueConstraint('date', 'course', 'race_time', name='uq_races_date_course_time'),
+        # Racecards: WHERE date = ? ORDER BY race_time
+        db.Index('ix_races_date_race_time', 'date', 'race_time'),
+        # /api/races keyset pages: ORDER BY date, id (optionally by course)
+        db.Index('ix_races_date_id', 'date', 'id'),
+        db.Index('ix_races_course_date_id', 'course', 'date', 'id'),
+    )
+    
     # Relationships
     runners = db.relationship('Runner', backref='race', lazy=True, cascade='all, delete-orphan')
     
+    @validates('distance')
+    def _measure_distance(self, key, distance):
+        self.distance_yards = parse_distance(distance)
+        return distance
+    
+    @validates('going')
+    def _measure_going(self, key, going):
+        self.going_rank = parse_going(going)
+        return going
+    
     def to_dict(self):
         return {
             'id': self.id,
@@ -39,22 +84,34 @@ class Race(db.Model):
             'age_restriction': self.age_restriction
         }
 
+class Horse(db.Model):
+    """A horse, owning the single canonical copy of its form history"""
+    __tablename__ = 'horses'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False, unique=True)
+    
+    # Relationships
+    runners = db.relationship('Runner', backref='horse', lazy=True)
+    form_lines = db.relationship('FormLine', backref='horse', lazy=True, cascade='all, delete-orphan')
+
 class Runner(db.Model):
     """Individual runner in a race"""
     __tablename__ = 'runners'
     
     id = db.Column(db.Integer, primary_key=True)
-    race_id = db.Column(db.Integer, db.ForeignKey('races.id'), nullable=False, index=True)
+    race_id = db.Column(db.Integer, db.ForeignKey('races.id'), nullable=False)
+    horse_id = db.Column(db.Integer, db.ForeignKey('horses.id'), nullable=False, index=True)
     
-    # Horse details
-    horse_name = db.Column(db.String(100), nullable=False, index=True)
+    # Horse details (name kept on the entry as it is part of the natural key)
+    horse_name = db.Column(db.String(100), nullable=False)
     age = db.Column(db.Integer)
     weight = db.Column(db.String(20))
     draw = db.Column(db.Integer)
     
     # Jockey/Trainer
-    jockey = db.Column(db.String(100), index=True)
-    trainer = db.Column(db.String(100), index=True)
+    jockey = db.Column(db.String(100))
+    trainer = db.Column(db.String(100))
     
     # Ratings and odds
     official_rating = db.Column(db.Integer)
@@ -65,10 +122,29 @@ class Runner(db.Model):
     # Form string
     form = db.Column(db.String(50))
     
-    # Relationships
-    form_lines = db.relationship('FormLine', backref='runner', lazy=True, cascade='all, delete-orphan')
+    non_runner = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false())
+    
+    # Row version, used to build ETags for race cards
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
     
-    def to_dict(self, include_form=True):
+    __table_args__ = (
+        # Natural key, the conflict target for refresh upserts
+        db.UniqueConstraint('race_id', 'horse_name', name='uq_runners_race_horse'),
+    )
+    
+    @property
+    def form_lines(self):
+        """The horse's form going into this race, most recent first"""
+        return (FormLine.query
+                .filter(FormLine.horse_id == self.horse_id, form_before(self.race.date))
+                .order_by(FormLine.race_date.desc(), FormLine.id.desc())
+                .all())
+    
+    def to_dict(self, include_form=True, form_lines=None):
+        """
+        Serialise the runner. Pass pre-loaded form_lines to avoid the lazy
+        load of self.form_lines when include_form is set.
+        """
         result = {
             'id': self.id,
             'horse_name': self.horse_name,
@@ -81,37 +157,82 @@ class Runner(db.Model):
             'rpr': self.rpr,
             'ts': self.ts,
             'odds': self.odds,
-            'form': self.form
+            'form': self.form,
+            'non_runner': self.non_runner
         }
         
         if include_form:
-            result['form_lines'] = [fl.to_dict() for fl in self.form_lines]
+            if form_lines is None:
+                form_lines = self.form_lines
+            result['form_lines'] = [fl.to_dict() for fl in form_lines]
         
         return result
 
+class Course(db.Model):
+    """A racecourse and its characteristics"""
+    __tablename__ = 'courses'
+    
+    id = db.Column(CODE, primary_key=True)
+    name = db.Column(db.String(100), nullable=False, unique=True)
+    surface = db.Column(db.String(100))
+    configuration = db.Column(db.String(100))
+    lh_rh = db.Column(db.String(50))  # Left Handed, Right Handed, Other
+    
+    # Row version; with the row count it stamps the in-process course cache
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class LookupValue(db.Model):
+    """One distinct string of a dictionary-encoded form line column"""
+    __tablename__ = 'lookup_values'
+    
+    id = db.Column(CODE, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)  # one of LOOKUP_KINDS
+    value = db.Column(db.String(100), nullable=False)
+    # Numeric form for range filters: yards for distances, GOING_SCALE rank for goings
+    measure = db.Column(db.Integer)
+    
+    __table_args__ = (
+        db.UniqueConstraint('kind', 'value', name='uq_lookup_values_kind_value'),
+    )
+
+course_codes = Dictionary(db, Course.__table__, value_column='name', extra=COURSE_CHARACTERISTIC_KEYS,
+                          version_column='updated_at')
+def _lookup_dictionary(kind):
+    parse = MEASURED_KINDS.get(kind)
+    derive = (lambda value: {'measure': parse(value)}) if parse else None
+    return Dictionary(db, LookupValue.__table__, kind=kind, derive=derive)
+
+lookup_codes = {kind: _lookup_dictionary(kind) for kind in LOOKUP_KINDS}
+
+def lookup_column(kind):
+    """Form line column stored as a code into lookup_values"""
+    return db.Column(kind + '_id', Coded(lookup_codes[kind]), db.ForeignKey('lookup_values.id'), key=kind)
+
+def course_characteristics(course):
+    """Surface, configuration and lh_rh of a course (all None if unknown)"""
+    code = course_codes.code(course)
+    row = course_codes.row(code) if code else None
+    return {key: row[key] if row else None for key in COURSE_CHARACTERISTIC_KEYS}
+
 class FormLine(db.Model):
     """Individual past performance entry for a horse"""
     __tablename__ = 'form_lines'
     
     id = db.Column(db.Integer, primary_key=True)
-    runner_id = db.Column(db.Integer, db.ForeignKey('runners.id'), nullable=False, index=True)
-    
-    # Race details
-    race_date = db.Column(db.Date, index=True)
-    course = db.Column(db.String(100), index=True)
-    distance = db.Column(db.String(50), index=True)
-    going = db.Column(db.String(50), index=True)
-    race_class = db.Column(db.String(50), index=True)
-    race_type = db.Column(db.String(50), index=True)  # Chase, Hurdle, NH Flat, Turf Flat, All Weather
-    race_code = db.Column(db.String(50), index=True)  # Hch, Nvh, Md, etc.
+    horse_id = db.Column(db.Integer, db.ForeignKey('horses.id'), nullable=False)
     
-    # Course characteristics (mapped from course name)
-    surface = db.Column(db.String(100))
-    configuration = db.Column(db.String(100))
-    lh_rh = db.Column(db.String(50))  # Left Handed, Right Handed, Other
+    # Race details. Everything but the date is a small integer code that
+    # reads and compares as its string (see lookups.py).
+    race_date = db.Column(db.Date)
+    course = db.Column('course_id', Coded(course_codes), db.ForeignKey('courses.id'), key='course')
+    distance = lookup_column('distance')
+    going = lookup_column('going')
+    race_class = lookup_column('race_class')
+    race_type = lookup_column('race_type')  # Chase, Hurdle, NH Flat, Turf Flat, All Weather
+    race_code = lookup_column('race_code')  # Hch, Nvh, Md, etc.
     
     # Performance
-    finishing_position = db.Column(db.Integer, index=True)
+    finishing_position = db.Column(db.Integer)
     beaten_distance = db.Column(db.String(20))
     weight_carried = db.Column(db.String(20))
     
@@ -124,6 +245,33 @@ class FormLine(db.Model):
     odds = db.Column(db.String(20))
     comment = db.Column(db.Text)
     
+    # Every form read is "this horse's lines, newest first" (undated lines
+    # last), filtered on a few race details. On Postgres every column the
+    # form filters use is carried in the index with INCLUDE. SQLite cannot
+    # declare NULLS LAST in an index, but its DESC order already puts NULLs
+    # last.
+    __table_args__ = (
+        # One line per horse per race; the conflict target when loading form
+        db.UniqueConstraint('horse_id', 'race_date', 'course', name='uq_form_lines_horse_race'),
+        db.Index('ix_form_lines_horse_date', 'horse_id', race_date.desc().nullslast(), id.desc(),
+                 postgresql_include=['going', 'distance', 'race_class', 'race_type', 'course',
+                                     'finishing_position', 'official_rating']).ddl_if(dialect='postgresql'),
+        db.Index('ix_form_lines_horse_date_sqlite', 'horse_id', race_date.desc(), id.desc())
+        .ddl_if(dialect='sqlite'),
+    )
+    
+    @property
+    def surface(self):
+        return course_characteristics(self.course)['surface']
+    
+    @property
+    def configuration(self):
+        return course_characteristics(self.course)['configuration']
+    
+    @property
+    def lh_rh(self):
+        return course_characteristics(self.course)['lh_rh']
+    
     def to_dict(self):
         return {
             'id': self.id,
@@ -146,3 +294,50 @@ class FormLine(db.Model):
             'odds': self.odds,
             'comment': self.comment
         }
+
+def form_before(race_date):
+    """Criterion for form lines run before race_date (undated lines included)"""
+    return db.or_(FormLine.race_date < race_date, FormLine.race_date.is_(None))
+
+class RunnerFormStat(db.Model):
+    """Per-horse form aggregates for one value of one dimension (e.g. going = Heavy)"""
+    __tablename__ = 'runner_form_stats'
+    
+    horse_id = db.Column(db.Integer, db.ForeignKey('horses.id'), primary_key=True)
+    dimension = db.Column(db.String(20), primary_key=True)  # going, distance, ..., or 'all'
+    value = db.Column(db.String(100), primary_key=True)
+    
+    runs = db.Column(db.Integer, nullable=False, default=0)
+    wins = db.Column(db.Integer, nullable=False, default=0)
+    places = db.Column(db.Integer, nullable=False, default=0)  # finished 1st-3rd
+    
+    best_rpr = db.Column(db.Integer)
+    rpr_total = db.Column(db.Integer, nullable=False, default=0)
+    rpr_runs = db.Column(db.Integer, nullable=False, default=0)
+    best_or = db.Column(db.Integer)
+    
+    def to_dict(self):
+        return {
+            'value': self.value,
+            'runs': self.runs,
+            'wins': self.wins,
+            'places': self.places,
+            'win_rate': round(self.wins / self.runs, 3) if self.runs else None,
+            'place_rate': round(self.places / self.runs, 3) if self.runs else None,
+            'best_rpr': self.best_rpr,
+            'avg_rpr': round(self.rpr_total / self.rpr_runs, 1) if self.rpr_runs else None,
+            'best_or': self.best_or
+        }
+
+class RacecardSnapshot(db.Model):
+    """A date's /api/racecards document, compressed (see racecards.py)"""
+    __tablename__ = 'racecard_snapshots'
+    
+    date = db.Column(db.Date, primary_key=True)
+    form_limit = db.Column(db.SmallInteger, primary_key=True)  # form lines per runner, 0 for none
+    
+    version = db.Column(db.String(40), nullable=False)  # ETag of the races, runners and form it was built from
+    size = db.Column(db.Integer, nullable=False)  # uncompressed bytes
+    gzip = db.Column(db.LargeBinary, nullable=False)
+    brotli = db.Column(db.LargeBinary)  # only when the brotli module is installed
+    built_at = db.Column(db.DateTime, nullable=False)
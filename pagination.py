@@ -0,0 +1,120 @@
+"""
+Keyset (cursor) pagination helpers for list endpoints
+Pages are ordered by a (date, id) pair, so each page is an index range scan
+that costs the same no matter how deep into the history it is
+"""
+
+import base64
+import json
+from datetime import date
+
+from sqlalchemy import and_, or_
+
+DEFAULT_PAGE_SIZE = 200
+MAX_PAGE_SIZE = 1000
+
+
+def encode_cursor(sort_value, row_id):
+    """
+    Encode the sort key of the last row on a page as an opaque cursor string
+
+    Args:
+        sort_value (date): Date column value of the last row (may be None)
+        row_id (int): Primary key of the last row
+
+    Returns:
+        str: URL-safe cursor
+    """
+    payload = [sort_value.isoformat() if sort_value else None, row_id]
+    raw = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor produced by encode_cursor
+
+    Returns:
+        tuple: (date or None, int)
+
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        sort_value, row_id = json.loads(base64.urlsafe_b64decode(padded))
+        sort_value = date.fromisoformat(sort_value) if sort_value else None
+        return sort_value, int(row_id)
+    except (TypeError, ValueError, UnicodeDecodeError):
+        raise ValueError('Invalid cursor')
+
+
+def parse_page_args(args):
+    """
+    Read limit/cursor from request args
+
+    Returns:
+        tuple: (limit, decoded cursor or None)
+
+    Raises:
+        ValueError: If limit or cursor is invalid
+    """
+    limit = args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        raise ValueError('limit must be between 1 and %d' % MAX_PAGE_SIZE)
+
+    cursor = args.get('cursor')
+    return limit, decode_cursor(cursor) if cursor else None
+
+
+def keyset_filter(sort_column, id_column, cursor, descending=False):
+    """
+    Build the WHERE clause selecting rows after the cursor position
+
+    For descending order NULL sort values are treated as sorting last, which
+    matches ordering by sort_column.desc().nullslast()
+    """
+    sort_value, row_id = cursor
+
+    if descending:
+        if sort_value is None:
+            return and_(sort_column.is_(None), id_column < row_id)
+        return or_(
+            sort_column < sort_value,
+            and_(sort_column == sort_value, id_column < row_id),
+            sort_column.is_(None)
+        )
+
+    return or_(
+        sort_column > sort_value,
+        and_(sort_column == sort_value, id_column > row_id)
+    )
+
+
+def keyset_query(query, sort_column, id_column, cursor, descending=False):
+    """Apply keyset ordering, and the cursor position if given, to a query"""
+    if cursor:
+        query = query.filter(keyset_filter(sort_column, id_column, cursor, descending))
+
+    if descending:
+        return query.order_by(sort_column.desc().nullslast(), id_column.desc())
+    return query.order_by(sort_column, id_column)
+
+
+def paginate(query, sort_column, id_column, limit, cursor, descending=False):
+    """
+    Apply keyset ordering/filtering to a query and fetch one page
+
+    Returns:
+        tuple: (rows, next_cursor) where next_cursor is None on the last page
+    """
+    query = keyset_query(query, sort_column, id_column, cursor, descending)
+
+    # Fetch one extra row to find out whether another page exists
+    rows = query.limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, encode_cursor(getattr(last, sort_column.key), getattr(last, id_column.key))
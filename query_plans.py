@@ -0,0 +1,161 @@
+"""
+Query plan regression check for the hot endpoint queries
+
+Runs EXPLAIN for the query shape behind each endpoint and fails if any of
+them falls back to a sequential scan or an explicit sort. Works against
+Postgres and SQLite. tests/test_query_plans.py runs every query as a test
+against the test database; the script checks the database DATABASE_URL
+points at.
+
+Usage: python -m pytest tests/test_query_plans.py
+       python query_plans.py
+"""
+
+import re
+import sys
+from datetime import date
+
+from sqlalchemy import text
+from werkzeug.datastructures import MultiDict
+
+from courses import courses_with_races
+from form_filters import build_form_criteria, build_race_criteria, build_screen_query
+from models import db, Race, FormLine, form_before
+from pagination import keyset_query
+from racecards import form_lines_query, racecard_races_query, racecard_runners_query
+from serializers import serialize_form_line, serialize_race
+
+SAMPLE_DATE = date(2024, 1, 1)
+PAGE_ROWS = 201  # a page of the default size, plus the row that finds the next
+
+
+def races_page(*criteria):
+    """The /api/races page query for criteria"""
+    query = db.session.query(*serialize_race.columns).filter(*criteria)
+    return keyset_query(query, Race.date, Race.id, None).limit(PAGE_ROWS)
+
+
+def form_page(*criteria):
+    """The /api/runners/<id>/form page query for horse 1 with criteria"""
+    query = (db.session.query(*serialize_form_line.columns)
+             .filter(FormLine.horse_id == 1, form_before(SAMPLE_DATE), *criteria))
+    return keyset_query(query, FormLine.race_date, FormLine.id, None, descending=True).limit(PAGE_ROWS)
+
+
+# (name, query builder) for each query an endpoint issues on its hot path,
+# built by the functions the routes call. The cached /api/distances and
+# /api/classes lookups are deliberately absent.
+HOT_QUERIES = [
+    ('racecards races', lambda: racecard_races_query(SAMPLE_DATE)),
+    ('racecards runners', lambda: racecard_runners_query([1, 2, 3])),
+    ('racecards form lines, form_limit', lambda: form_lines_query([1, 2, 3], SAMPLE_DATE, 5)),
+    ('races page', lambda: races_page()),
+    ('races page by date', lambda: races_page(Race.date == SAMPLE_DATE)),
+    ('races page by course', lambda: races_page(Race.course == 'Ascot')),
+    ('races page by distance and going',
+     lambda: races_page(*build_race_criteria(MultiDict([('min_distance', '2m'), ('max_distance', '2m4f'),
+                                                        ('going_min', 'Soft')])))),
+    ('races page by surface',
+     lambda: races_page(*build_race_criteria(MultiDict([('surface', 'Flat')])))),
+    ('race detail runners', lambda: racecard_runners_query([1])),
+    ('race detail form lines', lambda: form_lines_query([1, 2, 3], SAMPLE_DATE)),
+    ('runner form page', lambda: form_page()),
+    ('runner form filtered',
+     lambda: form_page(*build_form_criteria(MultiDict([('going', 'Soft,Heavy'), ('class', 'Class 2'),
+                                                       ('lh_rh', 'Left Handed'), ('min_position', '1'),
+                                                       ('max_position', '3'),
+                                                       ('date_from', '2023-01-01')])))),
+    ('runner form by distance and going',
+     lambda: form_page(*build_form_criteria(MultiDict([('min_distance', '2m'),
+                                                       ('going_max', 'Good to Soft')])))),
+    ('screen runners',
+     lambda: build_screen_query(SAMPLE_DATE, build_form_criteria(MultiDict([('going', 'Soft'),
+                                                                           ('lh_rh', 'Left Handed')])),
+                                within_days=365, min_wins=1)),
+    ('courses lookup', lambda: courses_with_races()),
+]
+
+# Only table scans count as a regression for these:
+#  - grouped queries sort their (one row per runner) output by design
+#  - a range on an indexed measure or a set of courses sorts the rows it
+#    selects into page order
+#  - runners found by race_id through the natural key are sorted into
+#    entry (id) order, a few dozen rows per race; a (race_id, id) index
+#    would cost every runner write to save that
+#  - the form_limit query sorts only the ranked lines it keeps (form_limit
+#    per horse); the ranking itself reads ix_form_lines_horse_date in order
+SORT_ALLOWED = {'screen runners', 'races page by distance and going', 'races page by surface',
+                'racecards runners', 'race detail runners', 'racecards form lines, form_limit'}
+
+SQLITE_SCAN = re.compile(r'^SCAN (races|runners|form_lines)$')
+SQLITE_SORT = re.compile(r'USE TEMP B-TREE')
+POSTGRES_SCAN = re.compile(r'Seq Scan on (races|runners|form_lines)')
+POSTGRES_SORT = re.compile(r'(^|->  )(Sort|Incremental Sort)\b')
+
+
+def explain(query):
+    """Return the plan lines for a query on the current connection"""
+    dialect = db.engine.dialect
+    sql = str(query.statement.compile(dialect=dialect, compile_kwargs={'literal_binds': True}))
+
+    if dialect.name == 'sqlite':
+        rows = db.session.execute(text('EXPLAIN QUERY PLAN ' + sql)).all()
+        return [row[-1] for row in rows]
+
+    rows = db.session.execute(text('EXPLAIN ' + sql)).all()
+    return [row[0].strip() for row in rows]
+
+
+def penalise_scans():
+    """
+    On Postgres, make seq scans and sorts look expensive for the rest of the
+    transaction. Small test tables make them look cheap, so without this the
+    plan reflects table size rather than which indexes exist.
+    """
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(text('SET LOCAL enable_seqscan = off'))
+        db.session.execute(text('SET LOCAL enable_sort = off'))
+
+
+def regressed(name, plan):
+    """True if a hot query's plan scans a table, or sorts where it should not"""
+    if db.engine.dialect.name == 'postgresql':
+        scan_pattern, sort_pattern = POSTGRES_SCAN, POSTGRES_SORT
+    else:
+        scan_pattern, sort_pattern = SQLITE_SCAN, SQLITE_SORT
+    patterns = [scan_pattern] if name in SORT_ALLOWED else [scan_pattern, sort_pattern]
+    return any(pattern.search(line) for pattern in patterns for line in plan)
+
+
+def check_plans():
+    """
+    EXPLAIN every hot query
+
+    Returns:
+        list: (name, plan lines) for each query whose plan regressed
+    """
+    penalise_scans()
+    failures = []
+    for name, build in HOT_QUERIES:
+        plan = explain(build())
+        if regressed(name, plan):
+            failures.append((name, plan))
+
+    db.session.rollback()
+    return failures
+
+
+if __name__ == '__main__':
+    from app import app
+
+    with app.app_context():
+        db.create_all()
+        failures = check_plans()
+
+    for name, plan in failures:
+        print('FAIL %s' % name)
+        for line in plan:
+            print('    ' + line)
+
+    print('%d of %d hot queries regressed' % (len(failures), len(HOT_QUERIES)))
+    sys.exit(1 if failures else 0)
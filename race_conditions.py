@@ -0,0 +1,106 @@
+"""
+Canonical forms of race distances and going descriptions
+
+Distances arrive as strings like "2m4f", "1m2f110y" or "7f 3y" and are
+normalised to yards. Going descriptions ("Good to Soft", "GS", "Soft
+(Heavy in places)") are placed on an ordinal scale from firmest to
+softest, so both can be stored as numbers and filtered with ranges.
+"""
+
+import re
+
+YARDS_PER_MILE = 1760
+YARDS_PER_FURLONG = 220
+
+# Firmest to softest. Irish "yielding" sits with good to soft, and the
+# all-weather goings share the scale with their turf equivalents.
+GOING_SCALE = {
+    'hard': 10,
+    'firm': 20,
+    'fast': 25,
+    'good to firm': 30,
+    'standard to fast': 35,
+    'good': 40,
+    'standard': 40,
+    'good to yielding': 45,
+    'standard to slow': 45,
+    'good to soft': 50,
+    'yielding': 50,
+    'slow': 50,
+    'yielding to soft': 55,
+    'soft': 60,
+    'soft to heavy': 70,
+    'heavy': 80,
+}
+
+GOING_ABBREVIATIONS = {
+    'hd': 'hard', 'f': 'firm', 'fm': 'firm', 'gf': 'good to firm', 'g': 'good', 'gd': 'good',
+    'gy': 'good to yielding', 'gs': 'good to soft', 'y': 'yielding', 'yld': 'yielding',
+    'ys': 'yielding to soft', 's': 'soft', 'sft': 'soft', 'sh': 'soft to heavy', 'h': 'heavy',
+    'hvy': 'heavy', 'std': 'standard', 'sf': 'standard to fast', 'ss': 'standard to slow',
+    'slw': 'slow', 'fst': 'fast',
+}
+
+_DISTANCE_PART = re.compile(r'(\d+(?:\.\d+)?)?\s*(½)?\s*(miles?|m|furlongs?|f|yards?|yds?|y)(?![a-z])')
+_DISTANCE_UNITS = {'m': YARDS_PER_MILE, 'f': YARDS_PER_FURLONG, 'y': 1}
+
+
+def parse_distance(text):
+    """
+    Convert a distance string to yards
+
+    Args:
+        text (str): e.g. "2m4f", "1m 2½f", "5f 110y", "2 miles"
+
+    Returns:
+        int: Distance in yards, or None if text is not a distance
+    """
+    if not text:
+        return None
+    text = text.strip().lower()
+
+    yards, end = 0.0, 0
+    for match in _DISTANCE_PART.finditer(text):
+        if text[end:match.start()].strip():
+            return None
+        number, half, unit = match.groups()
+        if number is None and half is None:
+            return None
+        amount = float(number or 0) + (0.5 if half else 0)
+        yards += amount * _DISTANCE_UNITS[unit[0]]
+        end = match.end()
+
+    if end == 0 or text[end:].strip():
+        return None
+    return int(round(yards))
+
+
+def parse_going(text):
+    """
+    Place a going description on GOING_SCALE
+
+    Only the main description counts; "Good to Soft (Soft in places)" and
+    "Good to Soft, Soft in places" are both good to soft. "to" may be written
+    as "/" or "-", and either side may be abbreviated ("Gd/Sft", "Good-Soft").
+
+    Returns:
+        int: Rank on GOING_SCALE, or None if the going is not recognised
+    """
+    if not text:
+        return None
+    main = re.split(r'[(,;]', text, maxsplit=1)[0].strip().lower()
+    parts = [re.sub(r'\s+', ' ', part) for part in re.split(r'\s*(?:[/-]|\bto\b)\s*', main) if part]
+    # "G/S" is a two-letter code as a whole before it is two goings
+    whole = GOING_ABBREVIATIONS.get(''.join(parts))
+    if whole:
+        return GOING_SCALE[whole]
+    return GOING_SCALE.get(' to '.join(GOING_ABBREVIATIONS.get(part, part) for part in parts))
+
+
+def add_measures(row):
+    """Add distance_yards/going_rank to a race row for whichever of distance/going it has"""
+    if 'distance' in row:
+        row['distance_yards'] = parse_distance(row['distance'])
+    if 'going' in row:
+        row['going_rank'] = parse_going(row['going'])
+    return row
@@ -0,0 +1,325 @@
+"""
+Racecard documents and their compressed snapshots
+
+/api/racecards?date= returns the same document for a date until its races
+or runners change, so each (date, form_limit) document is built once and
+stored in racecard_snapshots gzip-compressed, and brotli-compressed too
+when the brotli module is installed. Requests are answered with the stored
+bytes and the matching Content-Encoding, which compression.py leaves
+as they are.
+
+A snapshot is deleted in the same transaction as any change to the races,
+runners or form lines it was built from (ingest, refresh and ORM flushes)
+and rebuilt by the next request. Dates in the live window (LIVE_DAYS ago
+onwards, where declarations and non-runners still change) are also
+rebuilt in a background thread once the change commits, and checked
+against the cheap per-date version on every request. Older dates are
+served with a single snapshot read.
+"""
+
+import gzip
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, func, inspect, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from compression import brotli, compress
+from http_cache import make_etag, not_modified, representation_etag, with_validators
+from models import db, Race, Runner, FormLine, RacecardSnapshot, form_before
+from serializers import serialize_race, serialize_runner, serialize_form_line
+
+# Days back from today whose cards can still change
+LIVE_DAYS = 1
+
+# Largest per-runner form_limit kept as a snapshot
+MAX_FORM_LIMIT = 20
+
+# Built once per change, so worth higher levels than compression.py uses
+# for responses compressed per request
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 9
+
+# One encoding of a snapshot; body is gzip-compressed when encoding is None
+Snapshot = namedtuple('Snapshot', 'version body encoding')
+
+
+def form_lines_query(horse_ids, race_date, form_limit=None):
+    """
+    The form of many horses going into a race, by horse and most recent
+    first. When form_limit is set, only the latest form_limit lines per
+    horse are selected, ranked in SQL with ROW_NUMBER() over each horse's
+    history.
+    """
+    if form_limit:
+        ranked = (db.session.query(
+                      *serialize_form_line.columns,
+                      func.row_number().over(
+                          partition_by=FormLine.horse_id,
+                          order_by=(FormLine.race_date.desc(), FormLine.id.desc())
+                      ).label('rn'))
+                  .filter(FormLine.horse_id.in_(horse_ids), form_before(race_date))
+                  .subquery())
+        return (db.session.query(*serialize_form_line.columns_from(ranked))
+                .filter(ranked.c.rn <= form_limit)
+                .order_by(ranked.c.horse_id, ranked.c.rn))
+    return (db.session.query(*serialize_form_line.columns)
+            .filter(FormLine.horse_id.in_(horse_ids), form_before(race_date))
+            .order_by(FormLine.horse_id, FormLine.race_date.desc(), FormLine.id.desc()))
+
+
+def load_form_lines(horse_ids, race_date, form_limit=None):
+    """
+    Fetch the form of many horses going into a race in one statement (see
+    form_lines_query)
+    Returns a dict of horse_id -> list of serialised form lines
+    """
+    form_by_horse = {horse_id: [] for horse_id in horse_ids}
+    if not horse_ids:
+        return form_by_horse
+
+    rows = form_lines_query(horse_ids, race_date, form_limit).all()
+    for row in rows:
+        form_by_horse[row.horse_id].append(serialize_form_line(row))
+    return form_by_horse
+
+
+def is_live(race_date):
+    return race_date >= date.today() - timedelta(days=LIVE_DAYS)
+
+
+def racecard_version(race_date, form_limit=0):
+    """
+    ETag of a date's racecards, from one aggregate over the day's races
+    and runners, and with form_limit set a second over the card's horses'
+    form before the date (as get_race_detail versions form). There is no
+    Last-Modified: removed runners and new form lines move no timestamp.
+
+    Returns:
+        str: The ETag
+    """
+    race_count, races_updated, runner_count, runners_updated = (
+        db.session.query(func.count(func.distinct(Race.id)), func.max(Race.updated_at),
+                         func.count(Runner.id), func.max(Runner.updated_at))
+        .select_from(Race)
+        .outerjoin(Runner, Runner.race_id == Race.id)
+        .filter(Race.date == race_date)
+        .one())
+    form_count = max_form_id = None
+    if form_limit:
+        card_horses = (select(Runner.horse_id).join(Race, Race.id == Runner.race_id)
+                       .where(Race.date == race_date))
+        form_count, max_form_id = (
+            db.session.query(func.count(FormLine.id), func.max(FormLine.id))
+            .filter(FormLine.horse_id.in_(card_horses), form_before(race_date))
+            .one())
+    return make_etag(race_date.isoformat(), race_count, races_updated, runner_count,
+                     runners_updated, form_count, max_form_id, form_limit)
+
+
+def racecard_races_query(race_date):
+    """A date's races in post time order"""
+    return (db.session.query(*serialize_race.columns)
+            .filter(Race.date == race_date)
+            .order_by(Race.race_time))
+
+
+def racecard_runners_query(race_ids):
+    """The runners of a set of races, race by race"""
+    return (db.session.query(*serialize_runner.columns)
+            .filter(Runner.race_id.in_(race_ids))
+            .order_by(Runner.race_id, Runner.id))
+
+
+def build_racecards(race_date, form_limit=0):
+    """
+    The /api/racecards document for a date: every race with its runners,
+    and each runner's latest form_limit form lines when form_limit is set
+    """
+    # Load every race on the card and all of its runners in two statements
+    # (races, then all their runners) rather than one query per race
+    races = racecard_races_query(race_date).all()
+
+    runners_by_race = {race.id: [] for race in races}
+    runner_rows = []
+    if races:
+        runner_rows = racecard_runners_query(list(runners_by_race)).all()
+
+    form_by_horse = {}
+    if form_limit:
+        form_by_horse = load_form_lines(list({row.horse_id for row in runner_rows}),
+                                        race_date, form_limit)
+    for row in runner_rows:
+        runner = serialize_runner(row)
+        if form_limit:
+            runner['form_lines'] = form_by_horse[row.horse_id]
+        runners_by_race[row.race_id].append(runner)
+
+    racecards = [{'race': serialize_race(race), 'runners': runners_by_race[race.id]}
+                 for race in races]
+    return {
+        'date': race_date.isoformat(),
+        'count': len(racecards),
+        'racecards': racecards
+    }
+
+
+def build_snapshot(race_date, form_limit=0):
+    """
+    Build, compress and store a date's racecards, committing the snapshot
+
+    Returns:
+        dict: The racecard_snapshots row
+    """
+    version = racecard_version(race_date, form_limit)
+    body = current_app.json.dumps(build_racecards(race_date, form_limit))
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    row = {
+        'date': race_date,
+        'form_limit': form_limit,
+        'version': version,
+        'size': len(body),
+        'gzip': compress(body, 'gzip', GZIP_LEVEL),
+        'brotli': compress(body, 'br', BROTLI_QUALITY) if brotli else None,
+        'built_at': datetime.utcnow(),
+    }
+
+    table = RacecardSnapshot.__table__
+    insert = postgresql.insert if db.session.get_bind().dialect.name == 'postgresql' else sqlite.insert
+    stmt = insert(table)
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=['date', 'form_limit'],
+        set_={column: stmt.excluded[column] for column in row if column not in ('date', 'form_limit')}),
+        row)
+    db.session.commit()
+    return row
+
+
+def read_snapshot(race_date, form_limit, encoding):
+    """
+    The stored snapshot of a date, reading only the body for an encoding
+    ('br', 'gzip', or None for identity, which is kept as gzip until sent)
+
+    Returns:
+        Snapshot: or None if there is none
+    """
+    table = RacecardSnapshot.__table__
+    body_column = table.c.brotli if encoding == 'br' else table.c.gzip
+    row = db.session.execute(
+        select(table.c.version, body_column)
+        .where(table.c.date == race_date, table.c.form_limit == form_limit)).first()
+    if row is None:
+        return None
+    if row[1] is None:  # built where the brotli module was missing
+        return read_snapshot(race_date, form_limit, 'gzip')
+    return Snapshot(row[0], row[1], encoding)
+
+
+def stored_snapshot(row, encoding):
+    """A Snapshot of a build_snapshot() row for an encoding"""
+    if encoding == 'br' and row['brotli'] is not None:
+        return Snapshot(row['version'], row['brotli'], 'br')
+    return Snapshot(row['version'], row['gzip'], encoding and 'gzip')
+
+
+def snapshot_response(snapshot):
+    """The snapshot as sent, or 304 if the client has it already"""
+    response = not_modified(snapshot.version)
+    if response is None:
+        etag = representation_etag(snapshot.version, snapshot.encoding)
+        body = snapshot.body if snapshot.encoding else gzip.decompress(snapshot.body)
+        response = current_app.response_class(body, mimetype='application/json')
+        if snapshot.encoding:
+            response.headers['Content-Encoding'] = snapshot.encoding
+        response = with_validators(response, etag)
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def _delete_snapshots(session, criteria):
+    session.execute(RacecardSnapshot.__table__.delete().where(*criteria))
+
+
+def _note_rebuild(session, dates):
+    live = {race_date for race_date in dates if race_date is not None and is_live(race_date)}
+    if live:
+        session.info.setdefault('snapshot_dates', set()).update(live)
+
+
+def invalidate_snapshots(session, dates):
+    """Drop the snapshots of dates whose races or runners changed"""
+    dates = {race_date for race_date in dates if race_date is not None}
+    if not dates:
+        return
+    _delete_snapshots(session, [RacecardSnapshot.date.in_(dates)])
+    _note_rebuild(session, dates)
+
+
+def invalidate_form_snapshots(session, race_dates):
+    """Drop the snapshots with form that form lines run on race_dates appear in"""
+    race_dates = set(race_dates)
+    if not race_dates:
+        return
+    criteria = [RacecardSnapshot.form_limit > 0]
+    if None not in race_dates:  # undated lines appear in every date's form
+        criteria.append(RacecardSnapshot.date > min(race_dates))
+    _delete_snapshots(session, criteria)
+
+
+@event.listens_for(Session, 'after_flush')
+def _invalidate_on_flush(session, flush_context):
+    # Same pattern as cache.py, but the snapshots live in the database, so
+    # they are deleted here, inside the transaction making the change
+    changed = list(session.new) + list(session.dirty) + list(session.deleted)
+    dates, race_ids, form_dates = set(), set(), set()
+    for obj in changed:
+        if isinstance(obj, Race):
+            history = inspect(obj).attrs.date.history
+            dates.update(history.added or [obj.date])
+            dates.update(history.deleted or [])
+        elif isinstance(obj, Runner):
+            race_ids.add(obj.race_id)
+        elif isinstance(obj, FormLine):
+            form_dates.add(obj.race_date)
+    race_ids.discard(None)
+    if race_ids:
+        dates.update(session.execute(select(Race.date).where(Race.id.in_(race_ids))).scalars())
+    invalidate_snapshots(session, dates)
+    invalidate_form_snapshots(session, form_dates)
+
+
+_rebuilds = None
+_rebuilds_lock = threading.Lock()
+
+
+def _rebuild(app, dates):
+    with app.app_context():
+        for race_date in sorted(dates):
+            try:
+                build_snapshot(race_date)
+            except Exception:
+                db.session.rollback()
+                app.logger.exception('racecard snapshot rebuild failed for %s', race_date)
+
+
+@event.listens_for(Session, 'after_commit')
+def _rebuild_on_commit(session):
+    global _rebuilds
+    dates = session.info.pop('snapshot_dates', None)
+    if not dates or not has_app_context():
+        return
+    with _rebuilds_lock:
+        if _rebuilds is None:
+            # One thread, so rebuilds of the same date run in commit order
+            _rebuilds = ThreadPoolExecutor(max_workers=1, thread_name_prefix='racecard-snapshots')
+    _rebuilds.submit(_rebuild, current_app._get_current_object(), dates)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_on_rollback(session):
+    session.info.pop('snapshot_dates', None)
@@ -0,0 +1,150 @@
+"""
+Incremental refresh of declarations, non-runners and odds
+
+Races and runners are upserted on their natural keys (date, course,
+race_time) and (race_id, horse_name) with INSERT ... ON CONFLICT DO UPDATE.
+Only the columns present in the input are written, and a row is only
+rewritten when one of them actually changed, so a refresh never touches
+form_lines and unchanged rows cost no writes. A batch that changes
+anything drops the racecard snapshots of its dates (see racecards.py).
+
+Input is the same JSONL race card format as `flask ingest`; any nested
+form_lines are ignored. A race or runner repeated within a batch is
+merged into one row first, later records overriding the fields they
+carry, since one upsert statement cannot change a row twice.
+
+Usage: flask --app app refresh odds.jsonl
+"""
+
+import time
+from datetime import datetime
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import or_, tuple_
+
+from cache import invalidate_lookups
+from ingest import (DEFAULT_BATCH_SIZE, RACE_FIELDS, RACE_KEY, RUNNER_FIELDS, RUNNER_KEY, IngestError,
+                    batched, clean_record, read_jsonl, resolve_horses, resolve_race_courses,
+                    upsert_insert)
+from models import db, Race, Runner
+from race_conditions import add_measures
+from racecards import invalidate_snapshots
+
+
+def upsert(model, rows, key):
+    """
+    Upsert rows on a unique key, one statement per distinct column set
+
+    Returns:
+        int: Number of rows inserted or changed
+    """
+    insert = upsert_insert()
+    table = model.__table__
+
+    groups = {}
+    for row in rows:
+        groups.setdefault(tuple(sorted(row)), []).append(row)
+
+    changed = 0
+    for columns, group in groups.items():
+        stmt = insert(table)
+        updates = [column for column in columns if column not in key]
+        if not updates:
+            stmt = stmt.on_conflict_do_nothing(index_elements=list(key))
+        else:
+            set_ = {column: stmt.excluded[column] for column in updates}
+            set_['updated_at'] = datetime.utcnow()
+            stmt = stmt.on_conflict_do_update(
+                index_elements=list(key),
+                set_=set_,
+                # Skip the write entirely when nothing differs
+                where=or_(*[table.c[column].is_distinct_from(stmt.excluded[column])
+                            for column in updates]))
+        # RETURNING yields only rows that were inserted or actually updated
+        changed += len(db.session.execute(stmt.returning(table.c.id), group).all())
+    return changed
+
+
+def refresh_batch(batch, stats):
+    """Upsert one batch of race cards and their runners"""
+    races = {}  # race key -> (race row, {horse_name: runner row})
+    for line_no, record in batch:
+        try:
+            if isinstance(record, Exception):
+                raise record
+            race_row = add_measures(clean_record(record, RACE_FIELDS, required=RACE_KEY,
+                                                 present_only=True))
+            runner_rows = [clean_record(runner, RUNNER_FIELDS, required=('horse_name',),
+                                        present_only=True)
+                           for runner in record.get('runners') or []]
+        except IngestError as e:
+            stats['skipped'] += 1
+            click.echo('line %d skipped: %s' % (line_no, e), err=True)
+            continue
+        merged_race, merged_runners = races.setdefault(
+            tuple(race_row[column] for column in RACE_KEY), ({}, {}))
+        merged_race.update(race_row)
+        for runner_row in runner_rows:
+            merged_runners.setdefault(runner_row['horse_name'], {}).update(runner_row)
+
+    race_rows = [race_row for race_row, _ in races.values()]
+    runner_groups = [list(runners.values()) for _, runners in races.values()]
+
+    resolve_race_courses(race_rows)
+    races_changed = upsert(Race, race_rows, RACE_KEY)
+    stats['races'] += races_changed
+
+    # Map natural keys back to ids, including races that were unchanged
+    keys = {tuple(row[column] for column in RACE_KEY) for row in race_rows}
+    race_ids = dict(((race.date, race.course, race.race_time), race.id) for race in
+                    db.session.query(Race.id, Race.date, Race.course, Race.race_time)
+                    .filter(tuple_(Race.date, Race.course, Race.race_time).in_(keys)))
+
+    horse_ids = resolve_horses(runner['horse_name'] for runners in runner_groups for runner in runners)
+
+    runner_rows = []
+    for race_row, runners in zip(race_rows, runner_groups):
+        race_id = race_ids[tuple(race_row[column] for column in RACE_KEY)]
+        runner_rows.extend(dict(runner, race_id=race_id, horse_id=horse_ids[runner['horse_name']])
+                           for runner in runners)
+    runners_changed = upsert(Runner, runner_rows, RUNNER_KEY)
+    stats['runners'] += runners_changed
+    if races_changed or runners_changed:
+        invalidate_snapshots(db.session, {row['date'] for row in race_rows})
+
+
+def refresh_file(path, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Apply a JSONL race card file as an incremental refresh
+
+    Returns:
+        dict: Races and runners inserted or changed, skipped records and
+        elapsed seconds
+    """
+    stats = {'races': 0, 'runners': 0, 'skipped': 0}
+    started = time.perf_counter()
+    for batch in batched(read_jsonl(path), batch_size):
+        try:
+            refresh_batch(batch, stats)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+    if stats['races']:
+        invalidate_lookups()
+    stats['seconds'] = time.perf_counter() - started
+    return stats
+
+
+@click.command('refresh')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--batch-size', default=DEFAULT_BATCH_SIZE, show_default=True,
+              help='Races per transaction')
+@with_appcontext
+def refresh_command(path, batch_size):
+    """Upsert declarations, non-runners and odds from a race card file (.jsonl)"""
+    stats = refresh_file(path, batch_size)
+    click.echo('Changed %d races, %d runners (%d skipped) in %.2fs'
+               % (stats['races'], stats['runners'], stats['skipped'], stats['seconds']))
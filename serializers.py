@@ -0,0 +1,88 @@
+"""
+Column-projected serialisation for read-only endpoints
+
+Read-only routes select plain columns instead of ORM instances, so no
+objects are hydrated or tracked in the identity map, and turn each row into
+the same dict the model's to_dict() would produce. orjson, if installed,
+is plugged in as Flask's JSON provider.
+"""
+
+from datetime import date
+
+from flask.json.provider import DefaultJSONProvider, JSONProvider
+
+from models import Race, Runner, FormLine, course_characteristics
+
+try:
+    import orjson
+except ImportError:  # optional speed-up, the stdlib encoder is used without it
+    orjson = None
+
+# Columns behind the keys emitted by each model's to_dict(). Form lines
+# also carry their course's characteristics, filled in from the course.
+RACE_KEYS = ['id', 'date', 'course', 'race_time', 'race_name', 'distance', 'race_class',
+             'going', 'prize', 'age_restriction']
+RUNNER_KEYS = ['id', 'horse_name', 'age', 'weight', 'draw', 'jockey', 'trainer',
+               'official_rating', 'rpr', 'ts', 'odds', 'form', 'non_runner']
+FORM_LINE_KEYS = ['id', 'race_date', 'course', 'distance', 'going', 'race_class', 'race_type',
+                  'race_code', 'finishing_position', 'beaten_distance', 'weight_carried',
+                  'official_rating', 'rpr', 'jockey', 'odds', 'comment']
+
+
+class RowSerializer:
+    """
+    Precompiled row -> dict converter for one model
+
+    columns is the select list for a projected query; __call__ converts a
+    Row from that query. Extra columns (e.g. foreign keys used for grouping)
+    can be selected with extra= and are read from the row but not emitted.
+    derive, if given, maps the converted dict to further keys to add.
+    """
+
+    def __init__(self, model, keys, extra=(), derive=None):
+        self.keys = list(keys)
+        self.derive = derive
+        self.columns = [getattr(model, key) for key in self.keys]
+        self.columns += [getattr(model, key) for key in extra]
+        mapper_columns = model.__table__.columns
+        self._dates = [i for i, key in enumerate(self.keys)
+                       if mapper_columns[key].type.python_type is date]
+
+    def columns_from(self, selectable):
+        """Select list reading the same columns from a subquery"""
+        return [selectable.c[column.key] for column in self.columns]
+
+    def __call__(self, row):
+        values = list(row[:len(self.keys)])
+        for i in self._dates:
+            if values[i] is not None:
+                values[i] = values[i].isoformat()
+        result = dict(zip(self.keys, values))
+        if self.derive is not None:
+            result.update(self.derive(result))
+        return result
+
+
+serialize_race = RowSerializer(Race, RACE_KEYS)
+serialize_runner = RowSerializer(Runner, RUNNER_KEYS, extra=['race_id', 'horse_id'])
+serialize_form_line = RowSerializer(FormLine, FORM_LINE_KEYS, extra=['horse_id'],
+                                    derive=lambda form: course_characteristics(form['course']))
+
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson, keeping Flask's sorted-key output"""
+
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=DefaultJSONProvider.default, option=option).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+def install_json_provider(app):
+    """Use orjson for jsonify and streamed bodies when it is installed"""
+    if orjson is not None:
+        app.json = OrjsonProvider(app)
@@ -0,0 +1,51 @@
+"""
+Streaming responses for large result sets
+Rows are pulled from the database in chunks with yield_per and written out
+as they are serialised, so memory stays flat however many rows match
+"""
+
+from flask import current_app, request, stream_with_context
+
+NDJSON = 'application/x-ndjson'
+STREAM_CHUNK_SIZE = 1000
+
+
+def wants_stream():
+    """True if the client asked for ?stream=1 or an NDJSON body"""
+    return request.args.get('stream') in ('1', 'true') or wants_ndjson()
+
+
+def wants_ndjson():
+    best = request.accept_mimetypes.best_match(['application/json', NDJSON])
+    return best == NDJSON
+
+
+def _json_chunks(key, items):
+    dumps = current_app.json.dumps
+    yield '{"%s":[' % key
+    count = 0
+    for item in items:
+        yield (',' if count else '') + dumps(item)
+        count += 1
+    yield '],"count":%d}' % count
+
+
+def _ndjson_chunks(items):
+    dumps = current_app.json.dumps
+    for item in items:
+        yield dumps(item) + '\n'
+
+
+def stream_response(query, key, serialize):
+    """
+    Stream every row of query, serialised with serialize(row)
+
+    The body is {"<key>": [...], "count": N} as JSON, or one object per
+    line when the client accepts application/x-ndjson.
+    """
+    items = (serialize(row) for row in query.yield_per(STREAM_CHUNK_SIZE))
+    if wants_ndjson():
+        body, mimetype = _ndjson_chunks(items), NDJSON
+    else:
+        body, mimetype = _json_chunks(key, items), 'application/json'
+    return current_app.response_class(stream_with_context(body), mimetype=mimetype)
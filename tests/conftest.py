@@ -0,0 +1,51 @@
+"""
+Shared fixtures: an app on a throwaway database with the current schema
+
+The database is a temporary SQLite file, or TEST_DATABASE_URL when set
+(e.g. a local Postgres to check its query plans). Its tables are dropped
+when the session ends, so never point TEST_DATABASE_URL at data you want
+to keep.
+
+Run from the repository root: python -m pytest
+"""
+
+import os
+
+import pytest
+
+# app.py builds a module-level app on import; it never connects, and the
+# tests use their own app from create_app()
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+import lookups
+from app import create_app
+from migrations import migrate
+from models import db
+
+
+@pytest.fixture(scope='session')
+def app(tmp_path_factory):
+    url = os.getenv('TEST_DATABASE_URL') or 'sqlite:///%s' % tmp_path_factory.mktemp('db').joinpath('test.sqlite')
+    app = create_app({'SQLALCHEMY_DATABASE_URI': url, 'TESTING': True})
+
+    # Lookup tables only change through the tests' own ingest, so keep the
+    # dictionaries from re-checking their versions mid-test
+    version_check_seconds = lookups.VERSION_CHECK_SECONDS
+    lookups.VERSION_CHECK_SECONDS = 3600
+    for dictionary in lookups._dictionaries:
+        dictionary.clear()
+
+    with app.app_context():
+        migrate()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+    lookups.VERSION_CHECK_SECONDS = version_check_seconds
+    for dictionary in lookups._dictionaries:
+        dictionary.clear()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
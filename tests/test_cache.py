@@ -0,0 +1,72 @@
+"""
+RedisCache against a dict-backed stand-in for the Redis client
+"""
+
+import pytest
+
+import cache
+from cache import RedisCache, cached_lookup, invalidate_lookups
+
+
+class FakeRedis:
+    """The get/setex/incr subset of redis.Redis that RedisCache uses"""
+
+    def __init__(self):
+        self.values = {}
+        self.ttls = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def setex(self, key, ttl, value):
+        self.values[key] = value.encode('utf-8') if isinstance(value, str) else value
+        self.ttls[key] = ttl
+
+    def incr(self, key):
+        self.values[key] = str(int(self.values.get(key, b'0')) + 1).encode('ascii')
+        return int(self.values[key])
+
+
+@pytest.fixture
+def server():
+    return FakeRedis()
+
+
+def test_round_trip_and_ttl(server):
+    redis_cache = RedisCache(server, ttl=60)
+    assert redis_cache.get('goings') is None
+    redis_cache.set('goings', ['Good', 'Soft'])
+    assert redis_cache.get('goings') == ['Good', 'Soft']
+    assert set(server.ttls.values()) == {60}
+    assert (redis_cache.stats()['hits'], redis_cache.stats()['misses']) == (1, 1)
+
+
+def test_clear_bumps_the_generation_for_every_worker(server):
+    worker, other_worker = RedisCache(server), RedisCache(server)
+    worker.set('courses', {'courses': ['Ascot']})
+    assert other_worker.get('courses') == {'courses': ['Ascot']}
+
+    other_worker.clear()
+    assert server.get('hrf:lookup:gen') == b'1'
+    assert worker.get('courses') is None
+    assert other_worker.get('courses') is None
+
+    worker.set('courses', {'courses': ['Ascot', 'York']})
+    assert other_worker.get('courses') == {'courses': ['Ascot', 'York']}
+
+
+def test_invalidate_lookups_clears_the_shared_cache(server, monkeypatch):
+    monkeypatch.setattr(cache, 'lookup_cache', RedisCache(server))
+    loads = []
+
+    def load():
+        loads.append(1)
+        return ['Class 1']
+
+    assert cached_lookup('classes', load) == ['Class 1']
+    assert cached_lookup('classes', load) == ['Class 1']
+    assert len(loads) == 1
+
+    invalidate_lookups()
+    cached_lookup('classes', load)
+    assert len(loads) == 2
@@ -0,0 +1,64 @@
+"""
+Race details and racecards revalidate by ETag, which moves with new form
+"""
+
+import csv
+import json
+from datetime import date
+
+import pytest
+
+from ingest import ingest_file
+from models import Race
+
+RACE_DAY = date(2024, 5, 1)
+HORSE = 'Validator Horse'
+
+
+@pytest.fixture(scope='module')
+def race_id(app, tmp_path_factory):
+    path = tmp_path_factory.mktemp('validators').joinpath('card.jsonl')
+    path.write_text(json.dumps({
+        'date': RACE_DAY.isoformat(), 'course': 'Ascot', 'race_time': '14:00',
+        'runners': [{'horse_name': HORSE, 'form_lines': [
+            {'race_date': '2024-01-05', 'course': 'Ascot', 'finishing_position': 2}]}],
+    }) + '\n', encoding='utf-8')
+    ingest_file(str(path))
+    return Race.query.filter_by(date=RACE_DAY).one().id
+
+
+def add_form_line(tmp_path, race_date):
+    path = tmp_path.joinpath('form.csv')
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, ['horse_name', 'race_date', 'course', 'finishing_position'])
+        writer.writeheader()
+        writer.writerow({'horse_name': HORSE, 'race_date': race_date, 'course': 'Ascot',
+                         'finishing_position': 1})
+    assert ingest_file(str(path))['form_lines'] == 1
+
+
+def test_new_form_line_changes_race_detail(client, race_id, tmp_path):
+    url = '/api/races/%d' % race_id
+    first = client.get(url)
+    assert 'Last-Modified' not in first.headers
+    etag = first.headers['ETag']
+    assert client.get(url, headers={'If-None-Match': etag}).status_code == 304
+
+    add_form_line(tmp_path, '2024-02-10')
+    response = client.get(url, headers={'If-None-Match': etag,
+                                        'If-Modified-Since': 'Wed, 01 Jan 2031 00:00:00 GMT'})
+    assert response.status_code == 200
+    assert len(response.get_json()['runners'][0]['form_lines']) == 2
+    assert client.get(url, headers={'If-Modified-Since': 'Wed, 01 Jan 2031 00:00:00 GMT'}).status_code == 200
+
+
+def test_new_form_line_changes_racecards(client, race_id, tmp_path):
+    url = '/api/racecards?date=%s&form_limit=5' % RACE_DAY.isoformat()
+    first = client.get(url)
+    assert 'Last-Modified' not in first.headers
+    etag = first.headers['ETag']
+
+    add_form_line(tmp_path, '2024-03-15')
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
@@ -0,0 +1,59 @@
+"""
+Form line courses are stored under the mapped course, whatever the feed calls them
+"""
+
+import csv
+from datetime import date
+
+from sqlalchemy import text
+from werkzeug.datastructures import MultiDict
+
+from form_filters import build_form_criteria
+from ingest import ingest_file
+from migrations import course_spellings, merge_course_spellings
+from models import db, Course, FormLine, Horse
+
+
+def write_form(path, rows):
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, ['horse_name', 'race_date', 'course', 'finishing_position'])
+        writer.writeheader()
+        writer.writerows(rows)
+    return str(path)
+
+
+def test_form_line_course_uses_the_mapped_name(app, tmp_path):
+    ingest_file(write_form(tmp_path.joinpath('form.csv'), [
+        {'horse_name': 'Spelling Horse', 'race_date': '2023-09-01', 'course': 'Bangor',
+         'finishing_position': 1},
+        # The same run under the mapped name is the same line
+        {'horse_name': 'Spelling Horse', 'race_date': '2023-09-01', 'course': 'Bangor-On-Dee',
+         'finishing_position': 1},
+    ]))
+
+    horse = Horse.query.filter_by(name='Spelling Horse').one()
+    assert [line.course for line in horse.form_lines] == ['Bangor-On-Dee']
+    assert Course.query.filter_by(name='Bangor').count() == 0
+    for spelling in ['Bangor', 'Bangor-On-Dee']:
+        criteria = build_form_criteria(MultiDict([('course', spelling)]))
+        assert FormLine.query.filter(FormLine.horse_id == horse.id, *criteria).count() == 1
+
+
+def test_migration_moves_lines_off_feed_spellings(app):
+    connection = db.session.connection()
+    horse_id = connection.execute(text("INSERT INTO horses (name) VALUES ('Old Spelling Horse') "
+                                       "RETURNING id")).scalar()
+    spelling_id = connection.execute(text("INSERT INTO courses (name, updated_at) "
+                                          "VALUES ('Chelmsford', CURRENT_TIMESTAMP) RETURNING id")).scalar()
+    connection.execute(text('INSERT INTO form_lines (horse_id, race_date, course_id) '
+                            'VALUES (:horse_id, :race_date, :course_id)'),
+                       {'horse_id': horse_id, 'race_date': date(2022, 2, 2), 'course_id': spelling_id})
+    assert (spelling_id, 'Chelmsford (AW)') in course_spellings()
+
+    merge_course_spellings(connection)
+
+    assert course_spellings() == []
+    mapped = connection.execute(text("SELECT c.name FROM form_lines f JOIN courses c ON c.id = f.course_id "
+                                     "WHERE f.horse_id = :horse_id"), {'horse_id': horse_id}).scalar()
+    assert mapped == 'Chelmsford (AW)'
+    db.session.rollback()
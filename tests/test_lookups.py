@@ -0,0 +1,38 @@
+"""
+Coded form line columns keep every string written through the ORM
+"""
+
+from datetime import date
+
+from sqlalchemy import text
+
+from models import db, FormLine, Horse
+
+
+def test_orm_insert_and_update_keep_new_strings(app):
+    horse = Horse(name='Lookup Round Trip')
+    line = FormLine(horse=horse, race_date=date(2023, 6, 1), course='Nowhere Downs',
+                    going='Quagmire', distance='1m7f 3y', race_class='Class 9')
+    db.session.add(line)
+    db.session.commit()
+    line_id = line.id
+
+    codes = db.session.execute(text(
+        'SELECT course_id, going_id, distance_id, race_class_id FROM form_lines WHERE id = :id'),
+        {'id': line_id}).one()
+    assert 0 not in codes
+
+    db.session.expire_all()
+    line = db.session.get(FormLine, line_id)
+    assert (line.course, line.going, line.distance, line.race_class) == (
+        'Nowhere Downs', 'Quagmire', '1m7f 3y', 'Class 9')
+
+    line.going = 'Bog'
+    db.session.commit()
+    db.session.expire_all()
+    assert db.session.get(FormLine, line_id).going == 'Bog'
+    assert FormLine.query.filter(FormLine.going == 'Bog').count() == 1
+
+
+def test_filter_on_unknown_string_matches_nothing(app):
+    assert FormLine.query.filter(FormLine.going == 'No Such Going').all() == []
@@ -0,0 +1,22 @@
+"""
+Every hot endpoint query is planned on an index, without a table scan or
+(outside SORT_ALLOWED) an explicit sort
+"""
+
+import pytest
+
+from models import db
+from query_plans import HOT_QUERIES, explain, penalise_scans, regressed
+
+
+@pytest.fixture
+def plans(app):
+    penalise_scans()
+    yield
+    db.session.rollback()
+
+
+@pytest.mark.parametrize('name, build', HOT_QUERIES, ids=[name for name, _ in HOT_QUERIES])
+def test_plan_uses_indexes(plans, name, build):
+    plan = explain(build())
+    assert not regressed(name, plan), '\n'.join(['%s regressed:' % name] + plan)
@@ -0,0 +1,101 @@
+"""
+Distance and going parsing, and the cursor errors pages report
+"""
+
+import base64
+import json
+from datetime import date
+
+import pytest
+from sqlalchemy import inspect, text
+
+from migrations import backfill_measures, has_unmeasured_values
+from models import db, Race
+from pagination import decode_cursor, encode_cursor
+from race_conditions import GOING_SCALE, parse_distance, parse_going
+
+
+@pytest.mark.parametrize('text, yards', [
+    ('2m4f', 4400),
+    ('1m2f110y', 2310),
+    ('7f 3y', 1543),
+    ('1m 2½f', 2310),
+    ('5f 110y', 1210),
+    ('2 miles', 3520),
+    ('6 furlongs', 1320),
+    ('½f', 110),
+    (' 1M ', 1760),
+])
+def test_parse_distance(text, yards):
+    assert parse_distance(text) == yards
+
+
+@pytest.mark.parametrize('text', [None, '', '2x', 'm', 'about 2m', '2m4f?', 'Class 2'])
+def test_parse_distance_rejects(text):
+    assert parse_distance(text) is None
+
+
+@pytest.mark.parametrize('text, going', [
+    ('Good to Soft', 'good to soft'),
+    ('Good to Soft (Soft in places)', 'good to soft'),
+    ('Good to Soft, Soft in places', 'good to soft'),
+    ('GOOD  TO SOFT', 'good to soft'),
+    ('GS', 'good to soft'),
+    ('G/S', 'good to soft'),
+    ('Gd/Sft', 'good to soft'),
+    ('Good-Soft', 'good to soft'),
+    ('Good-to-Firm', 'good to firm'),
+    ('Yielding-To-Soft', 'yielding to soft'),
+    ('Standard / Slow', 'standard to slow'),
+    ('S/F', 'standard to fast'),
+    ('Soft', 'soft'),
+    ('Hvy', 'heavy'),
+    ('Yielding', 'yielding'),
+])
+def test_parse_going(text, going):
+    assert parse_going(text) == GOING_SCALE[going]
+
+
+@pytest.mark.parametrize('text', [None, '', 'to', 'Mud', 'Soft to Good to Firm'])
+def test_parse_going_rejects(text):
+    assert parse_going(text) is None
+
+
+def encoded(value):
+    return base64.urlsafe_b64encode(json.dumps(value).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def test_decode_cursor_round_trip():
+    assert decode_cursor(encode_cursor(date(2024, 1, 1), 7)) == (date(2024, 1, 1), 7)
+    assert decode_cursor(encoded([None, 3])) == (None, 3)
+
+
+@pytest.mark.parametrize('cursor', [
+    '',
+    'not base64!',
+    base64.urlsafe_b64encode(b'\xff\xfe').decode('ascii'),
+    encoded({'date': '2024-01-01'}),
+    encoded(['2024-01-01']),
+    encoded(['2024-01-01', 1, 2]),
+    encoded(['2024-13-01', 1]),
+    encoded(['2024-01-01', 'x']),
+    encoded(['2024-01-01', None]),
+    encoded([20240101, 1]),
+])
+def test_decode_cursor_rejects(cursor):
+    with pytest.raises(ValueError, match='Invalid cursor'):
+        decode_cursor(cursor)
+
+
+def test_migration_ranks_goings_stored_unparsed(app):
+    db.session.add(Race(date=date(2020, 3, 3), course='Ascot', race_time='13:10', going='Gd/Sft'))
+    db.session.flush()
+    db.session.execute(text("UPDATE races SET going_rank = NULL WHERE going = 'Gd/Sft'"))
+    inspector = inspect(db.session.connection())
+    assert has_unmeasured_values(inspector)
+
+    backfill_measures(db.session.connection())
+
+    assert not has_unmeasured_values(inspector)
+    assert Race.query.filter_by(going='Gd/Sft').one().going_rank == GOING_SCALE['good to soft']
+    db.session.rollback()
@@ -0,0 +1,105 @@
+"""
+/api/racecards runs a fixed number of statements however many races a day has
+"""
+
+import json
+from datetime import date
+
+import pytest
+from sqlalchemy import event
+
+from ingest import ingest_file
+from models import db, RacecardSnapshot
+
+RUNNERS_PER_RACE = 8
+FORM_LINES_PER_RUNNER = 3
+
+# Two past days (outside the live window, so no background rebuilds) with
+# very different numbers of races
+QUIET_DAY = date(2024, 3, 4)
+BUSY_DAY = date(2024, 3, 9)
+RACES = {QUIET_DAY: 2, BUSY_DAY: 24}
+
+
+def racecard(race_date, number):
+    course = ['Ascot', 'Kempton', 'Sandown'][number % 3]
+    return {
+        'date': race_date.isoformat(),
+        'course': course,
+        'race_time': '%02d:%02d' % (12 + number // 4, number % 4 * 15),
+        'race_name': 'Race %d' % number,
+        'distance': ['6f', '1m', '2m4f'][number % 3],
+        'going': 'Good',
+        'runners': [{
+            'horse_name': 'Horse %s-%d-%d' % (race_date.isoformat(), number, runner),
+            'age': 4,
+            'form_lines': [{
+                'race_date': date(2023, month, 1).isoformat(),
+                'course': course,
+                'distance': '1m',
+                'going': 'Soft',
+                'finishing_position': runner + 1,
+            } for month in range(1, FORM_LINES_PER_RUNNER + 1)],
+        } for runner in range(RUNNERS_PER_RACE)],
+    }
+
+
+@pytest.fixture(scope='module')
+def cards(app, tmp_path_factory):
+    path = tmp_path_factory.mktemp('cards').joinpath('cards.jsonl')
+    with open(path, 'w', encoding='utf-8') as f:
+        for race_date, count in RACES.items():
+            for number in range(count):
+                f.write(json.dumps(racecard(race_date, number)) + '\n')
+    stats = ingest_file(str(path))
+    assert stats['races'] == sum(RACES.values())
+    return RACES
+
+
+@pytest.fixture
+def statements(app):
+    """SQL statements run against the app's engine while the test runs"""
+    executed = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        executed.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', count)
+    yield executed
+    event.remove(db.engine, 'before_cursor_execute', count)
+
+
+def get_racecards(client, statements, race_date, form_limit):
+    del statements[:]
+    response = client.get('/api/racecards?date=%s&form_limit=%d' % (race_date.isoformat(), form_limit))
+    assert response.status_code == 200
+    return response.get_json(), len(statements)
+
+
+@pytest.mark.parametrize('form_limit', [0, 5])
+def test_statements_do_not_grow_with_races(client, cards, statements, form_limit):
+    # Read every lookup value once, so no dictionary reload is counted
+    for race_date in cards:
+        get_racecards(client, statements, race_date, 1)
+
+    counts = {}
+    for race_date, races in cards.items():
+        body, counts[race_date] = get_racecards(client, statements, race_date, form_limit)
+        assert body['count'] == races
+        runners = [runner for card in body['racecards'] for runner in card['runners']]
+        assert len(runners) == races * RUNNERS_PER_RACE
+        if form_limit:
+            assert all(len(runner['form_lines']) == FORM_LINES_PER_RUNNER for runner in runners)
+
+    # Snapshot read, version, races, runners and the snapshot upsert, plus
+    # the form version and the form lines with form_limit
+    assert counts[QUIET_DAY] == counts[BUSY_DAY] == (7 if form_limit else 5)
+
+
+def test_stored_snapshot_served_in_one_statement(client, cards, statements):
+    get_racecards(client, statements, BUSY_DAY, 0)
+    assert db.session.get(RacecardSnapshot, (BUSY_DAY, 0)) is not None
+
+    body, count = get_racecards(client, statements, BUSY_DAY, 0)
+    assert body['count'] == cards[BUSY_DAY]
+    assert count == 1
@@ -0,0 +1,40 @@
+"""
+Refreshing is idempotent, and repeats within a batch merge into one row
+"""
+
+import json
+
+from models import Race, Runner
+from refresh import refresh_file
+
+RACE = {'date': '2024-06-01', 'course': 'Sandown', 'race_time': '15:10'}
+
+
+def write_jsonl(path, records):
+    path.write_text(''.join(json.dumps(record) + '\n' for record in records), encoding='utf-8')
+    return str(path)
+
+
+def test_refreshing_twice_changes_nothing_the_second_time(app, tmp_path):
+    path = write_jsonl(tmp_path.joinpath('odds.jsonl'), [
+        dict(RACE, going='Good', runners=[{'horse_name': 'Refresh A', 'odds': '5/1'},
+                                          {'horse_name': 'Refresh B', 'odds': '3/1'}]),
+        # The same race again in the same batch, with later odds and a
+        # runner repeated within it
+        dict(RACE, runners=[{'horse_name': 'Refresh A', 'odds': '9/2'},
+                            {'horse_name': 'Refresh C', 'odds': '8/1'},
+                            {'horse_name': 'Refresh C', 'jockey': 'J Smith'}]),
+    ])
+
+    first = refresh_file(path)
+    assert (first['races'], first['runners'], first['skipped']) == (1, 3, 0)
+
+    second = refresh_file(path)
+    assert (second['races'], second['runners'], second['skipped']) == (0, 0, 0)
+
+    race = Race.query.filter_by(date=RACE['date'], course=RACE['course']).one()
+    assert race.going == 'Good'
+    runners = {runner.horse_name: runner for runner in Runner.query.filter_by(race_id=race.id)}
+    assert sorted(runners) == ['Refresh A', 'Refresh B', 'Refresh C']
+    assert runners['Refresh A'].odds == '9/2'
+    assert (runners['Refresh C'].odds, runners['Refresh C'].jockey) == ('8/1', 'J Smith')